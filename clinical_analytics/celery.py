@@ -9,15 +9,33 @@ os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'clinical_analytics.settings')
 app = Celery("clinical_analytics")
 app.config_from_object("django.conf:settings", namespace="CELERY")
 
+# Ingestion runs on its own queues so each stage can get a worker pool suited to its bottleneck: downloads are
+# network bound, extraction and parsing are CPU bound and the write-heavy jobs are bound by MongoDB.
+# Everything else stays on the default tasks queue.
+QUEUES = ['tasks', 'download', 'extract', 'parse', 'write']
+
 app.conf.task_queues = [
-    Queue('tasks', Exchange('tasks'), routing_key='tasks',
-          queue_arguments={'x-max-priority': 10}),
+    Queue(queue, Exchange(queue), routing_key=queue, queue_arguments={'x-max-priority': 10})
+    for queue in QUEUES
 ]
+app.conf.task_default_queue = 'tasks'
+app.conf.task_routes = {
+    'data_upload.tasks.download_file': {'queue': 'download'},
+    'data_upload.tasks.process_zip_file': {'queue': 'extract'},
+    'data_upload.tasks.prescan_file': {'queue': 'extract'},
+    'data_upload.tasks.process_csv_file': {'queue': 'parse'},
+    'data_upload.tasks.wrapper_process_csv_file': {'queue': 'parse'},
+    'data_upload.tasks.apply_bulk_edit': {'queue': 'write'},
+    'data_upload.tasks.join_sheets': {'queue': 'write'},
+    'data_upload.tasks.refresh_saved_query': {'queue': 'write'},
+    'data_upload.tasks.compute_formula_column': {'queue': 'write'},
+    'data_upload.tasks.compact_deleted_columns': {'queue': 'write'},
+}
 
 app.conf.task_acks_late = True
 app.conf.task_default_priority = 5
 app.conf.worker_prefetch_multiplier = 1
-app.conf.worker_concurrency = 1
+app.conf.worker_concurrency = int(os.getenv('CELERY_WORKER_CONCURRENCY', 1))
 app.autodiscover_tasks()
 
 
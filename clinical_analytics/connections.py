@@ -0,0 +1,129 @@
+import threading
+import time
+
+from azure.storage.blob import BlobServiceClient
+from django.conf import settings
+from django.db.backends.signals import connection_created
+from pymongo import monitoring
+
+
+class MongoPoolMetrics(monitoring.ConnectionPoolListener):
+    """Collects connection pool wait time and utilization for every Mongo client of the process."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.pools = 0
+        self.open_connections = 0
+        self.checked_out = 0
+        self.max_checked_out = 0
+        self.checkouts = 0
+        self.checkout_failures = 0
+        self.total_wait_ms = 0.0
+        self.max_wait_ms = 0.0
+
+    def pool_created(self, event):
+        with self._lock:
+            self.pools += 1
+
+    def pool_cleared(self, event):
+        pass
+
+    def pool_closed(self, event):
+        with self._lock:
+            self.pools -= 1
+
+    def connection_created(self, event):
+        with self._lock:
+            self.open_connections += 1
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        with self._lock:
+            self.open_connections -= 1
+
+    def connection_check_out_started(self, event):
+        self._local.started = time.perf_counter()
+
+    def connection_check_out_failed(self, event):
+        with self._lock:
+            self.checkout_failures += 1
+
+    def connection_checked_out(self, event):
+        started = getattr(self._local, "started", None)
+        wait_ms = (time.perf_counter() - started) * 1000 if started else 0.0
+        with self._lock:
+            self.checkouts += 1
+            self.checked_out += 1
+            self.max_checked_out = max(self.max_checked_out, self.checked_out)
+            self.total_wait_ms += wait_ms
+            self.max_wait_ms = max(self.max_wait_ms, wait_ms)
+
+    def connection_checked_in(self, event):
+        with self._lock:
+            self.checked_out -= 1
+
+    def snapshot(self):
+        with self._lock:
+            max_pool_size = settings.MONGO_MAX_POOL_SIZE * max(self.pools, 1)
+            return {
+                "pools": self.pools,
+                "max_pool_size": settings.MONGO_MAX_POOL_SIZE,
+                "open_connections": self.open_connections,
+                "checked_out": self.checked_out,
+                "max_checked_out": self.max_checked_out,
+                "utilization": self.checked_out / max_pool_size,
+                "checkouts": self.checkouts,
+                "checkout_failures": self.checkout_failures,
+                "average_wait_ms": self.total_wait_ms / self.checkouts if self.checkouts else 0.0,
+                "max_wait_ms": self.max_wait_ms,
+            }
+
+
+class PostgresConnectionMetrics:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.connections_created = 0
+
+    def connection_created(self, sender, connection, **kwargs):
+        with self._lock:
+            self.connections_created += 1
+
+    def snapshot(self):
+        return {
+            "connections_created": self.connections_created,
+            "conn_max_age": settings.DATABASES['default'].get('CONN_MAX_AGE'),
+            "health_checks": settings.DATABASES['default'].get('CONN_HEALTH_CHECKS'),
+        }
+
+
+mongo_pool_metrics = MongoPoolMetrics()
+postgres_connection_metrics = PostgresConnectionMetrics()
+connection_created.connect(postgres_connection_metrics.connection_created,
+                           dispatch_uid="postgres_connection_metrics")
+
+_blob_service_client = None
+_blob_service_client_lock = threading.Lock()
+
+
+def get_blob_service_client():
+    global _blob_service_client
+    if _blob_service_client is None:
+        with _blob_service_client_lock:
+            if _blob_service_client is None:
+                _blob_service_client = BlobServiceClient.from_connection_string(
+                    settings.AZURE_STORAGE_CONNECTION_STRING,
+                    connection_timeout=settings.AZURE_STORAGE_CONNECTION_TIMEOUT,
+                )
+    return _blob_service_client
+
+
+def connection_metrics():
+    return {
+        "mongo": mongo_pool_metrics.snapshot(),
+        "postgres": postgres_connection_metrics.snapshot(),
+        "blob": {"client_initialized": _blob_service_client is not None},
+    }
@@ -16,6 +16,7 @@ from dotenv import load_dotenv
 
 from mongoengine import connect
 
+from .connections import mongo_pool_metrics
 from .logging import LOGGING
 
 load_dotenv()
@@ -92,12 +93,31 @@ DATABASES = {
         'PASSWORD': os.getenv('POSTGRES_PASSWORD'),
         'HOST': os.getenv('POSTGRES_HOST'),
         'PORT': os.getenv('POSTGRES_PORT'),
+        'CONN_MAX_AGE': int(os.getenv('POSTGRES_CONN_MAX_AGE', 600)),
+        'CONN_HEALTH_CHECKS': True,
     }
 }
 
+MONGO_NAME = os.getenv('MONGO_NAME')
+MONGO_HOST = os.getenv('MONGO_HOST')
+MONGO_MAX_POOL_SIZE = int(os.getenv('MONGO_MAX_POOL_SIZE', 100))
+MONGO_MIN_POOL_SIZE = int(os.getenv('MONGO_MIN_POOL_SIZE', 5))
+MONGO_MAX_IDLE_TIME_MS = int(os.getenv('MONGO_MAX_IDLE_TIME_MS', 300000))
+MONGO_WAIT_QUEUE_TIMEOUT_MS = int(os.getenv('MONGO_WAIT_QUEUE_TIMEOUT_MS', 10000))
+MONGO_CLIENT_OPTIONS = {
+    'maxPoolSize': MONGO_MAX_POOL_SIZE,
+    'minPoolSize': MONGO_MIN_POOL_SIZE,
+    'maxIdleTimeMS': MONGO_MAX_IDLE_TIME_MS,
+    'waitQueueTimeoutMS': MONGO_WAIT_QUEUE_TIMEOUT_MS,
+    'event_listeners': [mongo_pool_metrics],
+    # The encoding MongoEngine defaults to, set explicitly so the Motor client reads UUIDs the same way.
+    'uuidRepresentation': 'pythonLegacy',
+}
+
 connect(
-    db=os.getenv('MONGO_NAME'),  # Name of your MongoDB database
-    host=os.getenv('MONGO_HOST'),
+    db=MONGO_NAME,  # Name of your MongoDB database
+    host=MONGO_HOST,
+    **MONGO_CLIENT_OPTIONS
 )
 
 # Password validation
@@ -146,8 +166,80 @@ CELERY_RESULT_BACKEND = os.environ.get("CELERY_BACKEND", "redis://redis:6379/0")
 
 AZURE_STORAGE_CONNECTION_STRING = os.getenv('AZURE_STORAGE_CONNECTION_STRING')
 AZURE_STORAGE_CONTAINER_NAME = os.getenv('AZURE_STORAGE_CONTAINER_NAME')
+AZURE_STORAGE_CONNECTION_TIMEOUT = int(os.getenv('AZURE_STORAGE_CONNECTION_TIMEOUT', 20))
 TEMP_FILE_PATH = '/tmp'
+# Per-job scratch workspaces; point SCRATCH_ROOT at a fast local disk shared by the ingestion workers.
+SCRATCH_ROOT = os.getenv('SCRATCH_ROOT', os.path.join(TEMP_FILE_PATH, 'scratch'))
+# Total bytes all workspaces may reserve; 0 only checks the free disk space.
+SCRATCH_QUOTA_BYTES = int(os.getenv('SCRATCH_QUOTA_BYTES', 0))
+SCRATCH_QUOTA_RETRY_DELAY = int(os.getenv('SCRATCH_QUOTA_RETRY_DELAY', 60))
+SCRATCH_WORKSPACE_MAX_IDLE = int(os.getenv('SCRATCH_WORKSPACE_MAX_IDLE', 6 * 60 * 60))
+ZIP_EXTRACT_THREADS = int(os.getenv('ZIP_EXTRACT_THREADS', 4))
+ZIP_EXTRACT_BUFFER_SIZE = int(os.getenv('ZIP_EXTRACT_BUFFER_SIZE', 1024 * 1024))
 ITER_CHUNK_SIZE = 1000
+# "python" (csv/openpyxl), "arrow" (needs pyarrow) or "auto", which picks arrow for CSV files above the minimum size.
+SHEET_PARSER_BACKEND = os.getenv('SHEET_PARSER_BACKEND', 'auto')
+SHEET_PARSER_ARROW_MIN_SIZE = int(os.getenv('SHEET_PARSER_ARROW_MIN_SIZE', 16 * 1024 * 1024))
+SHEET_PARSER_BLOCK_SIZE = int(os.getenv('SHEET_PARSER_BLOCK_SIZE', 4 * 1024 * 1024))
+# The pre-scan reads this many bytes from the start and the end of a CSV and checks up to PRESCAN_SAMPLE_ROWS of each.
+PRESCAN_SAMPLE_BYTES = int(os.getenv('PRESCAN_SAMPLE_BYTES', 1024 * 1024))
+PRESCAN_SAMPLE_ROWS = int(os.getenv('PRESCAN_SAMPLE_ROWS', 1000))
+PRESCAN_MAX_REPORTED_ROWS = int(os.getenv('PRESCAN_MAX_REPORTED_ROWS', 20))
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': os.environ.get("CACHE_LOCATION", "redis://redis:6379/1"),
+    }
+}
+
+LOCAL_CACHE_MAX_SIZE = int(os.getenv('LOCAL_CACHE_MAX_SIZE', 1024))
+LOCAL_CACHE_TTL = int(os.getenv('LOCAL_CACHE_TTL', 300))
+CACHE_INVALIDATION_URL = os.environ.get("CACHE_INVALIDATION_URL", CACHES['default']['LOCATION'])
+CACHE_INVALIDATION_CHANNEL = os.environ.get("CACHE_INVALIDATION_CHANNEL", "clinical_analytics.sheet_changed")
+CACHE_INVALIDATION_RETRY_DELAY = int(os.getenv('CACHE_INVALIDATION_RETRY_DELAY', 30))
+
+AGGREGATION_MAX_TIME_MS = int(os.getenv('AGGREGATION_MAX_TIME_MS', 30000))
+AGGREGATION_MAX_GROUPS = int(os.getenv('AGGREGATION_MAX_GROUPS', 10000))
+AGGREGATION_CACHE_TIMEOUT = int(os.getenv('AGGREGATION_CACHE_TIMEOUT', 60 * 60 * 24))
+
+COLUMN_DICTIONARY_MAX_VALUES = int(os.getenv('COLUMN_DICTIONARY_MAX_VALUES', 1000))
+
+SEARCH_SNIPPET_WIDTH = int(os.getenv('SEARCH_SNIPPET_WIDTH', 40))
+SEARCH_MAX_TIME_MS = int(os.getenv('SEARCH_MAX_TIME_MS', 5000))
+
+JOIN_PARTITIONS = int(os.getenv('JOIN_PARTITIONS', 32))
+
+SORT_INDEX_BATCH_SIZE = int(os.getenv('SORT_INDEX_BATCH_SIZE', 5000))
+
+EDIT_JOURNAL_RETAINED_REVISIONS = int(os.getenv('EDIT_JOURNAL_RETAINED_REVISIONS', 100))
+EDIT_JOURNAL_COMPACTION_BATCH_SIZE = int(os.getenv('EDIT_JOURNAL_COMPACTION_BATCH_SIZE', 5000))
+EDIT_CONFLICT_REPORT_LIMIT = int(os.getenv('EDIT_CONFLICT_REPORT_LIMIT', 100))
+# Pending journal entries older than this belong to an edit whose process died; they stop counting as conflicts and
+# the journal compaction removes them. It must exceed the time the longest edit takes to write its cells.
+EDIT_PENDING_TIMEOUT = int(os.getenv('EDIT_PENDING_TIMEOUT', 15 * 60))
+METADATA_UPDATE_ATTEMPTS = int(os.getenv('METADATA_UPDATE_ATTEMPTS', 5))
+# Upload size limits in bytes, smallest first; each step down the list lowers the ingest priority.
+INGEST_PRIORITY_THRESHOLDS = [int(size) for size in os.getenv(
+    'INGEST_PRIORITY_THRESHOLDS', '1048576,10485760,104857600,1073741824').split(',')]
+STUDY_MAX_CONCURRENT_TASKS = int(os.getenv('STUDY_MAX_CONCURRENT_TASKS', 2))
+STUDY_SLOT_TIMEOUT = int(os.getenv('STUDY_SLOT_TIMEOUT', 2 * 60 * 60))
+STUDY_SLOT_RETRY_DELAY = int(os.getenv('STUDY_SLOT_RETRY_DELAY', 15))
+STUDY_SLOT_REDIS_URL = os.environ.get("STUDY_SLOT_REDIS_URL", CACHES['default']['LOCATION'])
+BULK_EDIT_BATCH_SIZE = int(os.getenv('BULK_EDIT_BATCH_SIZE', 5000))
+BULK_EDIT_MAX_REPORTED_ERRORS = int(os.getenv('BULK_EDIT_MAX_REPORTED_ERRORS', 10000))
+CELERY_BEAT_SCHEDULE = {
+    'compact-edit-journals': {
+        'task': 'data_upload.tasks.compact_edit_journals',
+        'schedule': float(os.getenv('EDIT_JOURNAL_COMPACTION_INTERVAL', 3600)),
+        'options': {'queue': 'tasks'},
+    },
+    'reap-scratch-workspaces': {
+        'task': 'data_upload.tasks.reap_scratch_workspaces',
+        'schedule': float(os.getenv('SCRATCH_REAP_INTERVAL', 15 * 60)),
+        'options': {'queue': 'tasks'},
+    },
+}
 
 CORS_ALLOW_ALL_ORIGINS = True
 # CORS_ORIGIN_WHITELIST = [
@@ -162,4 +254,11 @@ CORS_ALLOW_HEADERS = [
     'content-type',
     'x-csrftoken',
     'Authorization',
+    'if-none-match',
+    'if-modified-since',
+]
+
+CORS_EXPOSE_HEADERS = [
+    'ETag',
+    'Last-Modified',
 ]
@@ -1,22 +1,52 @@
+import csv
+import hashlib
+import json
+import os
+import re
 import uuid
 
 import jwt
-import pymongo
+from asgiref.sync import sync_to_async
 from azure.core.exceptions import AzureError
-from azure.storage.blob import BlobServiceClient
 from celery import chain
 from django.conf import settings
+from django.core.cache import cache
 from ninja import NinjaAPI, UploadedFile, File, Form
-from .tasks import download_file, process_zip_file, process_csv_file, wrapper_process_csv_file
+from .tasks import download_file, process_zip_file, prescan_file, process_csv_file, wrapper_process_csv_file, \
+    join_sheets, refresh_saved_query, build_column_sort_index, compute_formula_column, compact_deleted_columns, \
+    schedule_edit_followups, apply_bulk_edit
 from .models import ZipUploadData, SheetUploadData, DataImportStatusEnum, StudyData, SheetMetaData, MongoDbClient, \
-    CustomColumnData, ColumnData
+    CustomColumnData, ColumnData, SearchDocument, SavedQuery, SortIndex, EditJournal, EditJournalArchive, \
+    EditActionEnum, BulkEditJob
 from .schemas import ZipUploadResponseObject, SheetUploadResponseObject, StudyDataResponseObject, \
     StudyListResponseObject, SingleStudyResponseObject, SingleStudyDataSchema, StudyDataSchema, ZipUploadDataSchema, \
     SheetUploadDataSchema, UploadRequestSchema, SheetMetadataResponseObject, SheetMetadataSchema, ColumnDataSchema, \
-    SheetDataResponseObject, FilterSchema, SheetUpdateRequestSchema, CustomColumnDataSchema
+    SheetDataResponseObject, SheetDataSchema, FilterSchema, SheetUpdateRequestSchema, CustomColumnDataSchema, \
+    AggregationRequestSchema, AggregationResponseObject, AggregationResultSchema, DistinctValuesResponseObject, \
+    DistinctValuesSchema, DistinctValueSchema, SearchResponseObject, SearchResultsSchema, SearchHitSchema, \
+    JoinRequestSchema, SavedQueryRequestSchema, SavedQueryResponseObject, SavedQueryListResponseObject, \
+    SavedQuerySchema, SortIndexListResponseObject, SortIndexSchema, ConnectionMetricsResponseObject, \
+    ConnectionMetricsSchema, EditJournalResponseObject, EditJournalSchema, ColumnRenameRequestSchema, \
+    ColumnOrderRequestSchema, BulkEditRequestSchema, BulkEditJobSchema, BulkEditJobResponseObject
+from .column_dictionary import get_column_dictionary
+from .search import query_terms, build_snippet
+from .queries import generate_match_query, sorting_query
+from .sort_index import aread_sorted_page, request_sort_index_build
+from .mongo import PERCENTILE_MIN_SERVER_VERSION, get_async_collection, server_version, supports_percentile
+from .conditional import sheet_etag, not_modified_response, set_validators
+from .local_cache import aget_sheet, aget_column_data
+from .editing import recompute_edited_formulas, write_cell_edits, write_row_edits, edit_stacks, revision_edits, \
+    aoverlay_revision, new_pending_edit, publish_edits, discard_edits, update_column_metadata, EditConflictError
+from .bulk_edit import PATCH_FILE_TYPES
+from .scheduling import ingest_priority
+from .formulas import compile_formula, check_dependencies, canonical_formula, dependency_graph, FormulaError
+from .columns import ColumnOperationError, ColumnConflictError, column_key, column_match, find_column, live_columns, \
+    new_column_key, insert_column, rename_column, reorder_columns, delete_column
 import logging
 from django.http import HttpResponse, JsonResponse
+from pymongo.errors import ExecutionTimeout
 
+from clinical_analytics.connections import get_blob_service_client, connection_metrics
 from clinical_analytics.schemas import StatusEnum
 
 api = NinjaAPI(urls_namespace="data_import")
@@ -58,6 +88,14 @@ def get_user_id(request, response):
     return payload.get("user_id")
 
 
+@api.get("/health/connections", response=ConnectionMetricsResponseObject, tags=["Health"])
+def get_connection_metrics(request):
+    metrics_response = ConnectionMetricsResponseObject()
+    metrics_response.data = ConnectionMetricsSchema(**connection_metrics())
+    metrics_response.status = StatusEnum.SUCCESS
+    return JsonResponse(metrics_response.dict(), status=200, safe=False)
+
+
 @api.post("/import_data", response=ZipUploadResponseObject, tags=["Data Import"])
 def import_data(request, data_file: File[UploadedFile], payload: Form[UploadRequestSchema]):
     logger.info("Importing data")
@@ -102,7 +140,7 @@ def import_data(request, data_file: File[UploadedFile], payload: Form[UploadRequ
 
     # Upload file to Azure Storage
     try:
-        blob_service_client = BlobServiceClient.from_connection_string(settings.AZURE_STORAGE_CONNECTION_STRING)
+        blob_service_client = get_blob_service_client()
         blob_client = blob_service_client.get_blob_client(container=settings.AZURE_STORAGE_CONTAINER_NAME,
                                                           blob=blob_name)
         blob_client.upload_blob(file_obj)
@@ -120,6 +158,7 @@ def import_data(request, data_file: File[UploadedFile], payload: Form[UploadRequ
 
     # Generate URL for the uploaded file
     date_lake_url = blob_client.blob_name
+    priority = ingest_priority(len(file_obj))
 
     # Save file upload details to the database
     if zip_file_id or file_name.endswith('.zip'):
@@ -142,9 +181,10 @@ def import_data(request, data_file: File[UploadedFile], payload: Form[UploadRequ
         )
         logger.info("zip file metadata saved to the database")
         logger.info("Starting the file processing tasks for the zip file with id {}".format(zip_upload_data.id))
-        chain(download_file.s(zip_upload_data.id, None).set(queue='tasks'),
-              process_zip_file.s(zip_upload_data.id).set(queue='tasks'),
-              process_csv_file.s(zip_upload_data.id, None).set(queue='tasks')).apply_async()
+        chain(download_file.s(zip_upload_data.id, None).set(priority=priority),
+              process_zip_file.s(zip_upload_data.id).set(priority=priority),
+              prescan_file.s(True).set(priority=priority),
+              process_csv_file.s(zip_upload_data.id, None).set(priority=priority)).apply_async()
         zip_upload_response.status = StatusEnum.SUCCESS
         zip_upload_response.data = ZipUploadDataSchema.model_validate(zip_upload_data)
         return JsonResponse(zip_upload_response.dict())
@@ -174,8 +214,9 @@ def import_data(request, data_file: File[UploadedFile], payload: Form[UploadRequ
         logger.info("sheet metadata saved to the database")
         logger.info("Starting the file processing tasks for the sheet with id {}".format(sheet_data.id))
         chain(
-            download_file.s(None, sheet_data.id).set(queue='tasks'),
-            wrapper_process_csv_file.s().set(queue='tasks')
+            download_file.s(None, sheet_data.id).set(priority=priority),
+            prescan_file.s().set(priority=priority),
+            wrapper_process_csv_file.s().set(priority=priority)
         ).apply_async()
         sheet_upload_response.status = StatusEnum.SUCCESS
         sheet_upload_response.data = SheetUploadDataSchema.model_validate(sheet_data)
@@ -215,13 +256,16 @@ def create_study(request, payload: StudyDataSchema):
 
 
 @api.get("/study", response=StudyListResponseObject, tags=["Study Data"])
-def get_studies(request):
+def get_studies(request, page: int = 1, page_size: int = 50):
     logger.info("Getting studies for which user has access to")
     study_response = StudyListResponseObject()
     user_id = get_user_id(request, study_response)
     if isinstance(user_id, JsonResponse):
         return user_id
-    study_data = StudyData.objects.filter(user_id=user_id)
+    skip = (max(page, 1) - 1) * page_size
+    study_data = list(StudyData.objects.filter(user_id=user_id)
+                      .only('id', 'study_name', 'sponsor_name', 'alias')
+                      .order_by('-last_modified_date_time', 'id')[skip:skip + page_size])
     logger.info("Retrieved {} studies from the database".format(len(study_data)))
     if len(study_data) == 0:
         study_response.status = StatusEnum.FAILURE
@@ -236,84 +280,323 @@ def get_studies(request):
 
 
 @api.get("/study/{study_id}", response=SingleStudyResponseObject, tags=["Study Data"])
-def get_study(request, study_id: uuid.UUID):
+def get_study(request, study_id: uuid.UUID, page: int = 1, page_size: int = 100, active_only: bool = False,
+              latest_only: bool = False, fields: str = None):
     logger.info("Getting study with id {}".format(study_id))
     study_response = SingleStudyResponseObject()
     user_id = get_user_id(request, study_response)
     if isinstance(user_id, JsonResponse):
         return user_id
-    study_data = StudyData.objects.get(user_id=user_id, id=study_id)
+    study_data = StudyData.objects.filter(user_id=user_id, id=study_id).first()
     if not study_data:
         logger.error("No study found with id {}".format(study_id))
         study_response.status = StatusEnum.FAILURE
         study_response.messages.append("No study found with id {}".format(study_id))
-        return HttpResponse(study_response, status=404)
+        return JsonResponse(study_response.dict(), status=404, safe=False)
+
+    sheet_fields = list(SheetUploadDataSchema.model_fields)
+    if fields:
+        selected_fields = [field.strip() for field in fields.split(",") if field.strip()]
+        unknown_fields = [field for field in selected_fields if field not in sheet_fields]
+        if unknown_fields:
+            study_response.status = StatusEnum.FAILURE
+            study_response.messages.append("Unknown sheet fields: {}".format(", ".join(unknown_fields)))
+            return JsonResponse(study_response.dict(), status=400, safe=False)
+        sheet_fields = ['id'] + [field for field in selected_fields if field != 'id']
 
-    logger.info("Retrieved study data and sheet uploads from the database")
     sheet_uploads = SheetUploadData.objects.filter(study_id=study_id)
+    if active_only:
+        sheet_uploads = sheet_uploads.filter(active=True)
+    if latest_only:
+        sheet_uploads = sheet_uploads.order_by('original_file_name', '-version_number').distinct(
+            'original_file_name')
+    else:
+        sheet_uploads = sheet_uploads.order_by('original_file_name', '-version_number', 'id')
+    skip = (max(page, 1) - 1) * page_size
+    sheet_uploads = list(sheet_uploads.values(*sheet_fields)[skip:skip + page_size + 1])
+    has_more = len(sheet_uploads) > page_size
+    sheet_uploads = sheet_uploads[:page_size]
     logger.info("Retrieved {} sheet uploads for the study with id {}".format(len(sheet_uploads), study_id))
+    if fields:
+        sheet_list = sheet_uploads
+    else:
+        sheet_list = [SheetUploadDataSchema.model_validate(sheet) for sheet in sheet_uploads]
     study_response.status = StatusEnum.SUCCESS
-    sheet_list = [SheetUploadDataSchema.model_validate(sheet) for sheet in sheet_uploads]
-    study_response.data = SingleStudyDataSchema(StudyDataSchema.model_validate(study_data), sheet_list)
+    study_response.data = SingleStudyDataSchema(StudyDataSchema.model_validate(study_data), sheet_list,
+                                                page=page, page_size=page_size, has_more=has_more)
     return JsonResponse(study_response.dict(), status=200, safe=False)
 
 
+@api.get("/study/{study_id}/search", response=SearchResponseObject, tags=["Study Data"])
+def search_study(request, study_id: uuid.UUID, q: str, sheet_id: uuid.UUID = None, page: int = 1,
+                 page_size: int = 50):
+    logger.info("Searching study with id {} for '{}'".format(study_id, q))
+    search_response = SearchResponseObject()
+    user_id = get_user_id(request, search_response)
+    if isinstance(user_id, JsonResponse):
+        return user_id
+    study_data = StudyData.objects.filter(user_id=user_id, id=study_id).first()
+    if not study_data:
+        logger.error("No study found with id {}".format(study_id))
+        search_response.status = StatusEnum.FAILURE
+        search_response.messages.append("No study found with id {}".format(study_id))
+        return JsonResponse(search_response.dict(), status=404, safe=False)
+    if not q.strip():
+        search_response.status = StatusEnum.FAILURE
+        search_response.messages.append("Search query is required")
+        return JsonResponse(search_response.dict(), status=400, safe=False)
+
+    sheets = SheetUploadData.objects.filter(study_id=study_id, active=True)
+    if sheet_id:
+        sheets = sheets.filter(id=sheet_id)
+    sheet_refs = {str(sheet.unique_reference): sheet.id for sheet in sheets.only('id', 'unique_reference')}
+    logger.info("Searching {} active sheets of study with id {}".format(len(sheet_refs), study_id))
+
+    skip = (page - 1) * page_size
+    cursor = SearchDocument._get_collection().find(
+        {"study_id": str(study_id), "sql_ref": {"$in": list(sheet_refs.keys())}, "$text": {"$search": q}},
+        {"score": {"$meta": "textScore"}, "sql_ref": 1, "sct_id": 1, "cells": 1},
+    ).sort([("score", {"$meta": "textScore"})]).skip(skip).limit(page_size + 1).max_time_ms(
+        settings.SEARCH_MAX_TIME_MS)
+    try:
+        documents = list(cursor)
+    except ExecutionTimeout:
+        logger.error("Search timed out for study with id {}".format(study_id))
+        search_response.status = StatusEnum.FAILURE
+        search_response.messages.append("Search exceeded the time budget of {} ms".format(settings.SEARCH_MAX_TIME_MS))
+        return JsonResponse(search_response.dict(), status=504, safe=False)
+
+    terms = query_terms(q)
+    results = []
+    for document in documents[:page_size]:
+        column, snippet = build_snippet(document.get("cells", {}), terms)
+        results.append(SearchHitSchema(sheet_id=sheet_refs[document["sql_ref"]], sct_id=document["sct_id"],
+                                       column=column, snippet=snippet, score=document.get("score", 0)))
+    logger.info("Found {} search results for study with id {}".format(len(results), study_id))
+    search_response.data = SearchResultsSchema(query=q, page=page, page_size=page_size,
+                                               has_more=len(documents) > page_size, results=results)
+    search_response.status = StatusEnum.SUCCESS
+    return JsonResponse(search_response.dict(), status=200, safe=False)
+
+
+@api.post("/study/{study_id}/join", response=SheetUploadResponseObject, tags=["Study Data"])
+def join_study_sheets(request, study_id: uuid.UUID, payload: JoinRequestSchema):
+    logger.info("Joining sheets {} of study with id {}".format(payload.sheet_ids, study_id))
+    join_response = SheetUploadResponseObject()
+    user_id = get_user_id(request, join_response)
+    if isinstance(user_id, JsonResponse):
+        return user_id
+    study_data = StudyData.objects.filter(user_id=user_id, id=study_id).first()
+    if not study_data:
+        logger.error("No study found with id {}".format(study_id))
+        join_response.status = StatusEnum.FAILURE
+        join_response.messages.append("No study found with id {}".format(study_id))
+        return JsonResponse(join_response.dict(), status=404, safe=False)
+
+    sheets = {sheet.id: sheet for sheet in
+              SheetUploadData.objects.filter(study_id=study_id, active=True, id__in=payload.sheet_ids)}
+    missing_sheets = [str(sheet_id) for sheet_id in payload.sheet_ids if sheet_id not in sheets]
+    if missing_sheets:
+        logger.error("Sheets {} are not active sheets of study with id {}".format(missing_sheets, study_id))
+        join_response.status = StatusEnum.FAILURE
+        join_response.messages.append("Sheets are not active sheets of the study: {}".format(", ".join(missing_sheets)))
+        return JsonResponse(join_response.dict(), status=400, safe=False)
+    for sheet in sheets.values():
+        meta_data = SheetMetaData.objects(sql_ref=str(sheet.unique_reference)).first()
+        column_names = [column.name for column in live_columns(meta_data.column_data)] if meta_data else []
+        missing_keys = [key for key in payload.join_keys if key not in column_names]
+        if missing_keys:
+            logger.error("Join keys {} not found in sheet with id {}".format(missing_keys, sheet.id))
+            join_response.status = StatusEnum.FAILURE
+            join_response.messages.append("Join keys {} not found in sheet {}".format(
+                ", ".join(missing_keys), sheet.original_file_name))
+            return JsonResponse(join_response.dict(), status=400, safe=False)
+
+    result_sheet = SheetUploadData.objects.create(
+        study_id=study_id,
+        original_file_name="{} join({})".format(payload.join_type, ", ".join(
+            sheets[sheet_id].original_file_name for sheet_id in payload.sheet_ids)),
+        unique_reference=uuid.uuid4(),
+        version_number=1,
+        status=DataImportStatusEnum.UPLOADED,
+        file_type=".join",
+        uploaded_by_id=user_id,
+        active=False
+    )
+    logger.info("Starting the join task for result sheet with id {}".format(result_sheet.id))
+    filters = [filter_data.model_dump() if filter_data else None for filter_data in payload.filters] \
+        if payload.filters else None
+    join_sheets.s(result_sheet.id, payload.sheet_ids, payload.join_keys, payload.join_type, filters).apply_async()
+    join_response.status = StatusEnum.SUCCESS
+    join_response.data = SheetUploadDataSchema.model_validate(result_sheet)
+    return JsonResponse(join_response.dict(), status=202, safe=False)
+
+
+@api.post("/study/{study_id}/saved_query", response=SavedQueryResponseObject, tags=["Saved Queries"])
+def create_saved_query(request, study_id: uuid.UUID, payload: SavedQueryRequestSchema):
+    logger.info("Creating saved query {} for study with id {}".format(payload.name, study_id))
+    saved_query_response = SavedQueryResponseObject()
+    user_id = get_user_id(request, saved_query_response)
+    if isinstance(user_id, JsonResponse):
+        return user_id
+    source_sheet = SheetUploadData.objects.filter(id=payload.sheet_id, study_id=study_id,
+                                                  study__user_id=user_id).first()
+    if not source_sheet:
+        logger.error("No sheet found with id {} in study with id {}".format(payload.sheet_id, study_id))
+        saved_query_response.status = StatusEnum.FAILURE
+        saved_query_response.messages.append("No sheet found with id {}".format(payload.sheet_id))
+        return JsonResponse(saved_query_response.dict(), status=404, safe=False)
+    if SavedQuery.objects.filter(study_id=study_id, name=payload.name).exists():
+        logger.error("Saved query {} already exists for study with id {}".format(payload.name, study_id))
+        saved_query_response.status = StatusEnum.FAILURE
+        saved_query_response.messages.append("Saved query {} already exists".format(payload.name))
+        return JsonResponse(saved_query_response.dict(), status=400, safe=False)
+
+    result_sheet = SheetUploadData.objects.create(
+        study_id=study_id,
+        original_file_name=payload.name,
+        unique_reference=uuid.uuid4(),
+        version_number=1,
+        status=DataImportStatusEnum.UPLOADED,
+        file_type=".view",
+        uploaded_by_id=user_id,
+        active=False
+    )
+    saved_query = SavedQuery.objects.create(
+        name=payload.name,
+        study_id=study_id,
+        source_file_name=source_sheet.original_file_name,
+        result_sheet=result_sheet,
+        filter_data=payload.filter_data.model_dump(),
+        created_by_id=user_id
+    )
+    logger.info("Starting the materialization of saved query with id {}".format(saved_query.id))
+    refresh_saved_query.s(saved_query.id).apply_async()
+    saved_query_response.status = StatusEnum.SUCCESS
+    saved_query_response.data = SavedQuerySchema.model_validate(saved_query)
+    return JsonResponse(saved_query_response.dict(), status=201, safe=False)
+
+
+@api.get("/study/{study_id}/saved_query", response=SavedQueryListResponseObject, tags=["Saved Queries"])
+def get_saved_queries(request, study_id: uuid.UUID):
+    logger.info("Fetching saved queries for study with id {}".format(study_id))
+    saved_query_response = SavedQueryListResponseObject()
+    user_id = get_user_id(request, saved_query_response)
+    if isinstance(user_id, JsonResponse):
+        return user_id
+    saved_queries = SavedQuery.objects.filter(study_id=study_id, study__user_id=user_id)
+    saved_query_response.status = StatusEnum.SUCCESS
+    saved_query_response.data = [SavedQuerySchema.model_validate(saved_query) for saved_query in saved_queries]
+    return JsonResponse(saved_query_response.dict(), status=200, safe=False)
+
+
+@api.get("/saved_query/{saved_query_id}", response=SavedQueryResponseObject, tags=["Saved Queries"])
+def get_saved_query(request, saved_query_id: uuid.UUID):
+    logger.info("Fetching saved query with id {}".format(saved_query_id))
+    saved_query_response = SavedQueryResponseObject()
+    user_id = get_user_id(request, saved_query_response)
+    if isinstance(user_id, JsonResponse):
+        return user_id
+    saved_query = SavedQuery.objects.filter(id=saved_query_id, study__user_id=user_id).first()
+    if not saved_query:
+        logger.error("No saved query found with id {}".format(saved_query_id))
+        saved_query_response.status = StatusEnum.FAILURE
+        saved_query_response.messages.append("No saved query found with id {}".format(saved_query_id))
+        return JsonResponse(saved_query_response.dict(), status=404, safe=False)
+    saved_query_response.status = StatusEnum.SUCCESS
+    saved_query_response.data = SavedQuerySchema.model_validate(saved_query)
+    return JsonResponse(saved_query_response.dict(), status=200, safe=False)
+
+
+@api.post("/saved_query/{saved_query_id}/refresh", response=SavedQueryResponseObject, tags=["Saved Queries"])
+def refresh_saved_query_api(request, saved_query_id: uuid.UUID):
+    logger.info("Refreshing saved query with id {}".format(saved_query_id))
+    saved_query_response = SavedQueryResponseObject()
+    user_id = get_user_id(request, saved_query_response)
+    if isinstance(user_id, JsonResponse):
+        return user_id
+    saved_query = SavedQuery.objects.filter(id=saved_query_id, study__user_id=user_id).first()
+    if not saved_query:
+        logger.error("No saved query found with id {}".format(saved_query_id))
+        saved_query_response.status = StatusEnum.FAILURE
+        saved_query_response.messages.append("No saved query found with id {}".format(saved_query_id))
+        return JsonResponse(saved_query_response.dict(), status=404, safe=False)
+    refresh_saved_query.s(saved_query.id).apply_async()
+    saved_query_response.status = StatusEnum.SUCCESS
+    saved_query_response.data = SavedQuerySchema.model_validate(saved_query)
+    return JsonResponse(saved_query_response.dict(), status=202, safe=False)
+
+
 @api.get("/sheet/{sheet_id}/meta_data", response=SheetMetadataResponseObject, tags=["Study Data"])
-def get_sheet_meta_data(request, sheet_id: uuid.UUID):
+async def get_sheet_meta_data(request, sheet_id: uuid.UUID):
     logger.info("Fetching meta data for sheet with id {}".format(sheet_id))
     meta_data_response = SheetMetadataResponseObject()
     sheet_meta_schema = SheetMetadataSchema()
     user_id = get_user_id(request, sheet_meta_schema)
     if isinstance(user_id, JsonResponse):
         return user_id
-    sheet_data = SheetUploadData.objects.get(id=sheet_id)
+    sheet_data = await aget_sheet(sheet_id)
     if not sheet_data:
         logger.error("No sheet found with id {}".format(sheet_id))
         meta_data_response.status = StatusEnum.FAILURE
         meta_data_response.messages.append("No sheet found with id {}".format(sheet_id))
         return JsonResponse(meta_data_response.dict(), status=404, safe=False)
 
-    aggregation_pipeline = [
-        {'$match': {'sql_ref': sheet_data.unique_reference}},
-        {'$unwind': '$column_data'},
-        {'$sort': {'column_data.column_index': 1}},
-        {'$group': {
-            '_id': '$_id',
-            'column_data': {'$push': '$column_data'}
-        }},
-    ]
-    sheet_meta_data = list(SheetMetaData.objects.aggregate(aggregation_pipeline))
-    logger.info("Retrieved sheet meta data from the database for sheet with id {}".format(sheet_data.unique_reference))
-    if not sheet_meta_data:
+    etag = sheet_etag(sheet_data, request)
+    not_modified = not_modified_response(request, etag, sheet_data.last_modified)
+    if not_modified:
+        logger.info("Sheet with id {} not modified since revision {}".format(sheet_id, sheet_data.revision))
+        return not_modified
+
+    column_data = await aget_column_data(sheet_data.unique_reference)
+    logger.info("Retrieved sheet meta data for sheet with id {}".format(sheet_data.unique_reference))
+    if column_data is None:
         logger.error("No sheet meta data found for sheet with id {}".format(sheet_id))
         meta_data_response.status = StatusEnum.FAILURE
         meta_data_response.messages.append("No sheet meta data found for sheet with id {}".format(sheet_id))
         return JsonResponse(meta_data_response.dict(), status=404, safe=False)
     sheet_meta_schema.sql_ref = sheet_data.unique_reference
-    logger.info(sheet_meta_data[0])
-    sheet_meta_schema.column_data = [ColumnDataSchema.model_validate(column) for column in
-                                     sheet_meta_data[0].get('column_data',[])]
+    sheet_meta_schema.column_data = [ColumnDataSchema.model_validate({**column, "key": column_key(column)})
+                                     for column in column_data]
     sheet_meta_schema.sheet_data = SheetUploadDataSchema.model_validate(sheet_data)
     meta_data_response.data = sheet_meta_schema
     meta_data_response.status = StatusEnum.SUCCESS
     logger.info("Retrieved sheet meta data from the database")
-    return JsonResponse(meta_data_response.dict(), status=200, safe=False)
+    return set_validators(JsonResponse(meta_data_response.dict(), status=200, safe=False), etag,
+                          sheet_data.last_modified)
 
 
 @api.get("/sheet/{sheet_id}", response=SheetDataResponseObject, tags=["Study Data"])
-def get_sheet_data(request, sheet_id: uuid.UUID, page: int = 1, page_size: int = 1000):
+async def get_sheet_data(request, sheet_id: uuid.UUID, page: int = 1, page_size: int = 1000, revision: int = None):
     logger.info("Fetching data for sheet with id {}".format(sheet_id))
     sheet_response = SheetDataResponseObject()
     user_id = get_user_id(request, sheet_response)
     if isinstance(user_id, JsonResponse):
         return user_id
-    sheet_data = SheetUploadData.objects.get(id=sheet_id)
+    sheet_data = await aget_sheet(sheet_id)
     if not sheet_data:
         logger.error("No sheet found with id {}".format(sheet_id))
         sheet_response.status = StatusEnum.FAILURE
         sheet_response.messages.append("No sheet found with id {}".format(sheet_id))
         return JsonResponse(sheet_response.dict(), status=404, safe=False)
     logger.info("Retrieved sheet data from the database")
+
+    etag = sheet_etag(sheet_data, request)
+    not_modified = not_modified_response(request, etag, sheet_data.last_modified)
+    if not_modified:
+        logger.info("Sheet with id {} not modified since revision {}".format(sheet_id, sheet_data.revision))
+        return not_modified
+
+    if revision is not None and revision != sheet_data.revision:
+        meta_data = await get_async_collection(SheetMetaData).find_one(
+            {"sql_ref": str(sheet_data.unique_reference)}, {"compacted_revision": 1})
+        compacted_revision = (meta_data or {}).get("compacted_revision", 0)
+        if revision > sheet_data.revision or revision < compacted_revision:
+            sheet_response.status = StatusEnum.FAILURE
+            sheet_response.messages.append("Revision {} is not available, revisions {} to {} can be read".format(
+                revision, compacted_revision, sheet_data.revision))
+            return JsonResponse(sheet_response.dict(), status=400, safe=False)
+
     skip = (page - 1) * page_size
     pipeline = [
         {"$match": {"sql_ref": f"{sheet_data.unique_reference}"}},
@@ -323,29 +606,30 @@ def get_sheet_data(request, sheet_id: uuid.UUID, page: int = 1, page_size: int =
         {"$replaceRoot": {"newRoot": "$data"}},
 
     ]
-    results = MongoDbClient.objects.aggregate(pipeline)
-    combined_data = list(results)
+    combined_data = await get_async_collection(MongoDbClient).aggregate(pipeline).to_list(None)
     logger.info("Retrieved data of length {} from the database".format(len(combined_data)))
     if not combined_data:
         logger.error("No sheet found with id {}".format(sheet_id))
         sheet_response.status = StatusEnum.FAILURE
         sheet_response.messages.append("No sheet found with id {}".format(sheet_id))
         return JsonResponse(sheet_response.dict(), status=404, safe=False)
+    if revision is not None and revision != sheet_data.revision:
+        combined_data = await aoverlay_revision(str(sheet_data.unique_reference), combined_data, revision)
     logger.info("Retrieved sheet data from the database")
     sheet_response.data = combined_data
     sheet_response.status = StatusEnum.SUCCESS
 
-    return JsonResponse(sheet_response.dict(), status=200, safe=False)
+    return set_validators(JsonResponse(sheet_response.dict(), status=200, safe=False), etag, sheet_data.last_modified)
 
 
 @api.post("/sheet/{sheet_id}/filters", response=SheetDataResponseObject, tags=["Study Data"])
-def apply_sheet_filters(request, sheet_id: uuid.UUID, filter_data: FilterSchema, page: int = 1, page_size: int = 1000):
+async def apply_sheet_filters(request, sheet_id: uuid.UUID, filter_data: FilterSchema, page: int = 1, page_size: int = 1000):
     logger.info("Applying filters to sheet with id {}".format(sheet_id))
     sheet_response = SheetDataResponseObject()
     user_id = get_user_id(request, sheet_response)
     if isinstance(user_id, JsonResponse):
         return user_id
-    sheet_data = SheetUploadData.objects.get(id=sheet_id)
+    sheet_data = await aget_sheet(sheet_id)
     if not sheet_data:
         logger.error("No sheet found with id {}".format(sheet_id))
         sheet_response.status = StatusEnum.FAILURE
@@ -353,7 +637,41 @@ def apply_sheet_filters(request, sheet_id: uuid.UUID, filter_data: FilterSchema,
         return JsonResponse(sheet_response.dict(), status=404, safe=False)
     logger.info("Retrieved sheet data from the database")
 
-    match_conditions = generate_match_query(filter_data)
+    etag = sheet_etag(sheet_data, request, filter_data.model_dump_json())
+    not_modified = not_modified_response(request, etag, sheet_data.last_modified)
+    if not_modified:
+        logger.info("Sheet with id {} not modified since revision {}".format(sheet_id, sheet_data.revision))
+        return not_modified
+
+    sql_ref = str(sheet_data.unique_reference)
+    column_data = await aget_column_data(sql_ref)
+    if column_data is None:
+        logger.error("No sheet meta data found for sheet with id {}".format(sheet_id))
+        sheet_response.status = StatusEnum.FAILURE
+        sheet_response.messages.append("No sheet meta data found for sheet with id {}".format(sheet_id))
+        return JsonResponse(sheet_response.dict(), status=404, safe=False)
+    try:
+        match_conditions = generate_match_query(filter_data, column_data)
+        sort_conditions = sorting_query(filter_data, column_data)
+    except ColumnOperationError as e:
+        logger.error("Invalid filters for sheet with id {}: {}".format(sheet_id, e))
+        sheet_response.status = StatusEnum.FAILURE
+        sheet_response.messages.append(str(e))
+        return JsonResponse(sheet_response.dict(), status=404, safe=False)
+    skip = (page - 1) * page_size
+
+    if not match_conditions and len(filter_data.sort_by_column) == 1:
+        sort_column = column_key(find_column(column_data, filter_data.sort_by_column[0]))
+        combined_data = await aread_sorted_page(sql_ref, sort_column, filter_data.sort_order[0], skip, page_size)
+        if combined_data:
+            logger.info("Served sorted page of column {} from the sort index".format(sort_column))
+            sheet_response.data = combined_data
+            sheet_response.status = StatusEnum.SUCCESS
+            return set_validators(JsonResponse(sheet_response.dict(), status=200, safe=False), etag,
+                                  sheet_data.last_modified)
+        if combined_data is None and await sync_to_async(request_sort_index_build)(sql_ref, sort_column):
+            logger.info("Queued sort index build of column {} for sheet with id {}".format(sort_column, sheet_id))
+            await sync_to_async(build_column_sort_index.s(sql_ref, sort_column).set(queue='tasks').apply_async)()
 
     pipeline = [
         {"$match": {"sql_ref": f"{sheet_data.unique_reference}"}},
@@ -363,18 +681,15 @@ def apply_sheet_filters(request, sheet_id: uuid.UUID, filter_data: FilterSchema,
         pipeline.append({"$match": match_conditions})
         logger.info(
             "Generated match conditions for the filters and sorting parameters for sheet with id {}".format(sheet_id))
-    if len(filter_data.sort_by_column) > 0:
-        sort_conditions = sorting_query(filter_data)
+    if sort_conditions:
         pipeline.append({"$sort": sort_conditions})
         logger.info(
             "Generated sort conditions for the filters and sorting parameters for sheet with id {}".format(sheet_id))
-    skip = (page - 1) * page_size
     pipeline.append({"$skip": skip})
     pipeline.append({"$limit": page_size})
     pipeline.append({"$replaceRoot": {"newRoot": "$data"}})
 
-    results = MongoDbClient.objects.aggregate(pipeline)
-    combined_data = list(results)
+    combined_data = await get_async_collection(MongoDbClient).aggregate(pipeline, allowDiskUse=True).to_list(None)
     logger.info("Retrieved data of length {} from the database".format(len(combined_data)))
     if not combined_data:
         logger.error("No sheet found with id {}".format(sheet_id))
@@ -385,47 +700,215 @@ def apply_sheet_filters(request, sheet_id: uuid.UUID, filter_data: FilterSchema,
     sheet_response.data = combined_data
     sheet_response.status = StatusEnum.SUCCESS
 
-    return JsonResponse(sheet_response.dict(), status=200, safe=False)
+    return set_validators(JsonResponse(sheet_response.dict(), status=200, safe=False), etag, sheet_data.last_modified)
+
+
+@api.post("/sheet/{sheet_id}/aggregate", response=AggregationResponseObject, tags=["Study Data"])
+def aggregate_sheet_data(request, sheet_id: uuid.UUID, payload: AggregationRequestSchema):
+    logger.info("Aggregating data for sheet with id {}".format(sheet_id))
+    aggregation_response = AggregationResponseObject()
+    user_id = get_user_id(request, aggregation_response)
+    if isinstance(user_id, JsonResponse):
+        return user_id
+    sheet_data = SheetUploadData.objects.filter(id=sheet_id).first()
+    if not sheet_data:
+        logger.error("No sheet found with id {}".format(sheet_id))
+        aggregation_response.status = StatusEnum.FAILURE
+        aggregation_response.messages.append("No sheet found with id {}".format(sheet_id))
+        return JsonResponse(aggregation_response.dict(), status=404, safe=False)
+
+    if any(measure.function == "percentile" for measure in payload.measures) and not supports_percentile():
+        logger.error("Percentile requested for sheet with id {} on MongoDB {}.{}".format(sheet_id, *server_version()))
+        aggregation_response.status = StatusEnum.FAILURE
+        aggregation_response.messages.append("Percentile measures need MongoDB {}.{} or later".format(
+            *PERCENTILE_MIN_SERVER_VERSION))
+        return JsonResponse(aggregation_response.dict(), status=400, safe=False)
 
+    cache_key = aggregation_cache_key(sheet_data, payload)
+    cached_result = cache.get(cache_key)
+    if cached_result:
+        logger.info("Serving aggregation for sheet with id {} from cache".format(sheet_id))
+        aggregation_response.data = AggregationResultSchema.model_validate(cached_result)
+        aggregation_response.data.cached = True
+        aggregation_response.status = StatusEnum.SUCCESS
+        return JsonResponse(aggregation_response.dict(), status=200, safe=False)
 
-def generate_match_query(filter_data):
-    operators_map = {
-        "equals": "$eq",
-        "not equals": "$ne",
-        "greater than": "$gt",
-        "less than": "$lt",
-        "greater than equals": "$gte",
-        "less than equals": "$lte",
-    }
+    meta_data = SheetMetaData.objects(sql_ref=str(sheet_data.unique_reference)).first()
+    if not meta_data:
+        logger.error("No sheet meta data found for sheet with id {}".format(sheet_id))
+        aggregation_response.status = StatusEnum.FAILURE
+        aggregation_response.messages.append("No sheet meta data found for sheet with id {}".format(sheet_id))
+        return JsonResponse(aggregation_response.dict(), status=404, safe=False)
+    requested_columns = payload.group_by + [measure.column for measure in payload.measures if measure.column]
+    columns = {column: find_column(meta_data.column_data, column) for column in requested_columns}
+    unknown_columns = [column for column, column_data in columns.items() if column_data is None]
+    if unknown_columns:
+        logger.error("Unknown columns {} in aggregation for sheet with id {}".format(unknown_columns, sheet_id))
+        aggregation_response.status = StatusEnum.FAILURE
+        aggregation_response.messages.append("Unknown columns: {}".format(", ".join(unknown_columns)))
+        return JsonResponse(aggregation_response.dict(), status=404, safe=False)
 
-    match_conditions = {}
-    for column, value, method in zip(filter_data.filter_column, filter_data.value, filter_data.filter_method):
-        operator = operators_map.get(method.lower())
-        if operator:
-            try:
-                value = int(value)
-            except ValueError:
-                try:
-                    value = float(value)
-                except ValueError:
-                    value = value
+    try:
+        pipeline, measure_names = generate_aggregation_pipeline(sheet_data, payload, columns, meta_data.column_data)
+    except ColumnOperationError as e:
+        logger.error("Invalid filters in aggregation for sheet with id {}: {}".format(sheet_id, e))
+        aggregation_response.status = StatusEnum.FAILURE
+        aggregation_response.messages.append(str(e))
+        return JsonResponse(aggregation_response.dict(), status=404, safe=False)
+    try:
+        results = list(MongoDbClient.objects.aggregate(pipeline, allowDiskUse=True,
+                                                       maxTimeMS=settings.AGGREGATION_MAX_TIME_MS))
+    except ExecutionTimeout:
+        logger.error("Aggregation timed out for sheet with id {}".format(sheet_id))
+        aggregation_response.status = StatusEnum.FAILURE
+        aggregation_response.messages.append(
+            "Aggregation exceeded the time budget of {} ms".format(settings.AGGREGATION_MAX_TIME_MS))
+        return JsonResponse(aggregation_response.dict(), status=504, safe=False)
+    logger.info("Retrieved {} groups from the database for sheet with id {}".format(len(results), sheet_id))
 
-            condition = {operator: value}
-            match_conditions[f"data.{column}"] = condition
+    rows = []
+    for result in results:
+        group_key = result.get('_id') or {}
+        row = {column: group_key.get("g{}".format(index)) for index, column in enumerate(payload.group_by)}
+        for index, name in enumerate(measure_names):
+            value = result.get("m{}".format(index))
+            if isinstance(value, list):
+                value = value[0] if value else None
+            row[name] = value
+        rows.append(row)
 
-    return match_conditions
+    aggregation_result = AggregationResultSchema(group_by=payload.group_by, measures=measure_names, rows=rows,
+                                                 revision=sheet_data.revision)
+    cache.set(cache_key, aggregation_result.model_dump(), settings.AGGREGATION_CACHE_TIMEOUT)
+    aggregation_response.data = aggregation_result
+    aggregation_response.status = StatusEnum.SUCCESS
+    return JsonResponse(aggregation_response.dict(), status=200, safe=False)
 
 
-def sorting_query(filter_schema):
-    sort_conditions = {}
-    for column, order in zip(filter_schema.sort_by_column, filter_schema.sort_order):
-        sort_conditions[f"data.{column}"] = order
+def aggregation_cache_key(sheet_data, payload):
+    digest = hashlib.sha256(json.dumps(payload.model_dump(), sort_keys=True, default=str).encode()).hexdigest()
+    return "aggregate:{}:{}:{}".format(sheet_data.unique_reference, sheet_data.revision, digest)
 
-    return sort_conditions
+
+def numeric_expression(field):
+    return {"$convert": {"input": field, "to": "double", "onError": None, "onNull": None}}
+
+
+def generate_aggregation_pipeline(sheet_data, payload, columns, column_data):
+    """columns maps the column identifiers of the payload to their column data; rows are grouped and measured on
+    the columns' keys and labelled with the identifiers as requested. column_data is the sheet's column data the
+    filters are resolved against."""
+    fields = {column: "$data.{}".format(column_key(column_data)) for column, column_data in columns.items()}
+    group_stage = {"_id": {"g{}".format(index): fields[column]
+                           for index, column in enumerate(payload.group_by)} or None}
+    measure_names = []
+    for index, measure in enumerate(payload.measures):
+        column = measure.column
+        field = fields.get(column)
+        numeric = column is not None and columns[column].data_type in ["integer", "float"]
+        if measure.function == "count" and not column:
+            accumulator = {"$sum": 1}
+        elif measure.function == "count":
+            accumulator = {"$sum": {"$cond": [{"$in": [{"$ifNull": [field, None]}, [None, ""]]}, 0, 1]}}
+        elif measure.function == "sum":
+            accumulator = {"$sum": numeric_expression(field)}
+        elif measure.function == "mean":
+            accumulator = {"$avg": numeric_expression(field)}
+        elif measure.function in ["min", "max"]:
+            value = numeric_expression(field) if numeric else field
+            accumulator = {"${}".format(measure.function): value}
+        else:
+            accumulator = {"$percentile": {"input": numeric_expression(field), "p": [measure.percentile / 100],
+                                           "method": "approximate"}}
+        group_stage["m{}".format(index)] = accumulator
+
+        if measure.alias:
+            measure_names.append(measure.alias)
+        elif measure.function == "percentile":
+            measure_names.append("p{:g}({})".format(measure.percentile, column))
+        elif column:
+            measure_names.append("{}({})".format(measure.function, column))
+        else:
+            measure_names.append(measure.function)
+
+    pipeline = [
+        {"$match": {"sql_ref": f"{sheet_data.unique_reference}"}},
+        {"$unwind": "$data"},
+    ]
+    if payload.filter_data:
+        match_conditions = generate_match_query(payload.filter_data, column_data)
+        if match_conditions:
+            pipeline.append({"$match": match_conditions})
+    pipeline.append({"$group": group_stage})
+    pipeline.append({"$sort": {"_id": 1}})
+    pipeline.append({"$limit": settings.AGGREGATION_MAX_GROUPS})
+    return pipeline, measure_names
+
+
+@api.get("/sheet/{sheet_id}/columns/{column}/distinct", response=DistinctValuesResponseObject, tags=["Study Data"])
+def get_distinct_values(request, sheet_id: uuid.UUID, column: str, prefix: str = None, top_k: int = 20):
+    logger.info("Fetching distinct values of column {} for sheet with id {}".format(column, sheet_id))
+    distinct_response = DistinctValuesResponseObject()
+    user_id = get_user_id(request, distinct_response)
+    if isinstance(user_id, JsonResponse):
+        return user_id
+    sheet_data = SheetUploadData.objects.filter(id=sheet_id).first()
+    if not sheet_data:
+        logger.error("No sheet found with id {}".format(sheet_id))
+        distinct_response.status = StatusEnum.FAILURE
+        distinct_response.messages.append("No sheet found with id {}".format(sheet_id))
+        return JsonResponse(distinct_response.dict(), status=404, safe=False)
+
+    sql_ref = str(sheet_data.unique_reference)
+    meta_data = SheetMetaData.objects(sql_ref=sql_ref).first()
+    column_data = find_column(meta_data.column_data, column) if meta_data else None
+    if column_data is None:
+        logger.error("No column {} found in sheet with id {}".format(column, sheet_id))
+        distinct_response.status = StatusEnum.FAILURE
+        distinct_response.messages.append("No column {} found in sheet".format(column))
+        return JsonResponse(distinct_response.dict(), status=404, safe=False)
+    key = column_key(column_data)
+    distinct_values = DistinctValuesSchema(column=column)
+    column_dictionary = get_column_dictionary(sql_ref, key)
+    if column_dictionary:
+        logger.info("Serving distinct values of column {} from the column dictionary".format(column))
+        values = column_dictionary.values
+        if prefix:
+            values = [value for value in values if value.value.lower().startswith(prefix.lower())]
+        values = sorted(values, key=lambda value: value.count, reverse=True)[:top_k]
+        distinct_values.values = [DistinctValueSchema(value=value.value, count=value.count) for value in values]
+        distinct_values.from_dictionary = True
+    else:
+        logger.info("No column dictionary for column {}, aggregating distinct values".format(column))
+        pipeline = [
+            {"$match": {"sql_ref": sql_ref}},
+            {"$unwind": "$data"},
+        ]
+        if prefix:
+            pipeline.append({"$match": {"data.{}".format(key): {"$regex": "^" + re.escape(prefix), "$options": "i"}}})
+        pipeline.append({"$group": {"_id": "$data.{}".format(key), "count": {"$sum": 1}}})
+        pipeline.append({"$sort": {"count": -1}})
+        pipeline.append({"$limit": top_k})
+        try:
+            results = list(MongoDbClient.objects.aggregate(pipeline, allowDiskUse=True,
+                                                           maxTimeMS=settings.AGGREGATION_MAX_TIME_MS))
+        except ExecutionTimeout:
+            logger.error("Distinct values aggregation timed out for sheet with id {}".format(sheet_id))
+            distinct_response.status = StatusEnum.FAILURE
+            distinct_response.messages.append(
+                "Distinct values exceeded the time budget of {} ms".format(settings.AGGREGATION_MAX_TIME_MS))
+            return JsonResponse(distinct_response.dict(), status=504, safe=False)
+        distinct_values.values = [DistinctValueSchema(value=result["_id"], count=result["count"])
+                                  for result in results]
+
+    distinct_response.data = distinct_values
+    distinct_response.status = StatusEnum.SUCCESS
+    return JsonResponse(distinct_response.dict(), status=200, safe=False)
 
 
 @api.post("/sheet/{sheet_id}/update", response=SheetDataResponseObject, tags=["Study Data"])
-def update_sheet_data_api(request, sheet_id: uuid.UUID, payload: list[SheetUpdateRequestSchema]):
+def update_sheet_data_api(request, sheet_id: uuid.UUID, payload: list[SheetUpdateRequestSchema],
+                          base_revision: int = None):
     logger.info("Updating sheet with id {}".format(sheet_id))
     sheet_response = SheetDataResponseObject()
     user_id = get_user_id(request, sheet_response)
@@ -439,69 +922,422 @@ def update_sheet_data_api(request, sheet_id: uuid.UUID, payload: list[SheetUpdat
         return JsonResponse(sheet_response.dict(), status=404, safe=False)
 
     logger.info("Retrieved sheet data from the database")
+    sql_ref = str(sheet_data.unique_reference)
+    meta_data = SheetMetaData.objects(sql_ref=sql_ref).first()
+    if not meta_data:
+        logger.error("No sheet meta data found for sheet with id {}".format(sheet_id))
+        sheet_response.status = StatusEnum.FAILURE
+        sheet_response.messages.append("No sheet meta data found for sheet with id {}".format(sheet_id))
+        return JsonResponse(sheet_response.dict(), status=404, safe=False)
+    if base_revision is not None and (base_revision < meta_data.compacted_revision or
+                                      base_revision > sheet_data.revision):
+        logger.error("Base revision {} of sheet {} cannot be checked for conflicts".format(base_revision, sheet_id))
+        sheet_response.status = StatusEnum.FAILURE
+        sheet_response.messages.append("Base revision {} is not available, reload the sheet and retry".format(
+            base_revision))
+        return JsonResponse(sheet_response.dict(), status=409, safe=False)
+    edited_sct_ids = set()
+    edited_columns = set()
+    formula_columns = []
+    edits = {}
+    pending = new_pending_edit()
+    columns_changed = False
+    error_status = None
     try:
         for update_sheet_data in payload:
-            column_name = update_sheet_data.name
-            meta_data = SheetMetaData.objects.get(sql_ref=sheet_data.unique_reference)
+            existing_column = None if update_sheet_data.newcolumn else \
+                find_column(meta_data.column_data, update_sheet_data.name)
+            if existing_column is not None:
+                column_key_name = column_key(existing_column)
+            elif update_sheet_data.newcolumn:
+                column_key_name = new_column_key(meta_data.column_data, update_sheet_data.name)
+            else:
+                raise ColumnOperationError("Unknown column {}".format(update_sheet_data.name))
+            references = []
+            formula_string = update_sheet_data.formula_string
+            if update_sheet_data.input_type == "FOR":
+                references = sorted(compile_formula(formula_string, meta_data.column_data,
+                                                    column_key_name).references)
+                check_dependencies(meta_data.column_data, column_key_name, references)
+                formula_string = canonical_formula(formula_string, meta_data.column_data, column_key_name)
             if update_sheet_data.newcolumn:
-                logger.info("Error sheet")
-                index = int(update_sheet_data.column_index)
                 protected = False
                 if update_sheet_data.input_type == "FOR":
                     protected = True
                 new_column_data = ColumnData(
-                    name=column_name,
-                    column_index=index,
+                    name=update_sheet_data.name,
                     input_type=update_sheet_data.input_type,
-                    formula_string=update_sheet_data.formula_string,
+                    formula_string=formula_string,
                     protected=protected,
                     data_type=update_sheet_data.data_type,
-                    alphabet=chr(ord('A')+index)
+                    depends_on=references
                 )
-                # logger.info("Index" + index)
-
-                updated_column_data = []
-                for data in meta_data.column_data:
-                    if data.column_index >= index:
-                        data.column_index += 1
-                        data.alphabet = chr(ord(data.alphabet) + 1)
-                    updated_column_data.append(data)
-                updated_column_data.append(new_column_data)
-                meta_data.column_data = updated_column_data
-                logger.info(updated_column_data)
-                meta_data.save()
-            # else:
-            #     column_data = column_data_list[0]
+                index = int(update_sheet_data.column_index)
+                meta_data = update_column_metadata(sql_ref, lambda fresh: insert_column(fresh, new_column_data, index))
+                columns_changed = True
+                column_key_name = new_column_data.key
 
             if update_sheet_data.input_type == "FOR":
+                if not update_sheet_data.newcolumn:
+                    SheetMetaData._get_collection().update_one(
+                        {"sql_ref": sql_ref, "column_data": {"$elemMatch": column_match(column_key_name)}},
+                        {"$set": {"column_data.$.formula_string": formula_string,
+                                  "column_data.$.depends_on": references}, "$inc": {"version": 1}})
+                    existing_column.formula_string = formula_string
+                    existing_column.depends_on = references
+                    columns_changed = True
+                formula_columns.append(column_key_name)
                 continue
             else:
-                update_operations = []
-                for updated_data in update_sheet_data.updated_data:
-                    sct_id = updated_data.sct_id
-                    value = updated_data.value
-                    filters = {
-                        "sql_ref": f"{sheet_data.unique_reference}",
-                        "data.sct_id": sct_id
-                    }
-                    update = {"$set": {"data.$.{}".format(column_name): value}}
-
-                    update_operations.append(pymongo.UpdateOne(filters, update))
-
-                logger.info(update_operations)
-                if update_operations:
-                    MongoDbClient._get_collection().bulk_write(update_operations, ordered=False)
+                values = {data.sct_id: data.value for data in update_sheet_data.updated_data}
+                if values:
+                    edits.setdefault(column_key_name, {}).update(values)
+        if edits:
+            edited_sct_ids = write_row_edits(sheet_data, meta_data, edits, user_id, pending,
+                                             base_revision=base_revision)
+            edited_columns.update(edits)
+        edited_columns.update(recompute_edited_formulas(sql_ref, meta_data, edited_sct_ids, edited_columns))
+    except EditConflictError as e:
+        logger.error("Conflicting edits for sheet {} since revision {}: {}".format(sheet_id, base_revision, e))
+        sheet_response.status = StatusEnum.FAILURE
+        sheet_response.messages.append("{} since revision {}, reload the sheet and retry".format(e, base_revision))
+        sheet_response.messages.extend("Cell {} of row {} was changed by {} in revision {}".format(
+            conflict["column"], conflict["sct_id"], conflict.get("user_id"), conflict.get("revision") or "pending")
+            for conflict in e.conflicts)
+        error_status = 409
+    except FormulaError as e:
+        logger.error("Invalid formula for sheet {}: {}".format(sheet_id, e))
+        sheet_response.status = StatusEnum.FAILURE
+        sheet_response.messages.append("Invalid formula: {}".format(e))
+        error_status = 400
+    except ColumnConflictError as e:
+        logger.error("Concurrent column update for sheet {}: {}".format(sheet_id, e))
+        sheet_response.status = StatusEnum.FAILURE
+        sheet_response.messages.append(str(e))
+        error_status = 409
+    except ColumnOperationError as e:
+        logger.error("Invalid column update for sheet {}: {}".format(sheet_id, e))
+        sheet_response.status = StatusEnum.FAILURE
+        sheet_response.messages.append(str(e))
+        error_status = 400
     except Exception as e:
         logger.error("Error updating sheet data: {}".format(e))
         sheet_response.status = StatusEnum.FAILURE
         sheet_response.messages.append("Error updating sheet data: {}".format(e))
-        return JsonResponse(sheet_response.dict(), status=500, safe=False)
-    logger.info("Sheet data updated successfully")
+        error_status = 500
+    if error_status:
+        if edited_sct_ids:
+            # The cells are written; only the formula recomputation failed, so the edit is kept on record.
+            publish_edits(sheet_data, pending)
+        else:
+            discard_edits(sql_ref, pending)
+            if columns_changed:
+                # Columns changed before the failure stay changed, so cached metadata must still be invalidated.
+                sheet_data.bump_revision()
+        return JsonResponse(sheet_response.dict(), status=error_status, safe=False)
+    revision = publish_edits(sheet_data, pending)
+    for column in formula_columns:
+        compute_formula_column.s(sql_ref, column).apply_async()
+    schedule_edit_followups(sheet_data, meta_data, edited_sct_ids, edited_columns)
+    logger.info("Sheet data updated successfully as revision {}".format(revision))
+    sheet_response.data = SheetDataSchema(data=[], revision=revision)
     sheet_response.status = StatusEnum.SUCCESS
     sheet_response.messages.append("Sheet data updated successfully")
     return JsonResponse(sheet_response.dict(), status=200, safe=False)
 
 
+def update_columns(request, sheet_id, operation, description):
+    logger.info("{} for sheet with id {}".format(description, sheet_id))
+    meta_data_response = SheetMetadataResponseObject()
+    user_id = get_user_id(request, meta_data_response)
+    if isinstance(user_id, JsonResponse):
+        return user_id
+    sheet_data = SheetUploadData.objects.filter(id=sheet_id).first()
+    if not sheet_data:
+        logger.error("No sheet found with id {}".format(sheet_id))
+        meta_data_response.status = StatusEnum.FAILURE
+        meta_data_response.messages.append("No sheet found with id {}".format(sheet_id))
+        return JsonResponse(meta_data_response.dict(), status=404, safe=False)
+    sql_ref = str(sheet_data.unique_reference)
+    if not SheetMetaData.objects(sql_ref=sql_ref).only('id').first():
+        logger.error("No sheet meta data found for sheet with id {}".format(sheet_id))
+        meta_data_response.status = StatusEnum.FAILURE
+        meta_data_response.messages.append("No sheet meta data found for sheet with id {}".format(sheet_id))
+        return JsonResponse(meta_data_response.dict(), status=404, safe=False)
+    try:
+        meta_data = update_column_metadata(sql_ref, operation)
+    except ColumnOperationError as e:
+        logger.error("{} failed for sheet with id {}: {}".format(description, sheet_id, e))
+        meta_data_response.status = StatusEnum.FAILURE
+        meta_data_response.messages.append(str(e))
+        return JsonResponse(meta_data_response.dict(), status=409 if isinstance(e, ColumnConflictError) else 400,
+                            safe=False)
+    sheet_data.bump_revision()
+    meta_data_response.data = SheetMetadataSchema(
+        sql_ref=sheet_data.unique_reference,
+        column_data=[ColumnDataSchema.model_validate(column).model_copy(update={"key": column_key(column)})
+                     for column in live_columns(meta_data.column_data)],
+        sheet_data=SheetUploadDataSchema.model_validate(sheet_data))
+    meta_data_response.status = StatusEnum.SUCCESS
+    return JsonResponse(meta_data_response.dict(), status=200, safe=False)
+
+
+@api.put("/sheet/{sheet_id}/columns/order", response=SheetMetadataResponseObject, tags=["Study Data"])
+def reorder_sheet_columns(request, sheet_id: uuid.UUID, payload: ColumnOrderRequestSchema):
+    return update_columns(request, sheet_id, lambda meta_data: reorder_columns(meta_data, payload.columns),
+                          "Reordering columns")
+
+
+@api.patch("/sheet/{sheet_id}/columns/{column}", response=SheetMetadataResponseObject, tags=["Study Data"])
+def rename_sheet_column(request, sheet_id: uuid.UUID, column: str, payload: ColumnRenameRequestSchema):
+    return update_columns(request, sheet_id, lambda meta_data: rename_column(meta_data, column, payload.name),
+                          "Renaming column {} to {}".format(column, payload.name))
+
+
+@api.delete("/sheet/{sheet_id}/columns/{column}", response=SheetMetadataResponseObject, tags=["Study Data"])
+def delete_sheet_column(request, sheet_id: uuid.UUID, column: str):
+    def tombstone(meta_data):
+        target = find_column(meta_data.column_data, column)
+        key = column_key(target) if target else column
+        dependents = [name for name, references in dependency_graph(meta_data.column_data).items()
+                      if key in references and name != key]
+        delete_column(meta_data, column, dependents)
+
+    response = update_columns(request, sheet_id, tombstone, "Deleting column {}".format(column))
+    if response.status_code == 200:
+        sheet_data = SheetUploadData.objects.get(id=sheet_id)
+        compact_deleted_columns.s(str(sheet_data.unique_reference)).apply_async()
+    return response
+
+
+def replay_revision(request, sheet_id, undo):
+    action = EditActionEnum.UNDO if undo else EditActionEnum.REDO
+    logger.info("{} of last edit requested for sheet with id {}".format(action.value, sheet_id))
+    sheet_response = SheetDataResponseObject()
+    user_id = get_user_id(request, sheet_response)
+    if isinstance(user_id, JsonResponse):
+        return user_id
+    sheet_data = SheetUploadData.objects.filter(id=sheet_id).first()
+    if not sheet_data:
+        logger.error("No sheet found with id {}".format(sheet_id))
+        sheet_response.status = StatusEnum.FAILURE
+        sheet_response.messages.append("No sheet found with id {}".format(sheet_id))
+        return JsonResponse(sheet_response.dict(), status=404, safe=False)
+    sql_ref = str(sheet_data.unique_reference)
+    undoable, redoable = edit_stacks(sql_ref)
+    stack = undoable if undo else redoable
+    if not stack:
+        sheet_response.status = StatusEnum.FAILURE
+        sheet_response.messages.append("Nothing to {}".format(action.value.lower()))
+        return JsonResponse(sheet_response.dict(), status=409, safe=False)
+
+    target_revision = stack[-1]
+    pending = new_pending_edit()
+    edited_sct_ids = set()
+    edited_columns = set()
+    written = False
+    try:
+        meta_data = SheetMetaData.objects.get(sql_ref=sql_ref)
+        for column, values in revision_edits(sql_ref, target_revision, undo).items():
+            edited_sct_ids.update(values)
+            edited_columns.add(column)
+            write_cell_edits(sheet_data, meta_data, column, values, user_id, pending, action, target_revision)
+            written = True
+        edited_columns.update(recompute_edited_formulas(sql_ref, meta_data, edited_sct_ids, edited_columns))
+    except Exception as e:
+        logger.error("Error during {} for sheet {}: {}".format(action.value, sheet_id, e))
+        # Columns already written stay on record; an edit that wrote nothing leaves no revision behind.
+        if written:
+            publish_edits(sheet_data, pending)
+        else:
+            discard_edits(sql_ref, pending)
+        sheet_response.status = StatusEnum.FAILURE
+        sheet_response.messages.append("Error during {}: {}".format(action.value.lower(), e))
+        return JsonResponse(sheet_response.dict(), status=500, safe=False)
+    revision = publish_edits(sheet_data, pending)
+    schedule_edit_followups(sheet_data, meta_data, edited_sct_ids, edited_columns)
+    sheet_response.status = StatusEnum.SUCCESS
+    sheet_response.messages.append("{} of revision {} applied as revision {}".format(action.value, target_revision,
+                                                                                   revision))
+    return JsonResponse(sheet_response.dict(), status=200, safe=False)
+
+
+@api.post("/sheet/{sheet_id}/undo", response=SheetDataResponseObject, tags=["Study Data"])
+def undo_sheet_edit(request, sheet_id: uuid.UUID):
+    return replay_revision(request, sheet_id, undo=True)
+
+
+@api.post("/sheet/{sheet_id}/redo", response=SheetDataResponseObject, tags=["Study Data"])
+def redo_sheet_edit(request, sheet_id: uuid.UUID):
+    return replay_revision(request, sheet_id, undo=False)
+
+
+@api.get("/sheet/{sheet_id}/history", response=EditJournalResponseObject, tags=["Study Data"])
+def get_sheet_history(request, sheet_id: uuid.UUID, sct_id: str = None, column: str = None, archived: bool = False,
+                      page: int = 1, page_size: int = 100):
+    logger.info("Fetching edit history for sheet with id {}".format(sheet_id))
+    history_response = EditJournalResponseObject()
+    user_id = get_user_id(request, history_response)
+    if isinstance(user_id, JsonResponse):
+        return user_id
+    sheet_data = SheetUploadData.objects.filter(id=sheet_id).first()
+    if not sheet_data:
+        logger.error("No sheet found with id {}".format(sheet_id))
+        history_response.status = StatusEnum.FAILURE
+        history_response.messages.append("No sheet found with id {}".format(sheet_id))
+        return JsonResponse(history_response.dict(), status=404, safe=False)
+    journal = EditJournalArchive if archived else EditJournal
+    entries = journal.objects(sql_ref=str(sheet_data.unique_reference))
+    if sct_id:
+        entries = entries.filter(sct_id=sct_id)
+    if column:
+        entries = entries.filter(column=column)
+    skip = (page - 1) * page_size
+    entries = entries.order_by('-revision', '-id').skip(skip).limit(page_size)
+    history_response.data = [EditJournalSchema.model_validate(entry) for entry in entries]
+    history_response.status = StatusEnum.SUCCESS
+    return JsonResponse(history_response.dict(), status=200, safe=False)
+
+
+@api.post("/sheet/{sheet_id}/bulk_edit", response=BulkEditJobResponseObject, tags=["Study Data"])
+def create_bulk_edit(request, sheet_id: uuid.UUID, patch_file: File[UploadedFile],
+                     payload: Form[BulkEditRequestSchema]):
+    logger.info("Creating bulk edit for sheet with id {}".format(sheet_id))
+    bulk_edit_response = BulkEditJobResponseObject()
+    user_id = get_user_id(request, bulk_edit_response)
+    if isinstance(user_id, JsonResponse):
+        return user_id
+    sheet_data = SheetUploadData.objects.filter(id=sheet_id).first()
+    if not sheet_data:
+        logger.error("No sheet found with id {}".format(sheet_id))
+        bulk_edit_response.status = StatusEnum.FAILURE
+        bulk_edit_response.messages.append("No sheet found with id {}".format(sheet_id))
+        return JsonResponse(bulk_edit_response.dict(), status=404, safe=False)
+    file_name = patch_file.name
+    if os.path.splitext(file_name)[1].lower() not in PATCH_FILE_TYPES:
+        logger.error("Invalid patch file type {}".format(file_name))
+        bulk_edit_response.status = StatusEnum.FAILURE
+        bulk_edit_response.messages.append("Invalid patch file type. Only {} files are supported.".format(
+            ", ".join(PATCH_FILE_TYPES)))
+        return JsonResponse(bulk_edit_response.dict(), status=400, safe=False)
+
+    blob_name = "bulk_edits/{}_{}".format(uuid.uuid4(), file_name)
+    try:
+        blob_service_client = get_blob_service_client()
+        blob_client = blob_service_client.get_blob_client(container=settings.AZURE_STORAGE_CONTAINER_NAME,
+                                                          blob=blob_name)
+        blob_client.upload_blob(patch_file)
+    except AzureError as e:
+        logger.error("AzureError while uploading patch file to Azure Storage: {}".format(e))
+        bulk_edit_response.status = StatusEnum.FAILURE
+        bulk_edit_response.messages.append("AzureError uploading file to Azure Storage: {}".format(e))
+        return JsonResponse(bulk_edit_response.dict(), status=500, safe=False)
+
+    bulk_edit = BulkEditJob.objects.create(
+        sheet=sheet_data,
+        original_file_name=file_name,
+        date_lake_url=blob_client.blob_name,
+        key_column=payload.key_column or "sct_id",
+        created_by_id=user_id
+    )
+    apply_bulk_edit.s(bulk_edit.id).apply_async()
+    bulk_edit_response.data = BulkEditJobSchema.model_validate(bulk_edit)
+    bulk_edit_response.status = StatusEnum.SUCCESS
+    return JsonResponse(bulk_edit_response.dict(), status=202, safe=False)
+
+
+@api.get("/sheet/{sheet_id}/bulk_edit/{bulk_edit_id}", response=BulkEditJobResponseObject, tags=["Study Data"])
+def get_bulk_edit(request, sheet_id: uuid.UUID, bulk_edit_id: uuid.UUID):
+    logger.info("Fetching bulk edit {} of sheet with id {}".format(bulk_edit_id, sheet_id))
+    bulk_edit_response = BulkEditJobResponseObject()
+    user_id = get_user_id(request, bulk_edit_response)
+    if isinstance(user_id, JsonResponse):
+        return user_id
+    bulk_edit = BulkEditJob.objects.filter(id=bulk_edit_id, sheet_id=sheet_id).first()
+    if not bulk_edit:
+        logger.error("No bulk edit found with id {}".format(bulk_edit_id))
+        bulk_edit_response.status = StatusEnum.FAILURE
+        bulk_edit_response.messages.append("No bulk edit found with id {}".format(bulk_edit_id))
+        return JsonResponse(bulk_edit_response.dict(), status=404, safe=False)
+    bulk_edit_response.data = BulkEditJobSchema.model_validate(bulk_edit)
+    bulk_edit_response.status = StatusEnum.SUCCESS
+    return JsonResponse(bulk_edit_response.dict(), status=200, safe=False)
+
+
+@api.get("/sheet/{sheet_id}/bulk_edit/{bulk_edit_id}/errors", tags=["Study Data"])
+def get_bulk_edit_errors(request, sheet_id: uuid.UUID, bulk_edit_id: uuid.UUID):
+    logger.info("Fetching error report of bulk edit {}".format(bulk_edit_id))
+    bulk_edit_response = BulkEditJobResponseObject()
+    user_id = get_user_id(request, bulk_edit_response)
+    if isinstance(user_id, JsonResponse):
+        return user_id
+    bulk_edit = BulkEditJob.objects.filter(id=bulk_edit_id, sheet_id=sheet_id).only('id', 'errors').first()
+    if not bulk_edit:
+        logger.error("No bulk edit found with id {}".format(bulk_edit_id))
+        bulk_edit_response.status = StatusEnum.FAILURE
+        bulk_edit_response.messages.append("No bulk edit found with id {}".format(bulk_edit_id))
+        return JsonResponse(bulk_edit_response.dict(), status=404, safe=False)
+    response = HttpResponse(content_type="text/csv")
+    response["Content-Disposition"] = 'attachment; filename="{}_errors.csv"'.format(bulk_edit_id)
+    writer = csv.DictWriter(response, fieldnames=["line", "key", "column", "message"])
+    writer.writeheader()
+    writer.writerows(bulk_edit.errors)
+    return response
+
+
+@api.get("/sheet/{sheet_id}/sort_index", response=SortIndexListResponseObject, tags=["Study Data"])
+def get_sort_indexes(request, sheet_id: uuid.UUID):
+    logger.info("Fetching sort indexes for sheet with id {}".format(sheet_id))
+    sort_index_response = SortIndexListResponseObject()
+    user_id = get_user_id(request, sort_index_response)
+    if isinstance(user_id, JsonResponse):
+        return user_id
+    sheet_data = SheetUploadData.objects.filter(id=sheet_id).first()
+    if not sheet_data:
+        logger.error("No sheet found with id {}".format(sheet_id))
+        sort_index_response.status = StatusEnum.FAILURE
+        sort_index_response.messages.append("No sheet found with id {}".format(sheet_id))
+        return JsonResponse(sort_index_response.dict(), status=404, safe=False)
+    sort_indexes = SortIndex.objects(sql_ref=str(sheet_data.unique_reference))
+    sort_index_response.status = StatusEnum.SUCCESS
+    sort_index_response.data = [SortIndexSchema.model_validate(sort_index) for sort_index in sort_indexes]
+    return JsonResponse(sort_index_response.dict(), status=200, safe=False)
+
+
+@api.post("/sheet/{sheet_id}/sort_index/{column}", response=SortIndexListResponseObject, tags=["Study Data"])
+def create_sort_index(request, sheet_id: uuid.UUID, column: str):
+    logger.info("Requesting sort index of column {} for sheet with id {}".format(column, sheet_id))
+    sort_index_response = SortIndexListResponseObject()
+    user_id = get_user_id(request, sort_index_response)
+    if isinstance(user_id, JsonResponse):
+        return user_id
+    sheet_data = SheetUploadData.objects.filter(id=sheet_id).first()
+    if not sheet_data:
+        logger.error("No sheet found with id {}".format(sheet_id))
+        sort_index_response.status = StatusEnum.FAILURE
+        sort_index_response.messages.append("No sheet found with id {}".format(sheet_id))
+        return JsonResponse(sort_index_response.dict(), status=404, safe=False)
+    sql_ref = str(sheet_data.unique_reference)
+    meta_data = SheetMetaData.objects(sql_ref=sql_ref).first()
+    target = find_column(meta_data.column_data, column) if meta_data else None
+    updated = target is not None and SheetMetaData._get_collection().update_one(
+        {"sql_ref": sql_ref, "column_data": {"$elemMatch": column_match(column_key(target))}},
+        {"$set": {"column_data.$.sort_indexed": True}, "$inc": {"version": 1}}).matched_count
+    if not updated:
+        logger.error("No column {} found in sheet with id {}".format(column, sheet_id))
+        sort_index_response.status = StatusEnum.FAILURE
+        sort_index_response.messages.append("No column {} found in sheet".format(column))
+        return JsonResponse(sort_index_response.dict(), status=404, safe=False)
+    key = column_key(target)
+    sheet_data.bump_revision()
+    if request_sort_index_build(sql_ref, key):
+        build_column_sort_index.s(sql_ref, key).set(queue='tasks').apply_async()
+    sort_index_response.status = StatusEnum.SUCCESS
+    sort_index_response.data = [SortIndexSchema.model_validate(sort_index) for sort_index in
+                                SortIndex.objects(sql_ref=sql_ref, column=key)]
+    return JsonResponse(sort_index_response.dict(), status=202, safe=False)
+
+
 @api.get("/sheet/{sheet_id}/custom_columns", response=SheetDataResponseObject, tags=["Study Data"])
 def get_custom_columns(request, sheet_id: uuid.UUID):
     logger.info("Fetching custom columns for sheet with id {}".format(sheet_id))
@@ -4,3 +4,6 @@ from django.apps import AppConfig
 class DataUploadConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'data_upload'
+
+    def ready(self):
+        from . import local_cache  # noqa: F401
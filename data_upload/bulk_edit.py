@@ -0,0 +1,60 @@
+import csv
+import json
+import logging
+
+from .models import MongoDbClient
+
+logger = logging.getLogger(__name__)
+
+PATCH_FILE_TYPES = [".csv", ".ndjson", ".jsonl"]
+
+
+class BulkEditError(ValueError):
+    pass
+
+
+def read_patch_rows(path, file_type):
+    """Yields (line number, row) for every row of a CSV or NDJSON patch; malformed NDJSON lines yield None."""
+    with open(path, newline='', encoding='utf-8-sig') as patch_file:
+        if file_type == ".csv":
+            reader = csv.DictReader(patch_file)
+            if not reader.fieldnames:
+                raise BulkEditError("The patch file has no header row")
+            for row in reader:
+                yield reader.line_num, row
+        else:
+            for line_number, line in enumerate(patch_file, start=1):
+                if not line.strip():
+                    continue
+                try:
+                    row = json.loads(line)
+                except ValueError:
+                    row = None
+                yield line_number, row if isinstance(row, dict) else None
+
+
+def natural_key_rows(sql_ref, key, key_values):
+    """Maps each wanted natural key value to the sct_ids of the rows holding it, in one pass over the sheet."""
+    key_values = {str(value) for value in key_values}
+    rows = {}
+    for chunk in MongoDbClient._get_collection().find({"sql_ref": sql_ref},
+                                                      {"_id": 0, "data.sct_id": 1, "data.{}".format(key): 1}):
+        for row in chunk.get("data", []):
+            value = row.get(key)
+            if value is not None and str(value) in key_values:
+                rows.setdefault(str(value), []).append(row["sct_id"])
+    return rows
+
+
+class BulkEditReport:
+    """Per-row errors of a bulk edit; all errors are counted but only the first max_errors are kept."""
+
+    def __init__(self, max_errors):
+        self.max_errors = max_errors
+        self.errors = []
+        self.error_count = 0
+
+    def add(self, line, key, column, message):
+        self.error_count += 1
+        if len(self.errors) < self.max_errors:
+            self.errors.append({"line": line, "key": key, "column": column, "message": message})
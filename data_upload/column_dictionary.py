@@ -0,0 +1,73 @@
+import logging
+from collections import Counter
+
+from django.conf import settings
+
+from .models import ColumnDictionary
+
+logger = logging.getLogger(__name__)
+
+
+def dictionary_value(value):
+    return "" if value is None else str(value)
+
+
+class ColumnDictionaryBuilder:
+    """Counts the values of every column while a sheet is ingested.
+
+    Columns with more than COLUMN_DICTIONARY_MAX_VALUES distinct values stop being counted and are saved as
+    truncated, so the distinct-values endpoint falls back to an aggregation for them.
+    """
+
+    def __init__(self, columns, max_values=None):
+        self.max_values = max_values or settings.COLUMN_DICTIONARY_MAX_VALUES
+        self.counters = {column: Counter() for column in columns}
+        self.truncated = set()
+
+    def add(self, row):
+        for column, counter in self.counters.items():
+            if column in self.truncated:
+                continue
+            counter[dictionary_value(row.get(column))] += 1
+            if len(counter) > self.max_values:
+                self.truncated.add(column)
+                counter.clear()
+
+    def save(self, sql_ref):
+        ColumnDictionary.objects(sql_ref=sql_ref).delete()
+        dictionaries = []
+        for column, counter in self.counters.items():
+            dictionaries.append(ColumnDictionary(
+                sql_ref=sql_ref,
+                column=column,
+                values=[{"value": value, "count": count} for value, count in counter.most_common()],
+                truncated=column in self.truncated
+            ))
+        if dictionaries:
+            ColumnDictionary.objects.insert(dictionaries, load_bulk=False)
+        logger.info("Saved {} column dictionaries for sheet {}".format(len(dictionaries), sql_ref))
+
+
+def update_column_dictionary(sql_ref, column, old_values, new_values):
+    deltas = Counter(dictionary_value(value) for value in new_values)
+    deltas.subtract(dictionary_value(value) for value in old_values)
+    collection = ColumnDictionary._get_collection()
+    for value, delta in deltas.items():
+        if delta == 0:
+            continue
+        result = collection.update_one({"sql_ref": sql_ref, "column": column, "truncated": False,
+                                        "values.value": value},
+                                       {"$inc": {"values.$.count": delta}})
+        if result.matched_count == 0 and delta > 0:
+            collection.update_one({"sql_ref": sql_ref, "column": column, "truncated": False,
+                                   "values.value": {"$ne": value}},
+                                  {"$push": {"values": {"value": value, "count": delta}}})
+    collection.update_one({"sql_ref": sql_ref, "column": column},
+                          {"$pull": {"values": {"count": {"$lte": 0}}}})
+    collection.update_one({"sql_ref": sql_ref, "column": column,
+                           "values.{}".format(settings.COLUMN_DICTIONARY_MAX_VALUES): {"$exists": True}},
+                          {"$set": {"truncated": True, "values": []}})
+
+
+def get_column_dictionary(sql_ref, column):
+    return ColumnDictionary.objects(sql_ref=sql_ref, column=column, truncated=False).first()
@@ -0,0 +1,133 @@
+def column_letter(index):
+    letters = ""
+    index += 1
+    while index > 0:
+        index, remainder = divmod(index - 1, 26)
+        letters = chr(ord('A') + remainder) + letters
+    return letters
+
+
+class ColumnOperationError(ValueError):
+    pass
+
+
+class ColumnConflictError(ColumnOperationError):
+    pass
+
+
+def column_attribute(column, attribute):
+    if isinstance(column, dict):
+        return column.get(attribute)
+    return getattr(column, attribute, None)
+
+
+def column_key(column):
+    """The field a column is stored under in the row documents; it never changes after the column is created."""
+    return column_attribute(column, "key") or column_attribute(column, "name")
+
+
+def column_match(key):
+    """$elemMatch condition for the column_data entry of a key, including columns saved before keys existed."""
+    return {"deleted": {"$ne": True}, "$or": [{"key": key}, {"key": None, "name": key}]}
+
+
+def live_columns(column_data):
+    return sorted((column for column in column_data if not column_attribute(column, "deleted")),
+                  key=lambda column: column_attribute(column, "column_index") or 0)
+
+
+def find_column(column_data, identifier):
+    """Finds a live column by key first and by display name second."""
+    columns = live_columns(column_data)
+    for column in columns:
+        if column_key(column) == identifier:
+            return column
+    for column in columns:
+        if column_attribute(column, "name") == identifier:
+            return column
+    return None
+
+
+def resolve_column_keys(column_data, identifiers):
+    keys = []
+    for identifier in identifiers:
+        column = find_column(column_data, identifier)
+        if column is None:
+            raise ColumnOperationError("Unknown column {}".format(identifier))
+        keys.append(column_key(column))
+    return keys
+
+
+def new_column_key(column_data, name):
+    used_keys = {column_key(column) for column in column_data}
+    key, suffix = name, 1
+    while key in used_keys:
+        suffix += 1
+        key = "{}_{}".format(name, suffix)
+    return key
+
+
+def renumber_columns(columns):
+    for index, column in enumerate(columns):
+        column.column_index = index
+        column.alphabet = column_letter(index)
+
+
+def validate_column_name(column_data, name, column=None):
+    if not name or "." in name or name.startswith("$"):
+        raise ColumnOperationError("Invalid column name {}".format(name))
+    if any(column_attribute(existing, "name") == name for existing in live_columns(column_data)
+           if existing is not column):
+        raise ColumnOperationError("Column {} already exists".format(name))
+
+
+def insert_column(meta_data, column, index):
+    validate_column_name(meta_data.column_data, column.name)
+    column.key = new_column_key(meta_data.column_data, column.name)
+    columns = live_columns(meta_data.column_data)
+    columns.insert(max(1, min(index, len(columns))), column)
+    renumber_columns(columns)
+    meta_data.column_data.append(column)
+    return column
+
+
+def rename_column(meta_data, identifier, name):
+    column = find_column(meta_data.column_data, identifier)
+    if column is None:
+        raise ColumnOperationError("Unknown column {}".format(identifier))
+    if column_key(column) == "sct_id":
+        raise ColumnOperationError("Column sct_id cannot be renamed")
+    validate_column_name(meta_data.column_data, name, column)
+    column.key = column_key(column)
+    column.name = name
+    return column
+
+
+def reorder_columns(meta_data, identifiers):
+    columns = live_columns(meta_data.column_data)
+    ordered = [find_column(columns, identifier) for identifier in identifiers]
+    if None in ordered:
+        raise ColumnOperationError("Unknown columns: {}".format(
+            ", ".join(identifier for identifier, column in zip(identifiers, ordered) if column is None)))
+    row_id_column = [column for column in columns if column_key(column) == "sct_id"]
+    ordered = [column for column in ordered if column_key(column) != "sct_id"]
+    if len({id(column) for column in ordered}) != len(columns) - len(row_id_column):
+        raise ColumnOperationError("The new order must list every column exactly once")
+    renumber_columns(row_id_column + ordered)
+    return row_id_column + ordered
+
+
+def delete_column(meta_data, identifier, dependents):
+    """Tombstones a column; its values stay in the rows until compaction unsets them."""
+    column = find_column(meta_data.column_data, identifier)
+    if column is None:
+        raise ColumnOperationError("Unknown column {}".format(identifier))
+    if column_key(column) == "sct_id":
+        raise ColumnOperationError("Column sct_id cannot be deleted")
+    if dependents:
+        raise ColumnOperationError("Column {} is used by formula columns {}".format(column.name,
+                                                                                  ", ".join(dependents)))
+    column.key = column_key(column)
+    column.deleted = True
+    renumber_columns(live_columns(meta_data.column_data))
+    return column
@@ -0,0 +1,30 @@
+import hashlib
+
+from django.http import HttpResponseNotModified
+from django.utils.http import http_date, parse_http_date_safe
+
+
+def sheet_etag(sheet_data, request, query=""):
+    key = "{}:{}:{}:{}".format(sheet_data.unique_reference, sheet_data.revision, request.get_full_path(), query)
+    return '"{}"'.format(hashlib.sha1(key.encode()).hexdigest())
+
+
+def not_modified_response(request, etag, last_modified):
+    if_none_match = request.headers.get("If-None-Match")
+    if if_none_match:
+        matched = if_none_match.strip() == "*" or etag in [tag.strip().removeprefix("W/") for tag in
+                                                           if_none_match.split(",")]
+    else:
+        if_modified_since = parse_http_date_safe(request.headers.get("If-Modified-Since") or "")
+        matched = bool(if_modified_since and last_modified and int(last_modified.timestamp()) <= if_modified_since)
+    if not matched:
+        return None
+    return set_validators(HttpResponseNotModified(), etag, last_modified)
+
+
+def set_validators(response, etag, last_modified):
+    response["ETag"] = etag
+    if last_modified:
+        response["Last-Modified"] = http_date(last_modified.timestamp())
+    response["Cache-Control"] = "private, no-cache"
+    return response
@@ -0,0 +1,369 @@
+import logging
+import uuid
+from collections import defaultdict
+from datetime import timedelta
+
+import pymongo
+from django.conf import settings
+from django.utils import timezone
+from pymongo.errors import BulkWriteError
+
+from .models import MongoDbClient, RowLocator, SheetMetaData, EditJournal, EditJournalArchive, EditActionEnum, \
+    ColumnDictionary
+from .row_ids import row_position
+from .formulas import recompute_order, compile_formula_columns, formula_update_pipeline
+from .columns import find_column, ColumnConflictError
+from .column_dictionary import get_column_dictionary, update_column_dictionary
+from .search import update_search_documents
+from .mongo import get_async_collection
+
+logger = logging.getLogger(__name__)
+
+
+class EditConflictError(Exception):
+    """Raised when cells of an edit were changed by another revision after the edit's base revision."""
+
+    def __init__(self, conflicts):
+        super().__init__("{} edited cells were changed concurrently".format(len(conflicts)))
+        self.conflicts = conflicts
+
+
+def create_chunk(sql_ref, sheet_metadata, rows, chunk_no=None):
+    chunk = MongoDbClient.objects.create(sql_ref=sql_ref, meta_data=sheet_metadata, data=rows, chunk_no=chunk_no)
+    record_row_locations(sql_ref, chunk.id, rows, chunk_no, sheet_metadata.chunk_size)
+    return chunk
+
+
+def record_row_locations(sql_ref, chunk_id, rows, chunk_no=None, chunk_size=None):
+    """Records a locator for every row whose position cannot be derived from its ordinal row id.
+
+    Rows written densely under ordinal ids need no locator; legacy SCT ids and rows copied into another sheet
+    (saved query views) do.
+    """
+    locators = [{"s": sql_ref, "i": row["sct_id"], "c": chunk_id, "o": offset}
+                for offset, row in enumerate(rows)
+                if row.get("sct_id") and row_position(row["sct_id"], chunk_size) != (chunk_no, offset)]
+    if locators:
+        RowLocator._get_collection().insert_many(locators, ordered=False)
+
+
+def drop_row_locations(sql_ref):
+    RowLocator.objects(sql_ref=sql_ref).delete()
+
+
+def rebuild_row_locations(sql_ref, chunk_size=None):
+    """Re-records the locators of a sheet after rows were removed from or moved between its chunks."""
+    drop_row_locations(sql_ref)
+    chunks = MongoDbClient._get_collection().find({"sql_ref": sql_ref}, {"chunk_no": 1, "data.sct_id": 1})
+    for chunk in chunks:
+        record_row_locations(sql_ref, chunk["_id"], chunk.get("data", []), chunk.get("chunk_no"), chunk_size)
+
+
+def locate_rows(sql_ref, sct_ids, chunk_size=None):
+    """Maps sct_ids to (chunk _id, offset) from recorded locators, then from ordinal row ids."""
+    sct_ids = list(sct_ids)
+    locators = RowLocator._get_collection().find({"s": sql_ref, "i": {"$in": sct_ids}},
+                                                 {"_id": 0, "i": 1, "c": 1, "o": 1})
+    locations = {locator["i"]: (locator["c"], locator["o"]) for locator in locators}
+    positions = {sct_id: row_position(sct_id, chunk_size) for sct_id in sct_ids if sct_id not in locations}
+    positions = {sct_id: position for sct_id, position in positions.items() if position}
+    if positions:
+        chunk_ids = {chunk["chunk_no"]: chunk["_id"] for chunk in MongoDbClient._get_collection().find(
+            {"sql_ref": sql_ref, "chunk_no": {"$in": list({chunk_no for chunk_no, _ in positions.values()})}},
+            {"_id": 1, "chunk_no": 1})}
+        for sct_id, (chunk_no, offset) in positions.items():
+            if chunk_no in chunk_ids:
+                locations[sct_id] = (chunk_ids[chunk_no], offset)
+    return locations
+
+
+def fetch_cell_values(sql_ref, column, sct_ids, chunk_size=None):
+    return {sct_id: row[column] for sct_id, row in fetch_row_values(sql_ref, [column], sct_ids, chunk_size).items()}
+
+
+def fetch_row_values(sql_ref, columns, sct_ids, chunk_size=None):
+    """Reads {sct_id: {column: value}} for the given rows; sct_ids that do not exist are left out."""
+    sct_ids = list(sct_ids)
+    locations = locate_rows(sql_ref, sct_ids, chunk_size)
+    match = {"sql_ref": sql_ref}
+    if len(locations) == len(set(sct_ids)):
+        # Every row is located, so only the chunks holding them need to be unwound.
+        match["_id"] = {"$in": list({chunk_id for chunk_id, _ in locations.values()})}
+    pipeline = [
+        {"$match": match},
+        {"$unwind": "$data"},
+        {"$match": {"data.sct_id": {"$in": sct_ids}}},
+        {"$project": dict({"_id": 0, "sct_id": "$data.sct_id"},
+                          **{"v{}".format(index): "$data.{}".format(column) for index, column in enumerate(columns)})},
+    ]
+    return {result["sct_id"]: {column: result.get("v{}".format(index)) for index, column in enumerate(columns)}
+            for result in MongoDbClient.objects.aggregate(pipeline, allowDiskUse=True)}
+
+
+def positional_updates(sql_ref, column, values):
+    return [pymongo.UpdateOne({"sql_ref": sql_ref, "data.sct_id": sct_id},
+                              {"$set": {"data.$.{}".format(column): value}})
+            for sct_id, value in values.items()]
+
+
+def apply_cell_edits(sql_ref, column, values, chunk_size=None):
+    return apply_row_edits(sql_ref, {column: values}, chunk_size)
+
+
+def apply_row_edits(sql_ref, edits, chunk_size=None):
+    """Writes {column: {sct_id: value}} edits with a single update per chunk, whatever the number of columns.
+
+    Each chunk update also matches the sct_id stored at every addressed offset, so a stale location makes the
+    update miss instead of overwriting another row; the edits are then replayed with positional updates.
+    """
+    collection = MongoDbClient._get_collection()
+    sct_ids = {sct_id for values in edits.values() for sct_id in values}
+    locations = locate_rows(sql_ref, sct_ids, chunk_size)
+    chunk_filters = defaultdict(dict)
+    chunk_updates = defaultdict(dict)
+    for column, values in edits.items():
+        for sct_id, value in values.items():
+            if sct_id in locations:
+                chunk_id, offset = locations[sct_id]
+                chunk_filters[chunk_id]["data.{}.sct_id".format(offset)] = sct_id
+                chunk_updates[chunk_id]["data.{}.{}".format(offset, column)] = value
+    operations = [pymongo.UpdateOne(dict(chunk_filter, _id=chunk_id), {"$set": chunk_updates[chunk_id]})
+                  for chunk_id, chunk_filter in chunk_filters.items()]
+    unlocated = {column: {sct_id: value for sct_id, value in values.items() if sct_id not in locations}
+                 for column, values in edits.items()}
+    if operations:
+        result = collection.bulk_write(operations, ordered=False)
+        if result.matched_count < len(operations):
+            logger.warning("Stale row locators for sheet {}, falling back to positional updates".format(sql_ref))
+            unlocated = edits
+    fallback = [operation for column, values in unlocated.items() if values
+                for operation in positional_updates(sql_ref, column, values)]
+    if fallback:
+        collection.bulk_write(fallback, ordered=False)
+    logger.info("Updated {} cells of columns {} in {} chunks".format(
+        sum(len(values) for values in edits.values()), list(edits), len(operations)))
+    return len(operations)
+
+
+def recompute_formula_rows(sql_ref, column_data, sct_ids, changed_columns, chunk_size=None):
+    """Re-evaluates the formula columns downstream of changed_columns for the edited rows only.
+
+    All affected formulas run as one update pipeline per touched chunk, in dependency order, so the work
+    grows with the number of edited rows rather than with the sheet.
+    """
+    columns = recompute_order(column_data, changed_columns)
+    if not columns or not sct_ids:
+        return []
+    formulas = compile_formula_columns(column_data, columns)
+    locations = locate_rows(sql_ref, sct_ids, chunk_size)
+    chunk_rows = defaultdict(list)
+    for sct_id, (chunk_id, _) in locations.items():
+        chunk_rows[chunk_id].append(sct_id)
+    operations = [pymongo.UpdateOne({"_id": chunk_id}, formula_update_pipeline(formulas, rows))
+                  for chunk_id, rows in chunk_rows.items()]
+    unlocated = [sct_id for sct_id in sct_ids if sct_id not in locations]
+    if unlocated:
+        operations.append(pymongo.UpdateMany({"sql_ref": sql_ref, "data.sct_id": {"$in": unlocated}},
+                                             formula_update_pipeline(formulas, unlocated)))
+    MongoDbClient._get_collection().bulk_write(operations, ordered=False)
+    logger.info("Recomputed formula columns {} for {} rows in {} chunks".format(columns, len(sct_ids),
+                                                                              len(chunk_rows)))
+    return columns
+
+
+def journal_edits(sql_ref, pending, column, old_values, new_values, user_id, action=EditActionEnum.EDIT,
+                  reverts=None):
+    """Journals edits under a pending token; publish_edits stamps them with their revision once they are written."""
+    edit_date_time = timezone.now()
+    entries = [{"sql_ref": sql_ref, "revision": None, "pending": pending, "sct_id": sct_id, "column": column,
+                "old_value": old_values.get(sct_id), "new_value": value, "action": action.value,
+                "reverts": reverts, "user_id": str(user_id), "edit_date_time": edit_date_time}
+               for sct_id, value in new_values.items() if sct_id in old_values]
+    if entries:
+        EditJournal._get_collection().insert_many(entries, ordered=False)
+    return len(entries)
+
+
+def new_pending_edit():
+    return uuid.uuid4().hex
+
+
+def discard_edits(sql_ref, pending):
+    """Drops the journal entries of an edit that was rejected or failed, so it never becomes a revision."""
+    EditJournal._get_collection().delete_many({"sql_ref": sql_ref, "pending": pending})
+
+
+def publish_edits(sheet_data, pending):
+    """Publishes the edits journaled under pending as the sheet's next revision and returns that revision.
+
+    The revision is taken only after the cells are written, so a reader that has seen revision N has seen every
+    edit journaled with a revision up to N.
+    """
+    revision = sheet_data.bump_revision()
+    EditJournal._get_collection().update_many({"sql_ref": str(sheet_data.unique_reference), "pending": pending},
+                                              {"$set": {"revision": revision}, "$unset": {"pending": ""}})
+    return revision
+
+
+def write_cell_edits(sheet_data, meta_data, column, values, user_id, pending, action=EditActionEnum.EDIT,
+                     reverts=None):
+    """Journals {sct_id: value} edits of one column, applies them and keeps its dictionary and search current.
+
+    The journal entries are written before the cells, so a failed edit can leave an entry behind but never an
+    unrecorded change.
+    """
+    return write_row_edits(sheet_data, meta_data, {column: values}, user_id, pending, action, reverts)
+
+
+def pending_cutoff():
+    """Pending entries journaled before this belong to an edit that will never be published or discarded."""
+    return timezone.now() - timedelta(seconds=settings.EDIT_PENDING_TIMEOUT)
+
+
+def conflicting_edits(sql_ref, edits, base_revision, pending):
+    """Journal entries touching the edited cells that were published after base_revision or are still pending.
+
+    Pending entries older than EDIT_PENDING_TIMEOUT are left out, so an edit whose process died between journaling
+    and publishing does not block its cells until the compaction reaps it.
+    """
+    cells = [{"column": column, "sct_id": {"$in": list(values)}} for column, values in edits.items() if values]
+    if not cells:
+        return []
+    return list(EditJournal._get_collection().find(
+        {"sql_ref": sql_ref, "$and": [
+            {"$or": cells},
+            {"$or": [{"revision": {"$gt": base_revision}},
+                     {"pending": {"$exists": True, "$ne": pending}, "edit_date_time": {"$gt": pending_cutoff()}}]},
+        ]},
+        {"_id": 0, "sct_id": 1, "column": 1, "revision": 1, "user_id": 1}
+    ).limit(settings.EDIT_CONFLICT_REPORT_LIMIT))
+
+
+def write_row_edits(sheet_data, meta_data, edits, user_id, pending, action=EditActionEnum.EDIT, reverts=None,
+                    base_revision=None):
+    """write_cell_edits for {column: {sct_id: value}} edits of several columns, applied as one update per chunk.
+
+    With a base_revision the edits are journaled first and then checked against every edit published after
+    base_revision or still pending, so of two racing writers of a cell at least one sees the other and backs out
+    before any cell is written. Returns the edited sct_ids that exist in the sheet.
+    """
+    sql_ref = str(sheet_data.unique_reference)
+    sct_ids = {sct_id for values in edits.values() for sct_id in values}
+    old_rows = fetch_row_values(sql_ref, list(edits), sct_ids, meta_data.chunk_size)
+    # Rows that do not exist would miss their chunk filter and push the whole batch onto positional updates.
+    edits = {column: {sct_id: value for sct_id, value in values.items() if sct_id in old_rows}
+             for column, values in edits.items()}
+    for column, values in edits.items():
+        old_values = {sct_id: row[column] for sct_id, row in old_rows.items() if sct_id in values}
+        journal_edits(sql_ref, pending, column, old_values, values, user_id, action, reverts)
+    if base_revision is not None:
+        conflicts = conflicting_edits(sql_ref, edits, base_revision, pending)
+        if conflicts:
+            discard_edits(sql_ref, pending)
+            raise EditConflictError(conflicts)
+    apply_row_edits(sql_ref, edits, meta_data.chunk_size)
+    for column, values in edits.items():
+        if get_column_dictionary(sql_ref, column):
+            update_column_dictionary(sql_ref, column, [old_rows[sct_id][column] for sct_id in values],
+                                     values.values())
+        column_data = find_column(meta_data.column_data, column)
+        if column_data and column_data.data_type == "string":
+            update_search_documents(sheet_data.study_id, sql_ref, column, values)
+    return set(old_rows)
+
+
+def update_column_metadata(sql_ref, operation):
+    """Applies operation to a fresh copy of the sheet's metadata and stores the columns only if no other writer
+    changed them in between, retrying on a lost race. Returns the updated metadata."""
+    collection = SheetMetaData._get_collection()
+    for _ in range(settings.METADATA_UPDATE_ATTEMPTS):
+        meta_data = SheetMetaData.objects.get(sql_ref=sql_ref)
+        operation(meta_data)
+        version = meta_data.version or 0
+        result = collection.update_one(
+            {"sql_ref": sql_ref, "version": version if version else {"$in": [0, None]}},
+            {"$set": {"column_data": [column.to_mongo() for column in meta_data.column_data]},
+             "$inc": {"version": 1}})
+        if result.matched_count:
+            meta_data.version = version + 1
+            return meta_data
+        logger.info("Columns of sheet {} changed concurrently, retrying".format(sql_ref))
+    raise ColumnConflictError("The columns of the sheet are being changed concurrently, please retry")
+
+
+def recompute_edited_formulas(sql_ref, meta_data, edited_sct_ids, edited_columns):
+    recomputed_columns = recompute_formula_rows(sql_ref, meta_data.column_data, list(edited_sct_ids),
+                                                edited_columns, meta_data.chunk_size)
+    if recomputed_columns:
+        ColumnDictionary.objects(sql_ref=sql_ref, column__in=recomputed_columns).delete()
+    return recomputed_columns
+
+
+def edit_stacks(sql_ref):
+    """Replays the journal's revisions into (undoable, redoable) stacks of revision numbers."""
+    pipeline = [
+        {"$match": {"sql_ref": sql_ref, "revision": {"$ne": None}}},
+        {"$group": {"_id": "$revision", "action": {"$first": "$action"}, "reverts": {"$first": "$reverts"}}},
+        {"$sort": {"_id": 1}},
+    ]
+    undoable, redoable = [], []
+    for group in EditJournal._get_collection().aggregate(pipeline, allowDiskUse=True):
+        if group["action"] == EditActionEnum.UNDO.value:
+            if undoable and undoable[-1] == group["reverts"]:
+                redoable.append(undoable.pop())
+        elif group["action"] == EditActionEnum.REDO.value:
+            if redoable and redoable[-1] == group["reverts"]:
+                undoable.append(redoable.pop())
+        else:
+            undoable.append(group["_id"])
+            redoable.clear()
+    return undoable, redoable
+
+
+def revision_edits(sql_ref, revision, undo):
+    """Returns {column: {sct_id: value}} that reverts (undo) or reapplies a journaled revision."""
+    edits = defaultdict(dict)
+    entries = EditJournal._get_collection().find({"sql_ref": sql_ref, "revision": revision}).sort(
+        "_id", -1 if undo else 1)
+    for entry in entries:
+        edits[entry["column"]][entry["sct_id"]] = entry["old_value"] if undo else entry["new_value"]
+    return edits
+
+
+async def aoverlay_revision(sql_ref, rows, revision):
+    """Rewinds rows read from the current chunks to how they were at revision."""
+    rows_by_id = {row.get("sct_id"): row for row in rows}
+    cursor = get_async_collection(EditJournal).find(
+        {"sql_ref": sql_ref, "sct_id": {"$in": list(rows_by_id)}, "revision": {"$gt": revision}},
+        {"_id": 0, "sct_id": 1, "column": 1, "old_value": 1}).sort([("revision", -1), ("_id", -1)])
+    async for entry in cursor:
+        rows_by_id[entry["sct_id"]][entry["column"]] = entry["old_value"]
+    return rows
+
+
+def reap_abandoned_edits():
+    """Removes pending journal entries past EDIT_PENDING_TIMEOUT; their edits can no longer become a revision."""
+    return EditJournal._get_collection().delete_many(
+        {"pending": {"$exists": True}, "edit_date_time": {"$lt": pending_cutoff()}}).deleted_count
+
+
+def compact_edit_journal(sql_ref, horizon, batch_size):
+    """Moves journal entries up to horizon into the archive; revisions up to it can no longer be pinned."""
+    journal = EditJournal._get_collection()
+    archive = EditJournalArchive._get_collection()
+    query = {"sql_ref": sql_ref, "revision": {"$lte": horizon}}
+    moved = 0
+    while True:
+        batch = list(journal.find(query).sort("_id", 1).limit(batch_size))
+        if not batch:
+            break
+        try:
+            archive.insert_many(batch, ordered=False)
+        except BulkWriteError as e:
+            # Entries archived by an interrupted run are already there.
+            if any(error["code"] != 11000 for error in e.details["writeErrors"]):
+                raise
+        journal.delete_many({"_id": {"$in": [entry["_id"] for entry in batch]}})
+        moved += len(batch)
+    SheetMetaData.objects(sql_ref=sql_ref, compacted_revision__lt=horizon).update(set__compacted_revision=horizon)
+    return moved
@@ -0,0 +1,401 @@
+import re
+
+from .columns import column_letter, column_key, find_column, live_columns
+
+TOKEN_PATTERN = re.compile(r"""
+    \s*(?:
+        (?P<number>\d+(?:\.\d*)?(?:[eE][+-]?\d+)?|\.\d+(?:[eE][+-]?\d+)?)
+        |"(?P<string>(?:[^"]|"")*)"
+        |\[(?P<bracketed>[^\]]+)\]
+        |(?P<identifier>[A-Za-z_][A-Za-z0-9_]*)
+        |(?P<operator><>|<=|>=|[-+*/^&=<>(),])
+    )""", re.VERBOSE)
+
+COMPARISON_OPERATORS = {"=": "$eq", "<>": "$ne", "<": "$lt", ">": "$gt", "<=": "$lte", ">=": "$gte"}
+ADDITIVE_OPERATORS = {"+": "$add", "-": "$subtract"}
+MULTIPLICATIVE_OPERATORS = {"*": "$multiply", "/": "$divide"}
+
+
+class FormulaError(ValueError):
+    pass
+
+
+class Formula:
+    """A formula compiled into a MongoDB expression over one row, bound as $$row."""
+
+    def __init__(self, expression, references, data_type):
+        self.expression = expression
+        self.references = references
+        self.data_type = data_type
+
+
+def tokenize(formula_string):
+    tokens = []
+    position = 0
+    formula_string = formula_string.strip()
+    while position < len(formula_string):
+        match = TOKEN_PATTERN.match(formula_string, position)
+        if not match or match.end() == position:
+            while formula_string[position].isspace():
+                position += 1
+            raise FormulaError("Unexpected character '{}' at position {}".format(formula_string[position], position))
+        kind = match.lastgroup
+        value = match.group(kind)
+        if kind == "string":
+            value = value.replace('""', '"')
+        tokens.append((kind, value))
+        position = match.end()
+    return tokens
+
+
+def number(expression, kind):
+    if kind == "number":
+        return expression
+    return {"$convert": {"input": expression, "to": "double", "onError": None, "onNull": None}}
+
+
+def string(expression, kind):
+    if kind == "string":
+        return expression
+    return {"$ifNull": [{"$toString": expression}, ""]}
+
+
+def divide(numerator, denominator):
+    return {"$let": {
+        "vars": {"denominator": denominator},
+        "in": {"$cond": [{"$in": ["$$denominator", [0, None]]}, None,
+                         {"$divide": [numerator, "$$denominator"]}]}
+    }}
+
+
+def numeric_function(operator):
+    def compile_function(arguments):
+        return {operator: [number(expression, kind) for expression, kind in arguments]}, "number"
+    return compile_function
+
+
+def round_function(arguments):
+    if len(arguments) not in (1, 2):
+        raise FormulaError("ROUND takes one or two arguments")
+    places = number(*arguments[1]) if len(arguments) == 2 else 0
+    return {"$round": [number(*arguments[0]), places]}, "number"
+
+
+def if_function(arguments):
+    if len(arguments) not in (2, 3):
+        raise FormulaError("IF takes two or three arguments")
+    otherwise = arguments[2] if len(arguments) == 3 else (None, "any")
+    kind = arguments[1][1] if arguments[1][1] == otherwise[1] else "any"
+    return {"$cond": [arguments[0][0], arguments[1][0], otherwise[0]]}, kind
+
+
+def single_argument(name, compile_argument):
+    def compile_function(arguments):
+        if len(arguments) != 1:
+            raise FormulaError("{} takes exactly one argument".format(name))
+        return compile_argument(*arguments[0])
+    return compile_function
+
+
+FUNCTIONS = {
+    "SUM": numeric_function("$sum"),
+    "AVERAGE": numeric_function("$avg"),
+    "MIN": numeric_function("$min"),
+    "MAX": numeric_function("$max"),
+    "ROUND": round_function,
+    "IF": if_function,
+    "AND": lambda arguments: ({"$and": [expression for expression, _ in arguments]}, "boolean"),
+    "OR": lambda arguments: ({"$or": [expression for expression, _ in arguments]}, "boolean"),
+    "NOT": single_argument("NOT", lambda expression, kind: ({"$not": [expression]}, "boolean")),
+    "ABS": single_argument("ABS", lambda expression, kind: ({"$abs": number(expression, kind)}, "number")),
+    "CONCAT": lambda arguments: ({"$concat": [string(*argument) for argument in arguments]}, "string"),
+    "UPPER": single_argument("UPPER", lambda expression, kind: ({"$toUpper": string(expression, kind)}, "string")),
+    "LOWER": single_argument("LOWER", lambda expression, kind: ({"$toLower": string(expression, kind)}, "string")),
+    "TRIM": single_argument("TRIM", lambda expression, kind: ({"$trim": {"input": string(expression, kind)}},
+                                                              "string")),
+    "LEN": single_argument("LEN", lambda expression, kind: ({"$strLenCP": string(expression, kind)}, "number")),
+    "ISBLANK": single_argument("ISBLANK", lambda expression, kind: (
+        {"$in": [{"$ifNull": [expression, None]}, [None, ""]]}, "boolean")),
+}
+
+
+class FormulaCompiler:
+    """Recursive descent compiler for spreadsheet-style formulas.
+
+    Columns are referenced by alphabet (A, B, AA), key or name; names that are not plain identifiers are
+    written in brackets, e.g. [Visit Date]. References compile to the column key, so formulas keep working
+    when columns are renamed or moved. Unary minus binds tighter than ^, as it does in spreadsheets.
+    """
+
+    def __init__(self, formula_string, column_data, target=None):
+        formula_string = (formula_string or "").strip()
+        if formula_string.startswith("="):
+            formula_string = formula_string[1:]
+        if not formula_string:
+            raise FormulaError("Formula is empty")
+        self.tokens = tokenize(formula_string)
+        self.position = 0
+        self.target = target
+        self.columns = live_columns(column_data)
+        self.alphabets = {(column.alphabet or column_letter(column.column_index)): column_key(column)
+                          for column in self.columns}
+        self.references = set()
+
+    def compile(self):
+        expression, kind = self.comparison()
+        if self.position < len(self.tokens):
+            raise FormulaError("Unexpected '{}' in formula".format(self.tokens[self.position][1]))
+        return Formula(expression, self.references, {"number": "float", "string": "string",
+                                                     "boolean": "boolean"}.get(kind))
+
+    def peek(self):
+        return self.tokens[self.position] if self.position < len(self.tokens) else (None, None)
+
+    def accept(self, *operators):
+        kind, value = self.peek()
+        if kind == "operator" and value in operators:
+            self.position += 1
+            return value
+        return None
+
+    def expect(self, operator):
+        if not self.accept(operator):
+            raise FormulaError("Expected '{}' in formula".format(operator))
+
+    def comparison(self):
+        left, left_kind = self.concatenation()
+        while True:
+            operator = self.accept(*COMPARISON_OPERATORS)
+            if not operator:
+                return left, left_kind
+            right, right_kind = self.concatenation()
+            if "number" in (left_kind, right_kind):
+                left, right = number(left, left_kind), number(right, right_kind)
+            left, left_kind = {COMPARISON_OPERATORS[operator]: [left, right]}, "boolean"
+
+    def concatenation(self):
+        left, left_kind = self.additive()
+        while self.accept("&"):
+            right, right_kind = self.additive()
+            left, left_kind = {"$concat": [string(left, left_kind), string(right, right_kind)]}, "string"
+        return left, left_kind
+
+    def additive(self):
+        left, left_kind = self.multiplicative()
+        while True:
+            operator = self.accept(*ADDITIVE_OPERATORS)
+            if not operator:
+                return left, left_kind
+            right, right_kind = self.multiplicative()
+            left, left_kind = {ADDITIVE_OPERATORS[operator]: [number(left, left_kind),
+                                                              number(right, right_kind)]}, "number"
+
+    def multiplicative(self):
+        left, left_kind = self.power()
+        while True:
+            operator = self.accept(*MULTIPLICATIVE_OPERATORS)
+            if not operator:
+                return left, left_kind
+            right, right_kind = self.power()
+            if operator == "/":
+                left = divide(number(left, left_kind), number(right, right_kind))
+            else:
+                left = {"$multiply": [number(left, left_kind), number(right, right_kind)]}
+            left_kind = "number"
+
+    def power(self):
+        left, left_kind = self.unary()
+        while self.accept("^"):
+            right, right_kind = self.unary()
+            left, left_kind = {"$pow": [number(left, left_kind), number(right, right_kind)]}, "number"
+        return left, left_kind
+
+    def unary(self):
+        if self.accept("-"):
+            expression, kind = self.unary()
+            return {"$multiply": [-1, number(expression, kind)]}, "number"
+        if self.accept("+"):
+            expression, kind = self.unary()
+            return number(expression, kind), "number"
+        return self.primary()
+
+    def primary(self):
+        kind, value = self.peek()
+        if kind is None:
+            raise FormulaError("Formula ends unexpectedly")
+        self.position += 1
+        if kind == "number":
+            return float(value), "number"
+        if kind == "string":
+            return {"$literal": value}, "string"
+        if kind == "bracketed":
+            return self.column(value.strip(), by_name=True)
+        if kind == "identifier":
+            if self.accept("("):
+                return self.function(value.upper())
+            if value.upper() in ("TRUE", "FALSE"):
+                return value.upper() == "TRUE", "boolean"
+            return self.column(value)
+        if value == "(":
+            expression = self.comparison()
+            self.expect(")")
+            return expression
+        raise FormulaError("Unexpected '{}' in formula".format(value))
+
+    def function(self, name):
+        if name not in FUNCTIONS:
+            raise FormulaError("Unknown function {}".format(name))
+        arguments = []
+        if not self.accept(")"):
+            arguments.append(self.comparison())
+            while self.accept(","):
+                arguments.append(self.comparison())
+            self.expect(")")
+        if not arguments:
+            raise FormulaError("{} needs at least one argument".format(name))
+        return FUNCTIONS[name](arguments)
+
+    def resolve(self, reference, by_name=False):
+        if not by_name and reference.upper() in self.alphabets:
+            return self.alphabets[reference.upper()]
+        column = find_column(self.columns, reference)
+        if column is None:
+            raise FormulaError("Unknown column {}".format(reference))
+        return column_key(column)
+
+    def column(self, reference, by_name=False):
+        key = self.resolve(reference, by_name)
+        if key == self.target:
+            raise FormulaError("Formula for column {} refers to itself".format(reference))
+        if "." in key or key.startswith("$"):
+            raise FormulaError("Column {} cannot be used in a formula".format(reference))
+        self.references.add(key)
+        return "$$row.{}".format(key), "any"
+
+    def canonical(self):
+        """The formula with every column reference rewritten as [key]."""
+        parts = []
+        for index, (kind, value) in enumerate(self.tokens):
+            following = self.tokens[index + 1] if index + 1 < len(self.tokens) else (None, None)
+            function_call = kind == "identifier" and following == ("operator", "(")
+            if kind == "string":
+                part = '"{}"'.format(value.replace('"', '""'))
+            elif kind == "bracketed" or kind == "identifier" and not function_call \
+                    and value.upper() not in ("TRUE", "FALSE"):
+                key = self.resolve(value.strip(), by_name=kind == "bracketed")
+                if "]" in key:
+                    raise FormulaError("Column {} cannot be used in a formula".format(value))
+                part = "[{}]".format(key)
+            else:
+                part = value
+            opens_call = value == "(" and index > 0 and self.tokens[index - 1][0] == "identifier"
+            if parts and parts[-1] != "(" and part not in (")", ",") and not opens_call:
+                parts.append(" ")
+            parts.append(part)
+        return "=" + "".join(parts)
+
+
+def compile_formula(formula_string, column_data, target=None):
+    return FormulaCompiler(formula_string, column_data, target).compile()
+
+
+def canonical_formula(formula_string, column_data, target=None):
+    compiler = FormulaCompiler(formula_string, column_data, target)
+    compiler.compile()
+    return compiler.canonical()
+
+
+def formula_references(column, column_data):
+    if column.depends_on:
+        return list(column.depends_on)
+    try:
+        return sorted(compile_formula(column.formula_string, column_data, column_key(column)).references)
+    except FormulaError:
+        return []
+
+
+def dependency_graph(column_data):
+    """Maps every formula column key to the keys its formula reads."""
+    return {column_key(column): formula_references(column, column_data) for column in live_columns(column_data)
+            if column.input_type == "FOR"}
+
+
+def find_cycle(graph):
+    visiting, visited = [], set()
+
+    def visit(name):
+        if name in visiting:
+            return visiting[visiting.index(name):] + [name]
+        if name in visited:
+            return None
+        visiting.append(name)
+        for dependency in graph.get(name, []):
+            cycle = visit(dependency)
+            if cycle:
+                return cycle
+        visiting.pop()
+        visited.add(name)
+        return None
+
+    for name in graph:
+        cycle = visit(name)
+        if cycle:
+            return cycle
+    return None
+
+
+def check_dependencies(column_data, target, references):
+    graph = dependency_graph(column_data)
+    graph[target] = list(references)
+    cycle = find_cycle(graph)
+    if cycle:
+        raise FormulaError("Formula for column {} creates a cycle: {}".format(target, " -> ".join(cycle)))
+
+
+def recompute_order(column_data, changed_columns, include_changed=False):
+    """Formula columns affected by changed_columns, each listed after every column it depends on."""
+    graph = dependency_graph(column_data)
+    affected = {name for name in changed_columns if include_changed and name in graph}
+    pending = True
+    while pending:
+        pending = False
+        for name, dependencies in graph.items():
+            if name not in affected and any(dependency in affected or dependency in changed_columns
+                                            for dependency in dependencies):
+                affected.add(name)
+                pending = True
+    ordered = []
+
+    def visit(name):
+        if name in ordered:
+            return
+        for dependency in graph[name]:
+            if dependency in affected:
+                visit(dependency)
+        ordered.append(name)
+
+    for name in sorted(affected):
+        visit(name)
+    return ordered
+
+
+def compile_formula_columns(column_data, columns):
+    formula_strings = {column_key(column): column.formula_string for column in live_columns(column_data)}
+    return [(name, compile_formula(formula_strings[name], column_data, name)) for name in columns]
+
+
+def formula_update_pipeline(formulas, sct_ids=None):
+    """Update pipeline that evaluates formulas in order for the rows of a chunk.
+
+    Each formula gets its own stage so later formulas see the values computed by earlier ones. With sct_ids
+    only those rows are evaluated; the rest of the chunk is left as it is.
+    """
+    pipeline = []
+    for column, formula in formulas:
+        if "." in column or column.startswith("$"):
+            raise FormulaError("Column {} cannot hold a formula".format(column))
+        computed_row = {"$mergeObjects": ["$$row", {column: formula.expression}]}
+        if sct_ids is not None:
+            computed_row = {"$cond": [{"$in": ["$$row.sct_id", list(sct_ids)]}, computed_row, "$$row"]}
+        pipeline.append({"$set": {"data": {"$map": {"input": "$data", "as": "row", "in": computed_row}}}})
+    return pipeline
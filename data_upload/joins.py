@@ -0,0 +1,93 @@
+import json
+import logging
+import os
+import zlib
+
+logger = logging.getLogger(__name__)
+
+JOIN_TYPES = ["inner", "left", "outer"]
+
+
+class PartitionedHashJoin:
+    """Hash join of two or more sheets on shared key columns.
+
+    Every input is first spilled to disk, hash partitioned on the join key, so only one partition of every sheet
+    has to be held in memory while the partition is joined.
+    """
+
+    def __init__(self, work_dir, join_keys, join_type, partitions):
+        self.work_dir = work_dir
+        self.join_keys = join_keys
+        self.join_type = join_type
+        self.partitions = partitions
+        self.inputs = 0
+        os.makedirs(self.work_dir, exist_ok=True)
+
+    def partition_path(self, partition, input_index):
+        return os.path.join(self.work_dir, "p{}_s{}.jsonl".format(partition, input_index))
+
+    def row_key(self, row):
+        key = [row.get(column) for column in self.join_keys]
+        if any(value in (None, "") for value in key):
+            return None
+        return key
+
+    def add_input(self, rows):
+        input_index = self.inputs
+        self.inputs += 1
+        files = {}
+        count = 0
+        try:
+            for row in rows:
+                key = self.row_key(row)
+                partition = zlib.crc32(json.dumps(key, default=str).encode()) % self.partitions if key else 0
+                if partition not in files:
+                    files[partition] = open(self.partition_path(partition, input_index), "w")
+                files[partition].write(json.dumps({"k": key, "r": row}, default=str) + "\n")
+                count += 1
+        finally:
+            for partition_file in files.values():
+                partition_file.close()
+        logger.info("Partitioned {} rows of join input {}".format(count, input_index))
+        return count
+
+    def read_partition(self, partition, input_index):
+        path = self.partition_path(partition, input_index)
+        if not os.path.exists(path):
+            return
+        with open(path) as partition_file:
+            for line in partition_file:
+                entry = json.loads(line)
+                yield (tuple(entry["k"]) if entry["k"] else None), entry["r"]
+
+    def join_partition(self, partition):
+        left = list(self.read_partition(partition, 0))
+        for input_index in range(1, self.inputs):
+            table = {}
+            unkeyed = []
+            for key, row in self.read_partition(partition, input_index):
+                if key is None:
+                    unkeyed.append(row)
+                else:
+                    table.setdefault(key, []).append(row)
+            matched = set()
+            joined = []
+            for key, row in left:
+                matches = table.get(key) if key is not None else None
+                if matches:
+                    matched.add(key)
+                    joined.extend((key, {**row, **match}) for match in matches)
+                elif self.join_type in ["left", "outer"]:
+                    joined.append((key, row))
+            if self.join_type == "outer":
+                for key, rows in table.items():
+                    if key not in matched:
+                        joined.extend((key, row) for row in rows)
+                joined.extend((None, row) for row in unkeyed)
+            left = joined
+        for _, row in left:
+            yield row
+
+    def join(self):
+        for partition in range(self.partitions):
+            yield from self.join_partition(partition)
@@ -0,0 +1,156 @@
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import redis
+from django.conf import settings
+from django.dispatch import receiver
+
+from .models import SheetUploadData, SheetMetaData
+from .mongo import get_async_collection
+from .signals import sheet_changed
+from .columns import live_columns
+
+logger = logging.getLogger(__name__)
+
+
+class TTLLRUCache:
+
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires = entry
+            if expires < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+sheet_cache = TTLLRUCache(settings.LOCAL_CACHE_MAX_SIZE, settings.LOCAL_CACHE_TTL)
+column_cache = TTLLRUCache(settings.LOCAL_CACHE_MAX_SIZE, settings.LOCAL_CACHE_TTL)
+
+_client = None
+_subscriber_pid = None
+_subscriber_retry_at = 0
+_subscriber_lock = threading.Lock()
+
+
+def get_invalidation_client():
+    global _client
+    if _client is None:
+        _client = redis.Redis.from_url(settings.CACHE_INVALIDATION_URL)
+    return _client
+
+
+def invalidate_local(sheet_id=None, sql_ref=None):
+    if sheet_id:
+        sheet_cache.invalidate(str(sheet_id))
+    if sql_ref:
+        column_cache.invalidate(str(sql_ref))
+
+
+def handle_invalidation_message(message):
+    try:
+        payload = json.loads(message["data"])
+    except (TypeError, ValueError):
+        logger.error("Invalid cache invalidation message: {}".format(message))
+        return
+    invalidate_local(payload.get("sheet_id"), payload.get("sql_ref"))
+
+
+def handle_subscriber_error(error, pubsub, thread):
+    """Called by the subscriber thread when its connection fails; the thread is replaced by a new subscription."""
+    global _subscriber_pid, _subscriber_retry_at
+    logger.error("Cache invalidation subscriber failed in process {}: {}".format(os.getpid(), error))
+    thread.stop()
+    try:
+        pubsub.close()
+    except redis.RedisError:
+        pass
+    # Invalidations published while disconnected are lost, so nothing cached so far can be trusted.
+    sheet_cache.clear()
+    column_cache.clear()
+    with _subscriber_lock:
+        _subscriber_pid = None
+        _subscriber_retry_at = 0
+    ensure_subscribed()
+
+
+def ensure_subscribed():
+    """Subscribes this process to cache invalidations once; failed attempts are retried after
+    CACHE_INVALIDATION_RETRY_DELAY, until then the caches rely on their TTL."""
+    global _subscriber_pid, _subscriber_retry_at
+    if _subscriber_pid == os.getpid() or time.monotonic() < _subscriber_retry_at:
+        return
+    with _subscriber_lock:
+        if _subscriber_pid == os.getpid() or time.monotonic() < _subscriber_retry_at:
+            return
+        try:
+            pubsub = get_invalidation_client().pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(**{settings.CACHE_INVALIDATION_CHANNEL: handle_invalidation_message})
+            pubsub.run_in_thread(sleep_time=1, daemon=True, exception_handler=handle_subscriber_error)
+            _subscriber_pid = os.getpid()
+            logger.info("Subscribed to cache invalidation channel in process {}".format(_subscriber_pid))
+        except redis.RedisError as e:
+            _subscriber_retry_at = time.monotonic() + settings.CACHE_INVALIDATION_RETRY_DELAY
+            logger.error("Could not subscribe to cache invalidation, relying on TTL only: {}".format(e))
+
+
+@receiver(sheet_changed, dispatch_uid="local_cache_sheet_changed")
+def publish_invalidation(sender, sheet_id=None, sql_ref=None, **kwargs):
+    invalidate_local(sheet_id, sql_ref)
+    try:
+        get_invalidation_client().publish(
+            settings.CACHE_INVALIDATION_CHANNEL,
+            json.dumps({"sheet_id": str(sheet_id) if sheet_id else None, "sql_ref": str(sql_ref) if sql_ref else None}))
+    except redis.RedisError as e:
+        logger.error("Could not publish cache invalidation for sheet {}: {}".format(sheet_id, e))
+
+
+async def aget_sheet(sheet_id):
+    ensure_subscribed()
+    sheet_data = sheet_cache.get(str(sheet_id))
+    if sheet_data is None:
+        sheet_data = await SheetUploadData.objects.filter(id=sheet_id).afirst()
+        if sheet_data:
+            sheet_cache.set(str(sheet_id), sheet_data)
+    return sheet_data
+
+
+async def aget_column_data(sql_ref):
+    ensure_subscribed()
+    column_data = column_cache.get(str(sql_ref))
+    if column_data is None:
+        meta_data = await get_async_collection(SheetMetaData).find_one({"sql_ref": str(sql_ref)}, {"column_data": 1})
+        if not meta_data:
+            return None
+        column_data = live_columns(meta_data.get("column_data", []))
+        column_cache.set(str(sql_ref), column_data)
+    return column_data
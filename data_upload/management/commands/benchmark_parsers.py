@@ -0,0 +1,37 @@
+import os
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from data_upload.parsers import PARSER_BACKENDS, available_backends, open_sheet_reader
+
+
+class Command(BaseCommand):
+    help = "Parses the same sheet files with every parser backend and reports rows/s per backend"
+
+    def add_arguments(self, parser):
+        parser.add_argument('files', nargs='+')
+        parser.add_argument('--backends', nargs='+', default=None)
+        parser.add_argument('--repeat', type=int, default=3, help="Runs per file and backend; the best run is reported")
+
+    def handle(self, *args, **options):
+        backends = options['backends'] or available_backends()
+        for backend in backends:
+            if backend not in available_backends():
+                raise CommandError("Parser backend {} is not available".format(backend))
+        self.stdout.write("{:<40} {:>8} {:>12} {:>12} {:>10}".format("file", "backend", "rows", "rows/s", "MB/s"))
+        for path in options['files']:
+            file_type = os.path.splitext(path)[1].lower()
+            size = os.path.getsize(path)
+            for backend in backends:
+                if file_type not in PARSER_BACKENDS[backend]:
+                    continue
+                best = None
+                for _ in range(options['repeat']):
+                    started = time.perf_counter()
+                    with open_sheet_reader(path, file_type, backend) as reader:
+                        row_count = sum(1 for _ in reader.rows())
+                    elapsed = time.perf_counter() - started
+                    best = elapsed if best is None else min(best, elapsed)
+                self.stdout.write("{:<40} {:>8} {:>12} {:>12.0f} {:>10.1f}".format(
+                    os.path.basename(path)[:40], backend, row_count, row_count / best, size / best / 1024 / 1024))
@@ -0,0 +1,52 @@
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from django.core.management.base import BaseCommand
+
+
+class Command(BaseCommand):
+    help = "Fires concurrent sheet reads at a running server and reports throughput and latency per concurrency level"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--base-url', default="http://localhost:8000/data-staging")
+        parser.add_argument('--sheet-id', required=True)
+        parser.add_argument('--token', required=True)
+        parser.add_argument('--concurrency', nargs='+', type=int, default=[1, 10, 40, 100, 200])
+        parser.add_argument('--requests', type=int, default=400, help="Requests per concurrency level")
+        parser.add_argument('--page-size', type=int, default=100)
+        parser.add_argument('--sort-column', default=None)
+
+    def handle(self, *args, **options):
+        base_url = options['base_url'].rstrip('/')
+        sheet_id = options['sheet_id']
+        headers = {"Authorization": "Bearer {}".format(options['token'])}
+        page_size = options['page_size']
+
+        def read(request_number):
+            page = request_number % 10 + 1
+            started = time.perf_counter()
+            if options['sort_column']:
+                response = requests.post("{}/sheet/{}/filters".format(base_url, sheet_id),
+                                         params={"page": page, "page_size": page_size}, headers=headers,
+                                         json={"sort_by_column": [options['sort_column']], "sort_order": [1]})
+            elif request_number % 2:
+                response = requests.get("{}/sheet/{}/meta_data".format(base_url, sheet_id), headers=headers)
+            else:
+                response = requests.get("{}/sheet/{}".format(base_url, sheet_id),
+                                        params={"page": page, "page_size": page_size}, headers=headers)
+            return time.perf_counter() - started, response.status_code
+
+        self.stdout.write("{:>12} {:>10} {:>10} {:>10} {:>10} {:>8}".format(
+            "concurrency", "req/s", "p50 ms", "p95 ms", "max ms", "errors"))
+        for concurrency in options['concurrency']:
+            started = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=concurrency) as executor:
+                results = list(executor.map(read, range(options['requests'])))
+            elapsed = time.perf_counter() - started
+            latencies = sorted(latency * 1000 for latency, _ in results)
+            errors = sum(1 for _, status in results if status >= 400)
+            self.stdout.write("{:>12} {:>10.1f} {:>10.1f} {:>10.1f} {:>10.1f} {:>8}".format(
+                concurrency, len(results) / elapsed, statistics.median(latencies),
+                latencies[int(len(latencies) * 0.95) - 1], latencies[-1], errors))
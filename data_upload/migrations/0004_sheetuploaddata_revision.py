@@ -0,0 +1,18 @@
+# Generated by Django 5.0.2 on 2026-10-19 09:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('data_upload', '0003_remove_customcolumndata_data_type_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='sheetuploaddata',
+            name='revision',
+            field=models.IntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,40 @@
+# Generated by Django 5.0.2 on 2026-10-19 10:03
+
+import django.db.models.deletion
+import uuid
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('data_upload', '0004_sheetuploaddata_revision'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SavedQuery',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False, unique=True)),
+                ('name', models.CharField(max_length=255)),
+                ('source_file_name', models.CharField(max_length=255)),
+                ('source_revision', models.IntegerField(default=0)),
+                ('filter_data', models.JSONField()),
+                ('status', models.IntegerField(choices=[(1, 'SUCCESS'), (2, 'FAILURE'), (3, 'UPLOADED'), (4, 'UNZIP_COMPLETED'), (5, 'DOWNLOADED'), (6, 'PROCESSING')], default=3)),
+                ('created_date_time', models.DateTimeField(auto_now_add=True)),
+                ('last_refresh_date_time', models.DateTimeField(blank=True, null=True)),
+                ('created_by', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='saved_queries', to=settings.AUTH_USER_MODEL)),
+                ('result_sheet', models.OneToOneField(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='saved_query', to='data_upload.sheetuploaddata')),
+                ('source_sheet', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='saved_queries', to='data_upload.sheetuploaddata')),
+                ('study', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='saved_queries', to='data_upload.studydata')),
+            ],
+            options={
+                'verbose_name': 'Saved Query',
+                'verbose_name_plural': 'Saved Queries',
+                'db_table': 'saved_query',
+                'unique_together': {('study', 'name')},
+            },
+        ),
+    ]
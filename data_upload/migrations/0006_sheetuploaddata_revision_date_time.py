@@ -0,0 +1,18 @@
+# Generated by Django 5.0.2 on 2026-10-19 11:41
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('data_upload', '0005_savedquery'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='sheetuploaddata',
+            name='revision_date_time',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
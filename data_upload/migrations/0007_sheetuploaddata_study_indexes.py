@@ -0,0 +1,21 @@
+# Generated by Django 5.0.2 on 2026-10-19 14:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('data_upload', '0006_sheetuploaddata_revision_date_time'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='sheetuploaddata',
+            index=models.Index(fields=['study', 'active', 'original_file_name', '-version_number'], name='sheet_upload_study_active_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='sheetuploaddata',
+            index=models.Index(fields=['study', 'original_file_name', '-version_number'], name='sheet_upload_study_file_idx'),
+        ),
+    ]
@@ -0,0 +1,43 @@
+# Generated by Django 5.0.2 on 2026-10-19 14:12
+
+import django.db.models.deletion
+import uuid
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('data_upload', '0007_sheetuploaddata_study_indexes'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BulkEditJob',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False, unique=True)),
+                ('original_file_name', models.CharField(max_length=255)),
+                ('date_lake_url', models.URLField(blank=True, max_length=255, null=True)),
+                ('key_column', models.CharField(default='sct_id', max_length=255)),
+                ('status', models.IntegerField(choices=[(1, 'SUCCESS'), (2, 'FAILURE'), (3, 'UPLOADED'), (4, 'UNZIP_COMPLETED'), (5, 'DOWNLOADED'), (6, 'PROCESSING')], default=3)),
+                ('additional_info', models.TextField(blank=True, null=True)),
+                ('total_rows', models.IntegerField(default=0)),
+                ('processed_rows', models.IntegerField(default=0)),
+                ('applied_cells', models.IntegerField(default=0)),
+                ('error_count', models.IntegerField(default=0)),
+                ('errors', models.JSONField(default=list)),
+                ('revision', models.IntegerField(blank=True, null=True)),
+                ('created_date_time', models.DateTimeField(auto_now_add=True)),
+                ('finished_date_time', models.DateTimeField(blank=True, null=True)),
+                ('created_by', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='bulk_edits', to=settings.AUTH_USER_MODEL)),
+                ('sheet', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='bulk_edits', to='data_upload.sheetuploaddata')),
+            ],
+            options={
+                'verbose_name': 'Bulk Edit Job',
+                'verbose_name_plural': 'Bulk Edit Jobs',
+                'db_table': 'bulk_edit_job',
+            },
+        ),
+    ]
@@ -1,10 +1,13 @@
 import uuid
-from enum import IntEnum
+from enum import IntEnum, Enum
 
-from django.db import models
+from django.db import models, transaction
+from django.utils import timezone
+
+from .signals import sheet_changed
 # from djongo import models as djongo_models
 from mongoengine import Document, StringField, DictField, ListField, EmbeddedDocumentListField, \
-    EmbeddedDocument, ReferenceField, BooleanField, IntField
+    EmbeddedDocument, ReferenceField, BooleanField, IntField, ObjectIdField, DateTimeField, DynamicField
 
 
 class DataImportStatusEnum(IntEnum):
@@ -82,15 +85,107 @@ class SheetUploadData(UploadData):
     file_type = models.CharField(max_length=255, null=True, blank=True)
     study = models.ForeignKey('StudyData', on_delete=models.CASCADE, related_name='sheet_uploads')
     active = models.BooleanField(default=True)
+    revision = models.IntegerField(default=0)
+    revision_date_time = models.DateTimeField(null=True, blank=True)
 
     class Meta:
         db_table = 'sheet_upload_data'
         verbose_name = 'Sheet Upload Data'
         verbose_name_plural = 'Sheet Upload Data'
+        indexes = [
+            models.Index(fields=['study', 'active', 'original_file_name', '-version_number'],
+                         name='sheet_upload_study_active_idx'),
+            models.Index(fields=['study', 'original_file_name', '-version_number'],
+                         name='sheet_upload_study_file_idx'),
+        ]
 
     def __str__(self):
         return self.original_file_name
 
+    def bump_revision(self):
+        # The row stays locked until the transaction ends, so the revision read back is the one this call set.
+        with transaction.atomic():
+            SheetUploadData.objects.filter(id=self.id).update(revision=models.F('revision') + 1,
+                                                              revision_date_time=timezone.now())
+            self.refresh_from_db(fields=['revision', 'revision_date_time'])
+        sheet_changed.send(sender=SheetUploadData, sheet_id=self.id, sql_ref=self.unique_reference)
+        return self.revision
+
+    @property
+    def last_modified(self):
+        return self.revision_date_time or self.upload_date_time
+
+
+class SavedQuery(models.Model):
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False, unique=True)
+    name = models.CharField(max_length=255, null=False, blank=False)
+    study = models.ForeignKey('StudyData', on_delete=models.CASCADE, related_name='saved_queries')
+    source_file_name = models.CharField(max_length=255, null=False, blank=False)
+    source_sheet = models.ForeignKey('SheetUploadData', on_delete=models.SET_NULL, related_name='saved_queries',
+                                     null=True, blank=True)
+    source_revision = models.IntegerField(default=0)
+    result_sheet = models.OneToOneField('SheetUploadData', on_delete=models.SET_NULL, related_name='saved_query',
+                                        null=True, blank=True)
+    filter_data = models.JSONField()
+    status = models.IntegerField(
+        choices=[(status.value, status.name) for status in DataImportStatusEnum],
+        default=DataImportStatusEnum.UPLOADED
+    )
+    created_by = models.ForeignKey('authentication.User', on_delete=models.CASCADE, related_name='saved_queries')
+    created_date_time = models.DateTimeField(auto_now_add=True)
+    last_refresh_date_time = models.DateTimeField(null=True, blank=True)
+
+    objects = models.Manager()
+
+    class Meta:
+        db_table = 'saved_query'
+        verbose_name = 'Saved Query'
+        verbose_name_plural = 'Saved Queries'
+        unique_together = ('study', 'name')
+
+    def __str__(self):
+        return self.name
+
+    @property
+    def stale(self):
+        active_sheet = SheetUploadData.objects.filter(study_id=self.study_id, original_file_name=self.source_file_name,
+                                                      active=True).only('id', 'revision').first()
+        if not active_sheet or not self.last_refresh_date_time:
+            return True
+        return active_sheet.id != self.source_sheet_id or active_sheet.revision != self.source_revision
+
+
+class BulkEditJob(models.Model):
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False, unique=True)
+    sheet = models.ForeignKey('SheetUploadData', on_delete=models.CASCADE, related_name='bulk_edits')
+    original_file_name = models.CharField(max_length=255, null=False, blank=False)
+    date_lake_url = models.URLField(max_length=255, null=True, blank=True)
+    key_column = models.CharField(max_length=255, default="sct_id")
+    status = models.IntegerField(
+        choices=[(status.value, status.name) for status in DataImportStatusEnum],
+        default=DataImportStatusEnum.UPLOADED
+    )
+    additional_info = models.TextField(blank=True, null=True)
+    total_rows = models.IntegerField(default=0)
+    processed_rows = models.IntegerField(default=0)
+    applied_cells = models.IntegerField(default=0)
+    error_count = models.IntegerField(default=0)
+    errors = models.JSONField(default=list)
+    revision = models.IntegerField(null=True, blank=True)
+    created_by = models.ForeignKey('authentication.User', on_delete=models.CASCADE, related_name='bulk_edits')
+    created_date_time = models.DateTimeField(auto_now_add=True)
+    finished_date_time = models.DateTimeField(null=True, blank=True)
+
+    objects = models.Manager()
+
+    class Meta:
+        db_table = 'bulk_edit_job'
+        verbose_name = 'Bulk Edit Job'
+        verbose_name_plural = 'Bulk Edit Jobs'
+
+    def __str__(self):
+        return "{} ({})".format(self.original_file_name, self.status)
+
 
 class ColumnData(EmbeddedDocument):
     name = StringField(max_length=255)
@@ -102,18 +197,31 @@ class ColumnData(EmbeddedDocument):
     resizable = BooleanField(default=True)
     visible = BooleanField(default=True)
     protected = BooleanField(default=True)
-    alphabet = StringField(max_length=2)
+    alphabet = StringField(max_length=3)
+    sort_indexed = BooleanField(default=False)
+    depends_on = ListField(StringField(max_length=255))
+    key = StringField(max_length=255)
+    deleted = BooleanField(default=False)
 
 
 class SheetMetaData(Document):
     sql_ref = StringField(max_length=255, null=False, blank=False)
     column_data = EmbeddedDocumentListField(ColumnData)
+    chunk_size = IntField()
+    compacted_revision = IntField(default=0)
+    version = IntField(default=0)
+    # Ingest checkpoint: rows committed so far and the position right after them in the parser backend that read them.
+    ingested_rows = IntField(default=0)
+    ingest_position = IntField()
+    ingest_parser = StringField(max_length=32)
 
     meta = {
         'db_table': 'sheet_meta_data',
         'verbose_name': 'Sheet Meta Data',
         'mongodb_model': True,
-        'verbose_name_plural': 'Sheet Meta Data'
+        'verbose_name_plural': 'Sheet Meta Data',
+        # One metadata document per sheet, so two deliveries of an ingest cannot both start it.
+        'indexes': [{'fields': ['sql_ref'], 'unique': True}]
     }
 
     def __str__(self):
@@ -125,18 +233,181 @@ class MongoDbClient(Document):
     sql_ref = StringField(max_length=255, null=False, blank=False)
     data = ListField(DictField())  # List of embedded RowData
     meta_data = ReferenceField(SheetMetaData, required=True)
+    chunk_no = IntField()
 
     meta = {
         'db_table': 'mongo_db_client',
         'verbose_name': 'MongoDB Client',
         'mongodb_model': True,
-        'verbose_name_plural': 'MongoDB Clients'
+        'verbose_name_plural': 'MongoDB Clients',
+        # Chunks appended without a number (saved query views) are left out of the uniqueness check.
+        'indexes': [{'fields': ('sql_ref', 'chunk_no'), 'unique': True,
+                     'partialFilterExpression': {'chunk_no': {'$exists': True}}}]
     }
 
     def __str__(self):
         return "{} ({})".format(self.id, self.sql_ref)  # Using MongoEngine's "id"
 
 
+class RowLocator(Document):
+    # Short field names keep one locator per row small; these documents are only read by the edit path.
+    sql_ref = StringField(max_length=255, db_field='s')
+    sct_id = StringField(max_length=255, db_field='i')
+    chunk_id = ObjectIdField(db_field='c')
+    offset = IntField(db_field='o')
+
+    meta = {
+        'db_table': 'row_locator',
+        'verbose_name': 'Row Locator',
+        'mongodb_model': True,
+        'verbose_name_plural': 'Row Locators',
+        'indexes': [{'fields': ('sql_ref', 'sct_id'), 'unique': True}]
+    }
+
+    def __str__(self):
+        return "{} ({}:{})".format(self.sct_id, self.chunk_id, self.offset)
+
+
+class ColumnValueCount(EmbeddedDocument):
+    value = StringField()
+    count = IntField(default=0)
+
+
+class ColumnDictionary(Document):
+    sql_ref = StringField(max_length=255, null=False, blank=False)
+    column = StringField(max_length=255, null=False, blank=False)
+    values = EmbeddedDocumentListField(ColumnValueCount)
+    truncated = BooleanField(default=False)
+
+    meta = {
+        'db_table': 'column_dictionary',
+        'verbose_name': 'Column Dictionary',
+        'mongodb_model': True,
+        'verbose_name_plural': 'Column Dictionaries',
+        'indexes': [('sql_ref', 'column')]
+    }
+
+    def __str__(self):
+        return "{} ({})".format(self.column, self.sql_ref)
+
+
+class SearchDocument(Document):
+    study_id = StringField(max_length=255, null=False, blank=False)
+    sql_ref = StringField(max_length=255, null=False, blank=False)
+    sct_id = StringField(max_length=255, null=False, blank=False)
+    content = StringField()
+    cells = DictField()
+
+    meta = {
+        'db_table': 'search_document',
+        'verbose_name': 'Search Document',
+        'mongodb_model': True,
+        'verbose_name_plural': 'Search Documents',
+        'indexes': [
+            {'fields': ['study_id', '$content']},
+            ('sql_ref', 'sct_id'),
+        ]
+    }
+
+    def __str__(self):
+        return "{} ({})".format(self.sct_id, self.sql_ref)
+
+
+class SortIndexStatusEnum(str, Enum):
+    QUEUED = "QUEUED"
+    BUILDING = "BUILDING"
+    READY = "READY"
+    STALE = "STALE"
+    FAILED = "FAILED"
+
+
+class SortIndex(Document):
+    sql_ref = StringField(max_length=255, null=False, blank=False)
+    column = StringField(max_length=255, null=False, blank=False)
+    status = StringField(max_length=20, default=SortIndexStatusEnum.QUEUED.value)
+    build_id = StringField(max_length=255)
+    # Increases with every build, so a finished build can tell the entries of older builds from newer ones.
+    build_number = IntField(default=0)
+    row_count = IntField(default=0)
+    built_date_time = DateTimeField()
+
+    meta = {
+        'db_table': 'sort_index',
+        'verbose_name': 'Sort Index',
+        'mongodb_model': True,
+        'verbose_name_plural': 'Sort Indexes',
+        'indexes': [{'fields': ('sql_ref', 'column'), 'unique': True}]
+    }
+
+    def __str__(self):
+        return "{} ({})".format(self.column, self.status)
+
+
+class SortIndexEntry(Document):
+    sql_ref = StringField(max_length=255, null=False, blank=False)
+    column = StringField(max_length=255, null=False, blank=False)
+    position = IntField()
+    sct_id = StringField(max_length=255)
+    chunk_id = ObjectIdField()
+    build_id = StringField(max_length=255)
+    build_number = IntField()
+
+    meta = {
+        'db_table': 'sort_index_entry',
+        'verbose_name': 'Sort Index Entry',
+        'mongodb_model': True,
+        'verbose_name_plural': 'Sort Index Entries',
+        'indexes': [('sql_ref', 'column', 'build_id', 'position'), ('sql_ref', 'column', 'build_number')]
+    }
+
+
+class EditActionEnum(str, Enum):
+    EDIT = "EDIT"
+    UNDO = "UNDO"
+    REDO = "REDO"
+
+
+class EditJournalEntry(Document):
+    sql_ref = StringField(max_length=255, null=False, blank=False)
+    revision = IntField()
+    sct_id = StringField(max_length=255)
+    column = StringField(max_length=255)
+    old_value = DynamicField()
+    new_value = DynamicField()
+    action = StringField(max_length=20, default=EditActionEnum.EDIT.value)
+    reverts = IntField()
+    pending = StringField(max_length=32)
+    user_id = StringField(max_length=255)
+    edit_date_time = DateTimeField()
+
+    meta = {'abstract': True}
+
+    def __str__(self):
+        return "{}.{} @ {}".format(self.sct_id, self.column, self.revision)
+
+
+class EditJournal(EditJournalEntry):
+    meta = {
+        'db_table': 'edit_journal',
+        'verbose_name': 'Edit Journal',
+        'mongodb_model': True,
+        'verbose_name_plural': 'Edit Journal',
+        'indexes': [('sql_ref', 'revision'), ('sql_ref', 'sct_id', 'revision'),
+                    {'fields': ['sql_ref', 'pending'], 'sparse': True},
+                    {'fields': ['edit_date_time'], 'partialFilterExpression': {'pending': {'$exists': True}}}]
+    }
+
+
+class EditJournalArchive(EditJournalEntry):
+    meta = {
+        'db_table': 'edit_journal_archive',
+        'verbose_name': 'Edit Journal Archive',
+        'mongodb_model': True,
+        'verbose_name_plural': 'Edit Journal Archive',
+        'indexes': [('sql_ref', 'revision'), ('sql_ref', 'sct_id', 'revision')]
+    }
+
+
 class CustomColumnData(models.Model):
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False, unique=True)
     sheet_id = models.ForeignKey('SheetUploadData', on_delete=models.CASCADE, related_name='custom_column_data')
@@ -0,0 +1,37 @@
+import asyncio
+import weakref
+
+from django.conf import settings
+from mongoengine.connection import get_db
+from motor.motor_asyncio import AsyncIOMotorClient
+
+# Motor clients are bound to the event loop they are first used on, so one client is kept per running loop.
+_clients = weakref.WeakKeyDictionary()
+# The $percentile accumulator was added in MongoDB 7.0.
+PERCENTILE_MIN_SERVER_VERSION = (7, 0)
+_server_version = None
+
+
+def get_async_database():
+    loop = asyncio.get_running_loop()
+    client = _clients.get(loop)
+    if client is None:
+        client = AsyncIOMotorClient(settings.MONGO_HOST, io_loop=loop, **settings.MONGO_CLIENT_OPTIONS)
+        _clients[loop] = client
+    return client[settings.MONGO_NAME]
+
+
+def get_async_collection(document):
+    return get_async_database()[document._get_collection_name()]
+
+
+def server_version():
+    """(major, minor) of the MongoDB server, read once per process."""
+    global _server_version
+    if _server_version is None:
+        _server_version = tuple(get_db().client.server_info()["versionArray"][:2])
+    return _server_version
+
+
+def supports_percentile():
+    return server_version() >= PERCENTILE_MIN_SERVER_VERSION
@@ -0,0 +1,159 @@
+import csv
+import os
+
+import openpyxl
+from django.conf import settings
+
+try:
+    import pyarrow
+    from pyarrow import csv as arrow_csv
+except ImportError:
+    pyarrow = None
+
+
+class SheetReader:
+    """Parser backend interface: streams the rows of an extracted sheet as dicts keyed by the header.
+
+    columns is the header; rows(position) yields the rows after position, and position() is an opaque value for the
+    rows handed out so far that a reader of the same backend can resume from.
+    """
+
+    backend = None
+
+    def rows(self, position=None):
+        raise NotImplementedError
+
+    def position(self):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class CsvSheetReader(SheetReader):
+    """Reads CSV with the csv module; position() is the file offset after the last row handed out."""
+
+    backend = "python"
+
+    def __init__(self, path):
+        self.file = open(path, newline='', encoding='utf-8-sig')
+        # Reading through readline() keeps tell() usable, iterating over a text file disables it.
+        self.lines = iter(self.file.readline, '')
+        self.columns = next(csv.reader(self.lines), None) or []
+
+    def rows(self, position=None):
+        if position is not None:
+            self.file.seek(position)
+        return csv.DictReader(self.lines, fieldnames=self.columns)
+
+    def position(self):
+        return self.file.tell()
+
+    def close(self):
+        self.file.close()
+
+
+class XlsxSheetReader(SheetReader):
+    """Streams the rows of the active worksheet of a workbook; position() is the number of data rows read."""
+
+    backend = "python"
+
+    def __init__(self, path):
+        self.workbook = openpyxl.load_workbook(path, read_only=True)
+        self.sheet = self.workbook.active
+        self.columns = list(next(self.sheet.iter_rows(max_row=1, values_only=True), ()))
+        self.row_count = 0
+
+    def rows(self, position=None):
+        self.row_count = position or 0
+        for values in self.sheet.iter_rows(min_row=self.row_count + 2, values_only=True):
+            self.row_count += 1
+            yield {self.columns[j]: value for j, value in enumerate(values)}
+
+    def position(self):
+        return self.row_count
+
+    def close(self):
+        self.workbook.close()
+
+
+class ArrowCsvSheetReader(SheetReader):
+    """Parses CSV in record batches with Arrow's multithreaded reader; position() is the number of data rows read.
+
+    Every column is read as a string so the rows match the ones the csv module produces. Rows with more or fewer
+    fields than the header are rejected instead of being padded.
+    """
+
+    backend = "arrow"
+
+    def __init__(self, path):
+        with open(path, newline='', encoding='utf-8-sig') as csvfile:
+            self.columns = next(csv.reader(csvfile), None) or []
+        self.file = open(path, "rb")
+        self.row_count = 0
+
+    def rows(self, position=None):
+        self.row_count = position or 0
+        if not self.columns:
+            return
+        self.file.seek(0)
+        batches = arrow_csv.open_csv(
+            self.file,
+            read_options=arrow_csv.ReadOptions(block_size=settings.SHEET_PARSER_BLOCK_SIZE,
+                                               skip_rows_after_names=self.row_count),
+            parse_options=arrow_csv.ParseOptions(newlines_in_values=True),
+            convert_options=arrow_csv.ConvertOptions(
+                column_types={column: pyarrow.string() for column in self.columns}))
+        for batch in batches:
+            for row in batch.to_pylist():
+                self.row_count += 1
+                yield row
+
+    def position(self):
+        return self.row_count
+
+    def close(self):
+        self.file.close()
+
+
+PARSER_BACKENDS = {
+    "python": {".csv": CsvSheetReader, ".xlsx": XlsxSheetReader},
+    "arrow": {".csv": ArrowCsvSheetReader},
+}
+
+
+def available_backends():
+    return [backend for backend in PARSER_BACKENDS if backend != "arrow" or pyarrow is not None]
+
+
+def choose_backend(path, file_type):
+    """The SHEET_PARSER_BACKEND setting, or for "auto" Arrow for CSV files of at least SHEET_PARSER_ARROW_MIN_SIZE."""
+    backend = settings.SHEET_PARSER_BACKEND
+    if backend != "auto":
+        return backend
+    if pyarrow is not None and file_type in PARSER_BACKENDS["arrow"] and \
+            os.path.getsize(path) >= settings.SHEET_PARSER_ARROW_MIN_SIZE:
+        return "arrow"
+    return "python"
+
+
+def open_sheet_reader(path, file_type, backend=None):
+    """Opens a reader for an extracted sheet, or returns None when the file type cannot be ingested.
+
+    File types the backend does not handle fall back to the python backend.
+    """
+    backend = backend or choose_backend(path, file_type)
+    if backend not in PARSER_BACKENDS:
+        raise ValueError("Unknown parser backend {}".format(backend))
+    if backend == "arrow" and pyarrow is None:
+        raise ValueError("The arrow parser backend needs pyarrow to be installed")
+    reader_class = PARSER_BACKENDS[backend].get(file_type) or PARSER_BACKENDS["python"].get(file_type)
+    if reader_class is None:
+        return None
+    return reader_class(path)
@@ -0,0 +1,185 @@
+import codecs
+import csv
+import os
+import zipfile
+
+import openpyxl
+from django.conf import settings
+
+UTF_BOMS = [
+    (codecs.BOM_UTF32_LE, "utf-32-le"),
+    (codecs.BOM_UTF32_BE, "utf-32-be"),
+    (codecs.BOM_UTF8, "utf-8-sig"),
+    (codecs.BOM_UTF16_LE, "utf-16-le"),
+    (codecs.BOM_UTF16_BE, "utf-16-be"),
+]
+SNIFFED_DELIMITERS = ",;\t|"
+
+
+class PrescanReport:
+    """Outcome of the pre-scan of one sheet file; it is stored as JSON in the upload's additional_info."""
+
+    def __init__(self, file_type, size):
+        self.info = {"file_type": file_type, "size": size}
+        self.errors = []
+
+    def error(self, code, message, **details):
+        self.errors.append(dict(code=code, message=message, **details))
+
+    @property
+    def valid(self):
+        return not self.errors
+
+    def dict(self):
+        return {"prescan": dict(valid=self.valid, errors=self.errors, **self.info)}
+
+
+def decode_sample(data, encoding, final):
+    """Decodes a byte sample; a sample cut in the middle of a character only loses that character."""
+    return codecs.getincrementaldecoder(encoding)().decode(data, final=final)
+
+
+def header_problems(report, columns):
+    blank = [index + 1 for index, column in enumerate(columns) if column is None or not str(column).strip()]
+    if blank:
+        report.error("blank_header", "Columns {} have no header".format(blank), columns=blank)
+    seen = set()
+    duplicates = []
+    for column in columns:
+        if column in seen and column not in duplicates:
+            duplicates.append(column)
+        seen.add(column)
+    if duplicates:
+        report.error("duplicate_header", "Duplicate column headers {}".format(duplicates), columns=duplicates)
+
+
+def parse_records(lines):
+    """Parses sampled lines, stopping at a record the sample cuts off; also returns the number of lines read."""
+    reader = csv.reader(lines)
+    records = []
+    try:
+        for record in reader:
+            records.append(record)
+    except csv.Error:
+        pass
+    return records, reader.line_num
+
+
+def ragged_lines(records, width, first_line, limit):
+    ragged = []
+    for offset, record in enumerate(records):
+        if record and len(record) != width:
+            ragged.append({"line": first_line + offset if first_line else None, "fields": len(record)})
+            if len(ragged) >= limit:
+                break
+    return ragged
+
+
+def prescan_csv(report, path, size):
+    sample_bytes = settings.PRESCAN_SAMPLE_BYTES
+    with open(path, "rb") as sheet_file:
+        head = sheet_file.read(sample_bytes)
+        tail = b""
+        if size > 2 * sample_bytes:
+            sheet_file.seek(size - sample_bytes)
+            tail = sheet_file.read()
+    if not head.strip():
+        report.error("empty_file", "The file is empty")
+        return
+
+    encoding = "utf-8"
+    for bom, bom_encoding in UTF_BOMS:
+        if head.startswith(bom):
+            encoding = bom_encoding
+            break
+    report.info["bom"] = encoding != "utf-8"
+    report.info["encoding"] = encoding
+    if encoding not in ("utf-8", "utf-8-sig"):
+        report.error("encoding", "The file is encoded as {}, sheets must be UTF-8".format(encoding))
+        return
+    try:
+        head_text = decode_sample(head, encoding, final=not tail and size <= sample_bytes)
+        # The tail sample starts at an arbitrary byte; continuation bytes of a cut character are skipped.
+        tail_text = decode_sample(tail.lstrip(bytes(range(0x80, 0xc0))), "utf-8", final=True) if tail else ""
+    except UnicodeDecodeError as e:
+        report.error("encoding", "The file is not valid UTF-8 near byte {}".format(e.start), byte=e.start)
+        return
+
+    head_lines = head_text.splitlines(keepends=True)
+    if len(head) == sample_bytes and len(head_lines) > 1:
+        head_lines = head_lines[:-1]
+    records, line_count = parse_records(head_lines)
+    if not records or not records[0]:
+        report.error("missing_header", "The first line of the file is empty")
+        return
+    columns = records[0]
+    report.info["columns"] = len(columns)
+    report.info["delimiter"] = ","
+    if len(columns) == 1:
+        try:
+            dialect = csv.Sniffer().sniff("".join(head_lines[:50]), delimiters=SNIFFED_DELIMITERS)
+        except csv.Error:
+            dialect = None
+        if dialect and dialect.delimiter != "," and len(next(csv.reader(head_lines[:1], dialect), [])) > 1:
+            report.info["delimiter"] = dialect.delimiter
+            report.error("delimiter", "The file is delimited by {!r}, sheets must be comma separated".format(
+                dialect.delimiter), delimiter=dialect.delimiter)
+            return
+    header_problems(report, columns)
+
+    rows = records[1:settings.PRESCAN_SAMPLE_ROWS + 1]
+    report.info["sampled_rows"] = len(rows)
+    # Quoted values spanning lines make line numbers and a tail cut at a line boundary unreliable.
+    multiline = len(records) < line_count
+    ragged = ragged_lines(rows, len(columns), None if multiline else 2, settings.PRESCAN_MAX_REPORTED_ROWS)
+    if tail_text and not multiline:
+        tail_rows = parse_records(tail_text.splitlines(keepends=True)[1:])[0][-settings.PRESCAN_SAMPLE_ROWS:]
+        report.info["sampled_rows"] += len(tail_rows)
+        ragged += ragged_lines(tail_rows, len(columns), None, settings.PRESCAN_MAX_REPORTED_ROWS - len(ragged))
+    if ragged:
+        report.error("ragged_rows", "Sampled rows do not have the {} fields of the header".format(len(columns)),
+                     rows=ragged)
+
+    sampled_bytes = len("".join(head_lines[1:len(rows) + 1]).encode("utf-8"))
+    if rows and sampled_bytes:
+        report.info["estimated_rows"] = int((size - len(head_lines[0].encode("utf-8"))) * len(rows) / sampled_bytes)
+    else:
+        report.info["estimated_rows"] = len(rows)
+
+
+def prescan_xlsx(report, path):
+    if not zipfile.is_zipfile(path):
+        report.error("invalid_workbook", "The file is not an xlsx workbook")
+        return
+    try:
+        workbook = openpyxl.load_workbook(path, read_only=True)
+    except Exception as e:
+        report.error("invalid_workbook", "The workbook cannot be opened: {}".format(e))
+        return
+    try:
+        sheet = workbook.active
+        columns = list(next(sheet.iter_rows(max_row=1, values_only=True), ()))
+        if not columns:
+            report.error("missing_header", "The first row of the worksheet is empty")
+            return
+        report.info["columns"] = len(columns)
+        report.info["estimated_rows"] = max((sheet.max_row or 1) - 1, 0)
+        header_problems(report, columns)
+    finally:
+        workbook.close()
+
+
+def prescan_sheet(path, file_type):
+    """Cheap checks of an extracted sheet that reject files the ingest would fail on or load as garbage.
+
+    Only the first and last PRESCAN_SAMPLE_BYTES of a CSV are read.
+    """
+    size = os.path.getsize(path)
+    report = PrescanReport(file_type, size)
+    if file_type == ".csv":
+        prescan_csv(report, path, size)
+    elif file_type == ".xlsx":
+        prescan_xlsx(report, path)
+    else:
+        report.error("file_type", "Files of type {} cannot be ingested".format(file_type))
+    return report
@@ -0,0 +1,43 @@
+from .columns import resolve_column_keys
+
+
+def generate_match_query(filter_data, column_data):
+    """Builds the $match conditions of the filters on the keys of the filtered columns; raises ColumnOperationError
+    for columns the sheet does not have."""
+    operators_map = {
+        "equals": "$eq",
+        "not equals": "$ne",
+        "greater than": "$gt",
+        "less than": "$lt",
+        "greater than equals": "$gte",
+        "less than equals": "$lte",
+    }
+
+    match_conditions = {}
+    if not filter_data.filter_column:
+        return match_conditions
+    keys = resolve_column_keys(column_data, filter_data.filter_column)
+    for key, value, method in zip(keys, filter_data.value, filter_data.filter_method):
+        operator = operators_map.get(method.lower())
+        if operator:
+            try:
+                value = int(value)
+            except ValueError:
+                try:
+                    value = float(value)
+                except ValueError:
+                    value = value
+
+            condition = {operator: value}
+            match_conditions[f"data.{key}"] = condition
+
+    return match_conditions
+
+
+def sorting_query(filter_schema, column_data):
+    sort_conditions = {}
+    keys = resolve_column_keys(column_data, filter_schema.sort_by_column)
+    for key, order in zip(keys, filter_schema.sort_order):
+        sort_conditions[f"data.{key}"] = order
+
+    return sort_conditions
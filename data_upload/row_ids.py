@@ -0,0 +1,34 @@
+ROW_ID_PREFIX = "R"
+LEGACY_ROW_ID_PREFIX = "SCT"
+DIGITS = "0123456789abcdefghijklmnopqrstuvwxyz"
+
+
+def encode_row_id(ordinal):
+    """Encodes a sheet-local row ordinal, e.g. 0 -> 'R0', 35 -> 'Rz', 36 -> 'R10'.
+
+    Row ids are only unique within a sheet; the sheet itself is identified by sql_ref.
+    """
+    encoded = ""
+    while True:
+        ordinal, remainder = divmod(ordinal, 36)
+        encoded = DIGITS[remainder] + encoded
+        if ordinal == 0:
+            return ROW_ID_PREFIX + encoded
+
+
+def decode_row_id(sct_id):
+    """Returns the ordinal of an encoded row id, or None for legacy SCT ids and anything else."""
+    if not isinstance(sct_id, str) or not sct_id.startswith(ROW_ID_PREFIX):
+        return None
+    encoded = sct_id[len(ROW_ID_PREFIX):]
+    if not encoded or any(digit not in DIGITS for digit in encoded):
+        return None
+    return int(encoded, 36)
+
+
+def row_position(sct_id, chunk_size):
+    """Returns the (chunk_no, offset) a row id was written at when its sheet was written densely."""
+    ordinal = decode_row_id(sct_id)
+    if ordinal is None or not chunk_size:
+        return None
+    return divmod(ordinal, chunk_size)
@@ -0,0 +1,85 @@
+import functools
+import logging
+import time
+
+import redis
+from celery import current_task
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+ACQUIRE_SLOT_SCRIPT = """
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', ARGV[1])
+if redis.call('ZSCORE', KEYS[1], ARGV[3]) or redis.call('ZCARD', KEYS[1]) < tonumber(ARGV[4]) then
+    redis.call('ZADD', KEYS[1], ARGV[2], ARGV[3])
+    redis.call('EXPIRE', KEYS[1], ARGV[5])
+    return 1
+end
+return 0
+"""
+
+_client = None
+
+
+def get_scheduling_client():
+    global _client
+    if _client is None:
+        _client = redis.Redis.from_url(settings.STUDY_SLOT_REDIS_URL)
+    return _client
+
+
+def ingest_priority(size):
+    """Message priority of an upload; smaller files get a higher priority so they are not queued behind large ones.
+
+    RabbitMQ delivers higher priorities first, up to the queues' x-max-priority of 10.
+    """
+    thresholds = settings.INGEST_PRIORITY_THRESHOLDS
+    for index, threshold in enumerate(thresholds):
+        if size <= threshold:
+            return 9 - 2 * index
+    return max(1, 9 - 2 * len(thresholds))
+
+
+def study_slot_key(study_id):
+    return "study_slots:{}".format(study_id)
+
+
+def acquire_study_slot(study_id, token):
+    """Takes one of the study's STUDY_MAX_CONCURRENT_TASKS slots; slots of crashed workers expire on their own."""
+    now = time.time()
+    try:
+        return bool(get_scheduling_client().eval(ACQUIRE_SLOT_SCRIPT, 1, study_slot_key(study_id), now,
+                                                 now + settings.STUDY_SLOT_TIMEOUT, token,
+                                                 settings.STUDY_MAX_CONCURRENT_TASKS, settings.STUDY_SLOT_TIMEOUT))
+    except redis.RedisError as e:
+        logger.error("Could not acquire a slot for study {}, running without one: {}".format(study_id, e))
+        return True
+
+
+def release_study_slot(study_id, token):
+    try:
+        get_scheduling_client().zrem(study_slot_key(study_id), token)
+    except redis.RedisError as e:
+        logger.error("Could not release the slot of study {}: {}".format(study_id, e))
+
+
+def fair_share(study_of):
+    """Runs the task only while its study holds a slot; otherwise the task is retried later, leaving the worker to
+    the other studies' tasks. study_of maps the task arguments to the study id."""
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            task = current_task
+            study_id = study_of(*args, **kwargs)
+            if task is None or not task.request.id or not study_id:
+                return function(*args, **kwargs)
+            token = task.request.id
+            if not acquire_study_slot(study_id, token):
+                logger.info("Study {} is using all of its slots, delaying task {}".format(study_id, token))
+                raise task.retry(countdown=settings.STUDY_SLOT_RETRY_DELAY, max_retries=None)
+            try:
+                return function(*args, **kwargs)
+            finally:
+                release_study_slot(study_id, token)
+        return wrapper
+    return decorator
@@ -1,5 +1,5 @@
 import uuid
-from typing import List, Optional, Any
+from typing import List, Optional, Any, Dict, Union
 
 from ninja import File, UploadedFile
 from pydantic import BaseModel, Field, model_validator
@@ -46,6 +46,7 @@ class SheetUploadDataSchema(UploadDataSchema):
     file_type: Optional[str]
     study_id: UUID
     active: bool
+    revision: int = 0
 
 
 class StudyDataSchema(BaseModel):
@@ -73,7 +74,10 @@ StudyListResponseObject = ResponseObject[List[StudyDataSchema]]
 
 class SingleStudyDataSchema(BaseModel):
     study_data: Optional[StudyDataSchema] = None
-    sheet_uploads: Optional[List[SheetUploadDataSchema]] = None
+    sheet_uploads: Optional[List[Union[SheetUploadDataSchema, Dict[str, Any]]]] = None
+    page: int = 1
+    page_size: Optional[int] = None
+    has_more: bool = False
 
     def __init__(self, study_data: StudyDataSchema, sheet_uploads: List[SheetUploadDataSchema], **data: Any):
         super().__init__(**data)
@@ -83,6 +87,8 @@ class SingleStudyDataSchema(BaseModel):
 
 class ColumnDataSchema(BaseModel):
     name: str
+    key: Optional[str] = None
+    alphabet: Optional[str] = None
     data_type: Optional[str]
     column_index: int
     input_type: str
@@ -91,6 +97,7 @@ class ColumnDataSchema(BaseModel):
     resizable: bool
     visible: bool
     protected: bool
+    sort_indexed: bool = False
 
     class Config:
         from_attributes = True
@@ -107,6 +114,7 @@ class SheetMetadataSchema(BaseModel):
 
 class SheetDataSchema(BaseModel):
     data: List[dict]
+    revision: Optional[int] = None
 
     class Config:
         from_attributes = True
@@ -172,12 +180,202 @@ class FilterSchema(BaseModel):
         return values
 
 
+class AggregationMeasureSchema(BaseModel):
+    function: str
+    column: Optional[str] = None
+    percentile: Optional[float] = None
+    alias: Optional[str] = None
+
+    @model_validator(mode="before")
+    @classmethod
+    def validate_measure(cls, values):
+        function = (values.get('function') or "").lower()
+        if function not in ["count", "sum", "mean", "min", "max", "percentile"]:
+            raise ValueError("function should be one of count, sum, mean, min, max or percentile")
+        if function != "count" and not values.get('column'):
+            raise ValueError("column is required for {} measure".format(function))
+        if function == "percentile":
+            percentile = values.get('percentile')
+            if percentile is None or not 0 <= float(percentile) <= 100:
+                raise ValueError("percentile should be a number between 0 and 100")
+        values['function'] = function
+        return values
+
+
+class AggregationRequestSchema(BaseModel):
+    group_by: List[str] = []
+    measures: List[AggregationMeasureSchema]
+    filter_data: Optional[FilterSchema] = None
+
+    @model_validator(mode="before")
+    @classmethod
+    def check_required_data(cls, values):
+        if not values.get('measures'):
+            raise ValueError("At least one measure is required")
+        return values
+
+
+class AggregationResultSchema(BaseModel):
+    group_by: List[str] = []
+    measures: List[str] = []
+    rows: List[dict] = []
+    revision: int = 0
+    cached: bool = False
+
+
+class DistinctValueSchema(BaseModel):
+    value: Optional[Any] = None
+    count: int
+
+
+class DistinctValuesSchema(BaseModel):
+    column: str
+    values: List[DistinctValueSchema] = []
+    from_dictionary: bool = False
+
+
+class SearchHitSchema(BaseModel):
+    sheet_id: UUID
+    sct_id: str
+    column: Optional[str] = None
+    snippet: Optional[str] = None
+    score: float = 0
+
+
+class SearchResultsSchema(BaseModel):
+    query: str
+    page: int
+    page_size: int
+    has_more: bool = False
+    results: List[SearchHitSchema] = []
+
+
+class JoinRequestSchema(BaseModel):
+    sheet_ids: List[UUID]
+    join_keys: List[str] = ["USUBJID"]
+    join_type: str = "inner"
+    filters: Optional[List[Optional[FilterSchema]]] = None
+
+    @model_validator(mode="before")
+    @classmethod
+    def validate_join_data(cls, values):
+        sheet_ids = values.get('sheet_ids') or []
+        if len(sheet_ids) < 2:
+            raise ValueError("At least two sheet_ids are required for a join")
+        if len(set(sheet_ids)) != len(sheet_ids):
+            raise ValueError("sheet_ids should not contain duplicates")
+        if 'join_keys' in values and not values.get('join_keys'):
+            raise ValueError("At least one join key is required")
+        if values.get('join_type', "inner") not in ["inner", "left", "outer"]:
+            raise ValueError("join_type should be one of inner, left or outer")
+        filters = values.get('filters')
+        if filters and len(filters) != len(sheet_ids):
+            raise ValueError("filters and sheet_ids should have same length")
+        return values
+
+
+class SavedQueryRequestSchema(BaseModel):
+    name: str
+    sheet_id: UUID
+    filter_data: FilterSchema
+
+
+class SavedQuerySchema(BaseModel):
+    id: UUID
+    name: str
+    study_id: UUID
+    source_file_name: str
+    source_sheet_id: Optional[UUID] = None
+    source_revision: int
+    result_sheet_id: Optional[UUID] = None
+    filter_data: dict
+    status: DataImportStatusEnum
+    created_date_time: datetime
+    last_refresh_date_time: Optional[datetime] = None
+    stale: bool
+
+    class Config:
+        from_attributes = True
+
+
+class SortIndexSchema(BaseModel):
+    column: str
+    status: str
+    row_count: int = 0
+    built_date_time: Optional[datetime] = None
+
+    class Config:
+        from_attributes = True
+
+
+class ConnectionMetricsSchema(BaseModel):
+    mongo: dict
+    postgres: dict
+    blob: dict
+
+
+class EditJournalSchema(BaseModel):
+    revision: Optional[int] = None
+    sct_id: str
+    column: str
+    old_value: Any = None
+    new_value: Any = None
+    action: str
+    reverts: Optional[int] = None
+    user_id: Optional[str] = None
+    edit_date_time: Optional[datetime] = None
+
+    class Config:
+        from_attributes = True
+
+
+class BulkEditRequestSchema(BaseModel):
+    key_column: Optional[str] = "sct_id"
+
+
+class BulkEditJobSchema(BaseModel):
+    id: UUID
+    sheet_id: UUID
+    original_file_name: str
+    key_column: str
+    status: DataImportStatusEnum
+    additional_info: Optional[str] = None
+    total_rows: int = 0
+    processed_rows: int = 0
+    applied_cells: int = 0
+    error_count: int = 0
+    revision: Optional[int] = None
+    created_date_time: datetime
+    finished_date_time: Optional[datetime] = None
+
+    class Config:
+        from_attributes = True
+
+
 SingleStudyResponseObject = ResponseObject[SingleStudyDataSchema]
 
 SheetMetadataResponseObject = ResponseObject[SheetMetadataSchema]
 
 SheetDataResponseObject = ResponseObject[SheetDataSchema]
 
+AggregationResponseObject = ResponseObject[AggregationResultSchema]
+
+DistinctValuesResponseObject = ResponseObject[DistinctValuesSchema]
+
+SearchResponseObject = ResponseObject[SearchResultsSchema]
+
+SavedQueryResponseObject = ResponseObject[SavedQuerySchema]
+
+SavedQueryListResponseObject = ResponseObject[List[SavedQuerySchema]]
+
+SortIndexListResponseObject = ResponseObject[List[SortIndexSchema]]
+
+ConnectionMetricsResponseObject = ResponseObject[ConnectionMetricsSchema]
+
+EditJournalResponseObject = ResponseObject[List[EditJournalSchema]]
+
+BulkEditJobResponseObject = ResponseObject[BulkEditJobSchema]
+
 
 class UpdatedDataSchema(BaseModel):
     sct_id: str
@@ -194,6 +392,14 @@ class SheetUpdateRequestSchema(BaseModel):
     newcolumn: bool
 
 
+class ColumnRenameRequestSchema(BaseModel):
+    name: str
+
+
+class ColumnOrderRequestSchema(BaseModel):
+    columns: List[str]
+
+
 class CustomColumnDataSchema(BaseModel):
     id: UUID
     sheet_id_id: UUID
@@ -0,0 +1,92 @@
+import logging
+import re
+
+import pymongo
+from django.conf import settings
+
+from .models import SearchDocument
+from .columns import column_attribute, column_key, live_columns
+
+logger = logging.getLogger(__name__)
+
+
+def searchable_columns(column_data):
+    return [column_key(column) for column in live_columns(column_data)
+            if column_attribute(column, "data_type") == "string" and column_key(column) != "sct_id"]
+
+
+def search_document(study_id, sql_ref, sct_id, cells):
+    return {
+        "study_id": study_id,
+        "sql_ref": sql_ref,
+        "sct_id": sct_id,
+        "cells": cells,
+        "content": " ".join(value for value in cells.values() if value),
+    }
+
+
+class SearchIndexBuilder:
+    """Writes one search document per row holding the string-typed cells of the row."""
+
+    def __init__(self, study_id, sql_ref, columns):
+        self.study_id = str(study_id)
+        self.sql_ref = str(sql_ref)
+        self.columns = columns
+        self.documents = []
+        self.count = 0
+
+    def add(self, row):
+        if not self.columns:
+            return
+        cells = {column: str(row[column]) for column in self.columns if row.get(column) not in (None, "")}
+        if cells:
+            self.documents.append(search_document(self.study_id, self.sql_ref, row["sct_id"], cells))
+
+    def flush(self):
+        if self.documents:
+            SearchDocument._get_collection().insert_many(self.documents, ordered=False)
+            self.count += len(self.documents)
+            self.documents = []
+
+
+def update_search_documents(study_id, sql_ref, column, new_values):
+    collection = SearchDocument._get_collection()
+    existing = {document["sct_id"]: document for document in
+                collection.find({"sql_ref": sql_ref, "sct_id": {"$in": list(new_values.keys())}},
+                                {"sct_id": 1, "cells": 1})}
+    operations = []
+    for sct_id, value in new_values.items():
+        cells = existing[sct_id].get("cells", {}) if sct_id in existing else {}
+        if value in (None, ""):
+            cells.pop(column, None)
+        else:
+            cells[column] = str(value)
+        document = search_document(str(study_id), sql_ref, sct_id, cells)
+        operations.append(pymongo.ReplaceOne({"sql_ref": sql_ref, "sct_id": sct_id}, document, upsert=True))
+    if operations:
+        collection.bulk_write(operations, ordered=False)
+    logger.info("Updated {} search documents for column {} of sheet {}".format(len(operations), column, sql_ref))
+
+
+def query_terms(query):
+    return [term.lower() for term in re.findall(r"[\w-]+", query) if not term.startswith("-")]
+
+
+def build_snippet(cells, terms, width=None):
+    width = width or settings.SEARCH_SNIPPET_WIDTH
+    for column, value in cells.items():
+        lowered = value.lower()
+        for term in terms:
+            position = lowered.find(term)
+            if position < 0:
+                continue
+            start = max(position - width, 0)
+            end = min(position + len(term) + width, len(value))
+            snippet = value[start:end]
+            if start > 0:
+                snippet = "..." + snippet
+            if end < len(value):
+                snippet = snippet + "..."
+            return column, snippet
+    column, value = next(iter(cells.items()), (None, ""))
+    return column, value[:2 * width]
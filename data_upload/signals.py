@@ -0,0 +1,4 @@
+from django.dispatch import Signal
+
+# Sent with sheet_id and sql_ref whenever a sheet record or its column metadata changes.
+sheet_changed = Signal()
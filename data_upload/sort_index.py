@@ -0,0 +1,139 @@
+import logging
+import uuid
+
+from django.conf import settings
+from django.utils import timezone
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+from .models import SortIndex, SortIndexEntry, SortIndexStatusEnum, MongoDbClient
+from .mongo import get_async_collection
+
+logger = logging.getLogger(__name__)
+
+
+def request_sort_index_build(sql_ref, column):
+    """Marks the sort index of a column as queued, returns False if a build is already queued, running or done."""
+    collection = SortIndex._get_collection()
+    try:
+        result = collection.update_one(
+            {"sql_ref": sql_ref, "column": column,
+             "status": {"$in": [SortIndexStatusEnum.STALE.value, SortIndexStatusEnum.FAILED.value]}},
+            {"$set": {"status": SortIndexStatusEnum.QUEUED.value}})
+        if result.modified_count:
+            return True
+        collection.insert_one({"sql_ref": sql_ref, "column": column, "status": SortIndexStatusEnum.QUEUED.value,
+                               "row_count": 0})
+        return True
+    except DuplicateKeyError:
+        return False
+
+
+def invalidate_sort_indexes(sql_ref, columns):
+    SortIndex._get_collection().update_many({"sql_ref": sql_ref, "column": {"$in": list(columns)}},
+                                            {"$set": {"status": SortIndexStatusEnum.STALE.value}})
+
+
+def build_sort_index(sql_ref, column):
+    """Builds the sort index of a column under a new build id.
+
+    Entries are tagged with the build that wrote them and reads only follow the entries of the build marked READY,
+    so a superseded build still running cannot mix its rows into a newer one. A build that finds itself superseded
+    removes its own entries; the one that becomes READY removes those of every older build.
+    """
+    collection = SortIndex._get_collection()
+    build_id = str(uuid.uuid4())
+    sort_index = collection.find_one_and_update(
+        {"sql_ref": sql_ref, "column": column},
+        {"$set": {"status": SortIndexStatusEnum.BUILDING.value, "build_id": build_id}, "$inc": {"build_number": 1}},
+        upsert=True, return_document=ReturnDocument.AFTER)
+    build_number = sort_index["build_number"]
+    entries = SortIndexEntry._get_collection()
+    pipeline = [
+        {"$match": {"sql_ref": sql_ref}},
+        {"$project": {"data.sct_id": 1, "data.{}".format(column): 1}},
+        {"$unwind": "$data"},
+        {"$sort": {"data.{}".format(column): 1, "data.sct_id": 1}},
+        {"$project": {"_id": 0, "chunk_id": "$_id", "sct_id": "$data.sct_id"}},
+    ]
+    batch = []
+    position = 0
+    for row in MongoDbClient.objects.aggregate(pipeline, allowDiskUse=True):
+        batch.append({"sql_ref": sql_ref, "column": column, "build_id": build_id, "build_number": build_number,
+                      "position": position, "sct_id": row["sct_id"], "chunk_id": row["chunk_id"]})
+        position += 1
+        if len(batch) >= settings.SORT_INDEX_BATCH_SIZE:
+            entries.insert_many(batch, ordered=False)
+            batch = []
+    if batch:
+        entries.insert_many(batch, ordered=False)
+    result = collection.update_one(
+        {"sql_ref": sql_ref, "column": column, "build_id": build_id, "status": SortIndexStatusEnum.BUILDING.value},
+        {"$set": {"status": SortIndexStatusEnum.READY.value, "row_count": position,
+                  "built_date_time": timezone.now()}})
+    if not result.modified_count:
+        logger.info("Sort index of column {} for sheet {} was invalidated while building".format(column, sql_ref))
+        entries.delete_many({"sql_ref": sql_ref, "column": column, "build_id": build_id})
+        return position
+    entries.delete_many({"sql_ref": sql_ref, "column": column,
+                         "$or": [{"build_number": {"$lt": build_number}}, {"build_number": {"$exists": False}}]})
+    logger.info("Built sort index of column {} for sheet {} with {} rows".format(column, sql_ref, position))
+    return position
+
+
+def sorted_page_positions(row_count, order, skip, limit):
+    if order == 1:
+        return skip, skip + limit
+    return max(row_count - skip - limit, 0), row_count - skip
+
+
+def sorted_rows_pipeline(index_entries):
+    return [
+        {"$match": {"_id": {"$in": list({entry["chunk_id"] for entry in index_entries})}}},
+        {"$unwind": "$data"},
+        {"$match": {"data.sct_id": {"$in": [entry["sct_id"] for entry in index_entries]}}},
+        {"$replaceRoot": {"newRoot": "$data"}},
+    ]
+
+
+def order_sorted_rows(sql_ref, column, index_entries, rows):
+    sct_ids = [entry["sct_id"] for entry in index_entries]
+    rows = {row["sct_id"]: row for row in rows}
+    if len(rows) != len(sct_ids):
+        logger.info("Sort index of column {} for sheet {} is out of date".format(column, sql_ref))
+        return None
+    return [rows[sct_id] for sct_id in sct_ids]
+
+
+async def amark_sort_index_stale(sql_ref, column, build_id):
+    # Only the build that was read is marked, a newer build queued in the meantime is left alone.
+    await get_async_collection(SortIndex).update_one(
+        {"sql_ref": sql_ref, "column": column, "build_id": build_id, "status": SortIndexStatusEnum.READY.value},
+        {"$set": {"status": SortIndexStatusEnum.STALE.value}})
+
+
+async def aread_sorted_page(sql_ref, column, order, skip, limit):
+    """Reads a page through the READY sort index of a column; returns None and marks the index STALE when its
+    entries no longer match the sheet's rows, so the next read queues a rebuild."""
+    sort_index = await get_async_collection(SortIndex).find_one(
+        {"sql_ref": sql_ref, "column": column, "status": SortIndexStatusEnum.READY.value},
+        {"row_count": 1, "build_id": 1})
+    if not sort_index:
+        return None
+    row_count = sort_index["row_count"]
+    start, end = sorted_page_positions(row_count, order, skip, limit)
+    if end <= start:
+        return []
+    index_entries = await get_async_collection(SortIndexEntry).find(
+        {"sql_ref": sql_ref, "column": column, "build_id": sort_index.get("build_id"),
+         "position": {"$gte": start, "$lt": end}},
+        {"_id": 0, "sct_id": 1, "chunk_id": 1}).sort("position", 1).to_list(None)
+    if order != 1:
+        index_entries.reverse()
+    rows = await get_async_collection(MongoDbClient).aggregate(sorted_rows_pipeline(index_entries)).to_list(None)
+    sorted_rows = None
+    if len(index_entries) == min(end, row_count) - start:
+        sorted_rows = order_sorted_rows(sql_ref, column, index_entries, rows)
+    if sorted_rows is None:
+        await amark_sort_index_stale(sql_ref, column, sort_index.get("build_id"))
+    return sorted_rows
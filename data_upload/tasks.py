@@ -1,21 +1,61 @@
+import itertools
 import json
 import os
-import csv
 import shutil
 import uuid
 import zipfile
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
-from azure.storage.blob import BlobServiceClient
+
+import pymongo
 from celery import shared_task
-from .models import ZipUploadData, SheetUploadData, MongoDbClient, DataImportStatusEnum, SheetMetaData
+from celery.exceptions import Ignore
+from mongoengine.errors import NotUniqueError
+from django.db import transaction
+from django.db.models import Max
+from django.utils import timezone
+from .models import ZipUploadData, SheetUploadData, MongoDbClient, DataImportStatusEnum, SheetMetaData, \
+    SearchDocument, SavedQuery, SortIndex, SortIndexStatusEnum, SortIndexEntry, ColumnDictionary, EditJournal, \
+    BulkEditJob
+from .column_dictionary import ColumnDictionaryBuilder
+from .search import SearchIndexBuilder, searchable_columns
+from .columns import column_letter, column_key, column_match, find_column, live_columns, resolve_column_keys
+from .joins import PartitionedHashJoin
+from .editing import create_chunk, drop_row_locations, rebuild_row_locations, compact_edit_journal, write_row_edits, \
+    recompute_edited_formulas, new_pending_edit, publish_edits, discard_edits, reap_abandoned_edits
+from .bulk_edit import BulkEditError, BulkEditReport, read_patch_rows, natural_key_rows
+from .parsers import open_sheet_reader
+from .prescan import prescan_sheet
+from .row_ids import encode_row_id
+from .sort_index import build_sort_index, request_sort_index_build, invalidate_sort_indexes
+from .formulas import recompute_order, compile_formula_columns, formula_update_pipeline, FormulaError
+from .queries import generate_match_query, sorting_query
+from .schemas import FilterSchema
+from .signals import sheet_changed
+from .scheduling import fair_share
+from .workspaces import Workspace, ScratchQuotaExceeded, reap_workspaces
 from django.conf import settings
+from clinical_analytics.connections import get_blob_service_client
 import logging
-import openpyxl
 
 logger = logging.getLogger(__name__)
 
 
+def upload_study_id(zip_upload_id=None, sheet_id=None, *args, **kwargs):
+    if zip_upload_id:
+        return ZipUploadData.objects.filter(id=zip_upload_id).values_list('study_id', flat=True).first()
+    if sheet_id:
+        return SheetUploadData.objects.filter(id=sheet_id).values_list('study_id', flat=True).first()
+    return None
+
+
+def bulk_edit_study_id(bulk_edit_id, *args, **kwargs):
+    return BulkEditJob.objects.filter(id=bulk_edit_id).values_list('sheet__study_id', flat=True).first()
+
+
 @shared_task
+@fair_share(upload_study_id)
 def download_file(zip_upload_id, sheet_id, queue='tasks'):
     if not sheet_id and not zip_upload_id:
         logger.error("File upload id or sheet id not found in the request")
@@ -30,35 +70,41 @@ def download_file(zip_upload_id, sheet_id, queue='tasks'):
     logger.info("Downloading file {}".format(upload_data.original_file_name))
     upload_data.status = DataImportStatusEnum.DOWNLOADED
 
-    download_path = settings.TEMP_FILE_PATH + "/" + str(upload_data.study_id)
-    if not os.path.exists(download_path):
-        os.makedirs(download_path)
-        logger.info("Directory created for file download at {}".format(download_path))
+    workspace = Workspace("uploads", zip_upload_id or sheet_id)
     if sheet_id:
-        download_path = os.path.join(download_path, "extracted_files")
-        if not os.path.exists(download_path):
-            os.makedirs(download_path)
-        logger.info("Directory created for file download at {}".format(download_path))
         extension = os.path.splitext(upload_data.original_file_name)[1]
         upload_data.file_type = extension
         logger.info("Extension of the file is {}".format(extension))
-        sheet_ref = str(upload_data.id) + extension
-        download_path = os.path.join(download_path, sheet_ref)
+        workspace.makedirs("extracted_files")
+        file_name = os.path.join("extracted_files", str(upload_data.id) + extension)
+        download_path = workspace.join(file_name)
         logger.info("Download path for the file is {}".format(download_path))
     else:
-        download_path = os.path.join(download_path, upload_data.original_file_name)
+        file_name = upload_data.original_file_name
+        download_path = workspace.join(file_name)
         logger.info("Download path for the zip file is {}".format(download_path))
 
     try:
-        blob_service_client = BlobServiceClient.from_connection_string(settings.AZURE_STORAGE_CONNECTION_STRING)
+        blob_service_client = get_blob_service_client()
         blob_client = blob_service_client.get_blob_client(container=settings.AZURE_STORAGE_CONTAINER_NAME,
                                                           blob=upload_data.date_lake_url)
+        download_stream = blob_client.download_blob()
+        workspace.reserve(file_name, download_stream.size)
         with open(download_path, "wb") as my_blob:
             logger.info("Downloading file from Azure Storage")
-            download_stream = blob_client.download_blob()
-            my_blob.write(download_stream.readall())
+            download_stream.readinto(my_blob)
         logger.info("File downloaded successfully")
         upload_data.save()
+    except ScratchQuotaExceeded as e:
+        if e.retryable:
+            logger.info("Delaying download of {}: {}".format(upload_data.original_file_name, e))
+            raise download_file.retry(countdown=settings.SCRATCH_QUOTA_RETRY_DELAY, max_retries=None)
+        logger.error("Error while downloading file: {}".format(e))
+        upload_data.status = DataImportStatusEnum.FAILURE
+        upload_data.additional_info = str(e)
+        upload_data.save()
+        workspace.remove()
+        return
     except Exception as e:
         logger.error("Error while downloading file from Azure Storage: {}".format(e))
         upload_data.status = DataImportStatusEnum.FAILURE
@@ -69,6 +115,7 @@ def download_file(zip_upload_id, sheet_id, queue='tasks'):
 
 
 @shared_task
+@fair_share(upload_study_id)
 def process_zip_file(zip_upload_id, queue='tasks'):
     if not zip_upload_id:
         logger.error("File upload id not found in the request")
@@ -80,57 +127,163 @@ def process_zip_file(zip_upload_id, queue='tasks'):
         return
 
     zip_upload_data.status = DataImportStatusEnum.UNZIP_COMPLETED
-    zip_dir_path = os.path.join(settings.TEMP_FILE_PATH, str(zip_upload_data.study_id))
-    zip_file_path = os.path.join(zip_dir_path, zip_upload_data.original_file_name)
-    sheet_dir_path = os.path.join(zip_dir_path, "extracted_files")
-    if not os.path.exists(sheet_dir_path):
-        os.makedirs(sheet_dir_path)
-        logger.info("Directory created for extracted files at {}".format(sheet_dir_path))
+    workspace = Workspace("uploads", zip_upload_id)
+    zip_file_path = workspace.join(zip_upload_data.original_file_name)
+    sheet_dir_path = workspace.makedirs("extracted_files")
 
     with zipfile.ZipFile(str(zip_file_path), 'r') as zip_ref:
-        for file_name in zip_ref.namelist():
-            if file_name.endswith('.csv') or file_name.endswith('.xlsx'):
-                file_extension = os.path.splitext(file_name)[1]
-                unique_ref = str(uuid.uuid4())
-                existing_file = SheetUploadData.objects.filter(original_file_name=file_name,
-                                                               study_id=zip_upload_data.study_id, active=True)
-                version_number = 1
-                if existing_file:
-                    version_number = existing_file.latest('version_number').version_number + 1
-                sheet_upload_data = SheetUploadData.objects.create(
-                    zip_upload_id=zip_upload_id,
-                    original_file_name=file_name,
-                    unique_reference=unique_ref,
-                    version_number=version_number,
-                    uploaded_by=zip_upload_data.uploaded_by,
-                    status=DataImportStatusEnum.UPLOADED,
-                    file_type=file_extension,
-                    study_id=zip_upload_data.study_id,
-                    active=False
-                )
-                logger.info("Sheet file {} created with unique reference {}".format(file_name, unique_ref))
-                new_file_path = os.path.join(sheet_dir_path, str(sheet_upload_data.id) + file_extension)
-                source = zip_ref.open(file_name)
-                target = open(new_file_path, "wb")
-                logger.info("Extracting file {} to {}".format(file_name, new_file_path))
+        try:
+            workspace.reserve("extracted_files", sum(member.file_size for member in zip_ref.infolist()
+                                                     if member.filename.endswith(('.csv', '.xlsx'))))
+        except ScratchQuotaExceeded as e:
+            if e.retryable:
+                logger.info("Delaying extraction of {}: {}".format(zip_upload_data.original_file_name, e))
+                raise process_zip_file.retry(countdown=settings.SCRATCH_QUOTA_RETRY_DELAY, max_retries=None)
+            logger.error("Error while extracting zip file: {}".format(e))
+            zip_upload_data.status = DataImportStatusEnum.FAILURE
+            zip_upload_data.additional_info = str(e)
+            zip_upload_data.save()
+            workspace.remove()
+            return
+        members = [file_name for file_name in zip_ref.namelist() if file_name.endswith(('.csv', '.xlsx'))]
+        sheets = register_zip_sheets(zip_upload_data, members)
+        failed = []
+        with ThreadPoolExecutor(max_workers=settings.ZIP_EXTRACT_THREADS) as executor:
+            futures = {executor.submit(extract_zip_member, zip_ref, sheet.original_file_name,
+                                       os.path.join(sheet_dir_path, str(sheet.id) + sheet.file_type)): sheet
+                       for sheet in sheets}
+            for future in as_completed(futures):
                 try:
-                    with source, target:
-                        target.write(source.read())
+                    future.result()
                 except Exception as e:
-                    logger.error("Error while extracting file: {}".format(e))
-                    sheet_upload_data.status = DataImportStatusEnum.FAILURE
-                    sheet_upload_data.save()
-                    continue
+                    logger.error("Error while extracting file {}: {}".format(futures[future].original_file_name, e))
+                    failed.append(futures[future].id)
+        if failed:
+            SheetUploadData.objects.filter(id__in=failed).update(status=DataImportStatusEnum.FAILURE)
     zip_upload_data.save()
     return zip_upload_id
 
 
+def register_zip_sheets(zip_upload_data, file_names):
+    """Creates the sheet rows of a zip's members with one version query and one insert.
+
+    Members registered by an earlier delivery of the same task are reused rather than created again.
+    """
+    registered = {sheet.original_file_name: sheet
+                  for sheet in SheetUploadData.objects.filter(zip_upload=zip_upload_data.id)}
+    new_names = [file_name for file_name in file_names if file_name not in registered]
+    latest_versions = dict(SheetUploadData.objects.filter(
+        study_id=zip_upload_data.study_id, original_file_name__in=new_names, active=True
+    ).values('original_file_name').annotate(latest=Max('version_number')).values_list('original_file_name', 'latest'))
+    new_sheets = [SheetUploadData(
+        zip_upload_id=zip_upload_data.id,
+        original_file_name=file_name,
+        unique_reference=str(uuid.uuid4()),
+        version_number=latest_versions.get(file_name, 0) + 1,
+        uploaded_by=zip_upload_data.uploaded_by,
+        status=DataImportStatusEnum.UPLOADED,
+        file_type=os.path.splitext(file_name)[1],
+        study_id=zip_upload_data.study_id,
+        active=False
+    ) for file_name in new_names]
+    with transaction.atomic():
+        SheetUploadData.objects.bulk_create(new_sheets)
+    logger.info("Registered {} sheet files of zip {}".format(len(new_sheets), zip_upload_data.id))
+    registered.update((sheet.original_file_name, sheet) for sheet in new_sheets)
+    return [registered[file_name] for file_name in file_names]
+
+
+def extract_zip_member(zip_ref, file_name, target_path):
+    # Members are decompressed in parallel threads; the archive file itself is shared under zipfile's lock.
+    logger.info("Extracting file {} to {}".format(file_name, target_path))
+    with zip_ref.open(file_name) as source, open(target_path, "wb") as target:
+        shutil.copyfileobj(source, target, settings.ZIP_EXTRACT_BUFFER_SIZE)
+
+
+@shared_task
+def prescan_file(upload_id, is_zip=False, queue='tasks'):
+    """Rejects unusable sheet files before they are ingested.
+
+    Returns the upload id for the next task of the chain. A rejected single sheet upload stops the chain, since
+    there is nothing left to ingest.
+    """
+    if not upload_id:
+        logger.error("File upload id not found in the request")
+        return
+    workspace = Workspace("uploads", upload_id)
+    if is_zip:
+        sheets = SheetUploadData.objects.filter(zip_upload=upload_id).exclude(
+            status__in=[DataImportStatusEnum.SUCCESS, DataImportStatusEnum.FAILURE])
+    else:
+        sheets = SheetUploadData.objects.filter(id=upload_id)
+    rejected = 0
+    for sheet_data in sheets:
+        file_path = workspace.join("extracted_files", str(sheet_data.id) + sheet_data.file_type)
+        if not os.path.exists(file_path):
+            continue
+        report = prescan_sheet(file_path, sheet_data.file_type)
+        sheet_data.additional_info = json.dumps(report.dict())
+        if not report.valid:
+            logger.error("Rejected sheet file {} with id {}: {}".format(
+                sheet_data.original_file_name, sheet_data.id, [error["code"] for error in report.errors]))
+            sheet_data.status = DataImportStatusEnum.FAILURE
+            os.remove(file_path)
+            rejected += 1
+        sheet_data.save(update_fields=['status', 'additional_info'])
+    if rejected and not is_zip:
+        workspace.remove()
+        raise Ignore()
+    return upload_id
+
+
+def sheet_study_id(sheet_id, *args, **kwargs):
+    return upload_study_id(None, sheet_id)
+
+
 @shared_task
+@fair_share(sheet_study_id)
 def wrapper_process_csv_file(sheet_id):
     return process_csv_file(None, sheet_id)
 
 
+def sheet_column_data(columns, first_row):
+    column_data = []
+    for index, column in enumerate(columns):
+        sample_data = first_row[column] if first_row else ""
+        column_data.append({"name": column, "key": column, "data_type": infer_data_type(sample_data),
+                            "column_index": index + 1, "alphabet": column_letter(index + 1)})
+    column_data.append(
+        {"name": "sct_id", "key": "sct_id", "data_type": "string", "column_index": 0, "visible": False,
+         "alphabet": 'A'})
+    return column_data
+
+
+def checkpoint_ingest(sheet_metadata, ingested_rows, position):
+    SheetMetaData.objects(id=sheet_metadata.id).update_one(set__ingested_rows=ingested_rows,
+                                                           set__ingest_position=position)
+
+
+def discard_uncommitted_chunks(sheet_metadata, dictionary_builder):
+    """Prepares a redelivered ingest to continue after its last checkpoint.
+
+    Whatever an interrupted delivery wrote past the checkpoint is removed, and the value counts of the committed
+    rows are read back, since the column dictionaries are only saved once the whole sheet is in.
+    """
+    sql_ref = sheet_metadata.sql_ref
+    chunk_size = sheet_metadata.chunk_size or settings.ITER_CHUNK_SIZE
+    ingested_rows = sheet_metadata.ingested_rows
+    committed_chunks = -(-ingested_rows // chunk_size)
+    MongoDbClient.objects(sql_ref=sql_ref, chunk_no__gte=committed_chunks).delete()
+    SearchDocument.objects(sql_ref=sql_ref, sct_id__in=[
+        encode_row_id(index) for index in range(ingested_rows, ingested_rows + chunk_size)]).delete()
+    for chunk in MongoDbClient._get_collection().find({"sql_ref": sql_ref, "chunk_no": {"$lt": committed_chunks}},
+                                                      {"_id": 0, "data": 1}):
+        for row in chunk.get("data", []):
+            dictionary_builder.add(row)
+
+
 @shared_task
+@fair_share(upload_study_id)
 def process_csv_file(zip_upload_id, sheet_id, queue='tasks'):
     logger.info("Processing csv file with zip id {} and sheet id {}".format(zip_upload_id, sheet_id))
     if not zip_upload_id and not sheet_id:
@@ -151,87 +304,115 @@ def process_csv_file(zip_upload_id, sheet_id, queue='tasks'):
     if len(sheet_data_list) <= 0:
         logger.error("No sheet data found for processing")
         return
-    main_dir_path = os.path.join(settings.TEMP_FILE_PATH, str(upload_data.study_id))
-    sheet_dir_path = os.path.join(main_dir_path, "extracted_files")
-    chunk_size = settings.ITER_CHUNK_SIZE
+    workspace = Workspace("uploads", zip_upload_id or sheet_id)
+    sheet_dir_path = workspace.join("extracted_files")
     for sheet_data in sheet_data_list:
         csv_file_path = os.path.join(sheet_dir_path, str(sheet_data.id) + sheet_data.file_type)
         logger.info("Processing sheet file {} with id {}".format(sheet_data.original_file_name, sheet_data.id))
+        if sheet_data.status == DataImportStatusEnum.SUCCESS:
+            logger.info("Sheet {} was already ingested by an earlier delivery".format(sheet_data.id))
+            continue
+        if sheet_data.status == DataImportStatusEnum.FAILURE:
+            logger.info("Skipping sheet {} that failed extraction or pre-scan".format(sheet_data.id))
+            continue
         if os.path.exists(csv_file_path):
-            data = []
-            column_data = []
-            alphabet = 'B'
-            if sheet_data.file_type == ".csv":
-                with open(csv_file_path, newline='', encoding='utf-8') as csvfile:
-                    csv_reader = csv.DictReader(csvfile)
-                    data = [row for row in csv_reader]
-
-                    for index, column in enumerate(csv_reader.fieldnames):
-                        sample_data = data[0][column] if data else ""
-                        data_type = infer_data_type(sample_data)
-                        column_data.append(
-                            {"name": column, "data_type": data_type, "column_index": index + 1, "alphabet": alphabet})
-                        alphabet = chr(ord(alphabet) + 1)
-            elif sheet_data.file_type == ".xlsx":
-                wb = openpyxl.load_workbook(csv_file_path)
-                sheet = wb.active
-                columns = []
-                for i, row in enumerate(sheet.iter_rows(values_only=True)):
-                    if i == 0:
-                        columns = row
-                        column_data = [{"name": column, "column_index": index + 1, "alphabet": alphabet} for
-                                       index, column in
-                                       enumerate(columns)]
-                        alphabet = chr(ord(alphabet) + 1)
-                    else:
-                        row_data = {columns[j]: value for j, value in enumerate(row)}
-                        data.append(row_data)
-                for column in column_data:
-                    sample_data = data[0][column["name"]] if data else ""
-                    data_type = infer_data_type(sample_data)
-                    column["data_type"] = data_type
-            else:
+            sql_ref = str(sheet_data.unique_reference)
+            sheet_metadata = SheetMetaData.objects(sql_ref=sql_ref).first()
+            resuming = sheet_metadata is not None
+            # A resumed ingest keeps the backend its checkpoint position belongs to.
+            reader = open_sheet_reader(csv_file_path, sheet_data.file_type,
+                                       (sheet_metadata.ingest_parser or "python") if resuming else None)
+            if reader is None:
                 logger.error("Invalid file type for processing: {}".format(sheet_data.file_type))
                 sheet_data.status = DataImportStatusEnum.FAILURE
                 sheet_data.save()
                 continue
-            column_data.append(
-                {"name": "sct_id", "data_type": "string", "column_index": 0, "visible": False, "alphabet": 'A'})
-            sheet_metadata = SheetMetaData.objects.create(
-                sql_ref=str(sheet_data.unique_reference),
-                column_data=column_data
-            )
-            data_chunk = []
-            logger.info("Processing data in chunks of size {}".format(chunk_size))
-            index = 0
-            for row in data:
-                row["sct_id"] = "SCT" + str(uuid.uuid4())
-
-                data_chunk.append(row)
-                index += 1
-
-                if index % chunk_size == 0:
-                    logger.info(row)
-                    MongoDbClient.objects.create(
-                        sql_ref=str(sheet_data.unique_reference),
-                        meta_data=sheet_metadata,
-                        data=data_chunk
-                    )
-                    data_chunk = []
-
-            if len(data_chunk) > 0:
-                MongoDbClient.objects.create(
-                    sql_ref=str(sheet_data.unique_reference),
-                    meta_data=sheet_metadata,
-                    data=data_chunk
-                )
+            logger.info("Parsing sheet {} with the {} parser".format(sheet_data.id, reader.backend))
+            with reader:
+                if resuming:
+                    rows = reader.rows(sheet_metadata.ingest_position)
+                    sort_indexed_columns = {column_key(column) for column in live_columns(sheet_metadata.column_data)
+                                            if column.sort_indexed}
+                else:
+                    rows = reader.rows()
+                    first_row = next(rows, None)
+                    if first_row is not None:
+                        rows = itertools.chain([first_row], rows)
+                    column_data = sheet_column_data(reader.columns, first_row)
+                    sort_indexed_columns = previous_sort_indexed_columns(sheet_data)
+                    for column in column_data:
+                        if column["name"] in sort_indexed_columns:
+                            column["sort_indexed"] = True
+                    try:
+                        sheet_metadata = SheetMetaData.objects.create(
+                            sql_ref=sql_ref,
+                            column_data=column_data,
+                            chunk_size=settings.ITER_CHUNK_SIZE,
+                            ingest_parser=reader.backend
+                        )
+                    except NotUniqueError:
+                        # A concurrent delivery of this task started the sheet between the lookup and the create.
+                        # Both deliveries walk the same sheets of the same upload, so the other one owns the whole
+                        # zip: the remaining sheets, the zip status and the workspace. Returning leaves all of them
+                        # to it, and leaving the with block closes this reader. A redelivery resumes from the
+                        # checkpoints if the other one dies.
+                        logger.info("Sheet {} is being ingested by another delivery".format(sheet_data.id))
+                        return
+                chunk_size = sheet_metadata.chunk_size or settings.ITER_CHUNK_SIZE
+                dictionary_builder = ColumnDictionaryBuilder(
+                    [column.name for column in sheet_metadata.column_data if column.name != "sct_id"])
+                search_builder = SearchIndexBuilder(sheet_data.study_id, sheet_data.unique_reference,
+                                                    searchable_columns(sheet_metadata.column_data))
+                index = sheet_metadata.ingested_rows
+                if resuming:
+                    logger.info("Resuming sheet {} after {} committed rows".format(sheet_data.id, index))
+                    discard_uncommitted_chunks(sheet_metadata, dictionary_builder)
+                data_chunk = []
+                logger.info("Processing data in chunks of size {}".format(chunk_size))
+                for row in rows:
+                    dictionary_builder.add(row)
+                    row["sct_id"] = encode_row_id(index)
+                    search_builder.add(row)
+
+                    data_chunk.append(row)
+                    index += 1
+
+                    if index % chunk_size == 0:
+                        logger.info(row)
+                        create_chunk(sql_ref, sheet_metadata, data_chunk, index // chunk_size - 1)
+                        search_builder.flush()
+                        checkpoint_ingest(sheet_metadata, index, reader.position())
+                        workspace.touch()
+                        data_chunk = []
+
+                if len(data_chunk) > 0:
+                    create_chunk(sql_ref, sheet_metadata, data_chunk, index // chunk_size)
+                    search_builder.flush()
+                    checkpoint_ingest(sheet_metadata, index, reader.position())
+            dictionary_builder.save(sql_ref)
+            logger.info("Indexed {} rows for search".format(search_builder.count))
 
             sheet_data.status = DataImportStatusEnum.SUCCESS
             existing_file = SheetUploadData.objects.filter(original_file_name=sheet_data.original_file_name,
                                                            study_id=sheet_data.study_id, active=True)
+            previous_sheets = list(existing_file.values_list('id', 'unique_reference'))
+            SearchDocument.objects(sql_ref__in=[str(ref) for _, ref in previous_sheets]).delete()
             existing_file.update(active=False)
             sheet_data.active = True
+            sheet_data.revision += 1
+            sheet_data.revision_date_time = timezone.now()
             sheet_data.save()
+            for previous_sheet_id, previous_ref in previous_sheets:
+                sheet_changed.send(sender=SheetUploadData, sheet_id=previous_sheet_id, sql_ref=previous_ref)
+            sheet_changed.send(sender=SheetUploadData, sheet_id=sheet_data.id, sql_ref=sheet_data.unique_reference)
+            for saved_query_id in SavedQuery.objects.filter(
+                    study_id=sheet_data.study_id,
+                    source_file_name=sheet_data.original_file_name).values_list('id', flat=True):
+                refresh_saved_query.apply_async(args=[saved_query_id])
+            for column in sort_indexed_columns:
+                if request_sort_index_build(str(sheet_data.unique_reference), column):
+                    build_column_sort_index.apply_async(args=[str(sheet_data.unique_reference), column],
+                                                        queue='tasks')
         else:
             logger.error("File not found at the path: {}".format(csv_file_path))
             sheet_data.status = DataImportStatusEnum.FAILURE
@@ -239,10 +420,542 @@ def process_csv_file(zip_upload_id, sheet_id, queue='tasks'):
     if zip_upload_id:
         upload_data.status = DataImportStatusEnum.SUCCESS
         upload_data.save()
-    shutil.rmtree(main_dir_path)
+    workspace.remove()
     logger.info("File processing completed successfully for file {}".format(upload_data.original_file_name))
 
 
+def stored_column_data(sheet_data):
+    meta_data = SheetMetaData.objects(sql_ref=str(sheet_data.unique_reference)).first()
+    return meta_data.column_data if meta_data else []
+
+
+def iter_sheet_rows(sheet_data, filter_data=None, sort=False, sct_ids=None):
+    pipeline = [
+        {"$match": {"sql_ref": f"{sheet_data.unique_reference}"}},
+        {"$unwind": "$data"},
+    ]
+    if sct_ids is not None:
+        pipeline.append({"$match": {"data.sct_id": {"$in": list(sct_ids)}}})
+    if filter_data:
+        column_data = stored_column_data(sheet_data)
+        match_conditions = generate_match_query(filter_data, column_data)
+        if match_conditions:
+            pipeline.append({"$match": match_conditions})
+        if sort and filter_data.sort_by_column:
+            pipeline.append({"$sort": sorting_query(filter_data, column_data)})
+    pipeline.append({"$replaceRoot": {"newRoot": "$data"}})
+    return MongoDbClient.objects.aggregate(pipeline, allowDiskUse=True)
+
+
+def write_sheet_chunks(sql_ref, sheet_metadata, rows, assign_ids=False, append=False):
+    """Writes rows in chunks of the sheet's chunk_size.
+
+    Chunks are numbered unless they are appended to a sheet that already has chunks.
+    """
+    chunk_size = sheet_metadata.chunk_size or settings.ITER_CHUNK_SIZE
+    data_chunk = []
+    row_count = 0
+    for row in rows:
+        if assign_ids:
+            row["sct_id"] = encode_row_id(row_count)
+        data_chunk.append(row)
+        row_count += 1
+        if len(data_chunk) >= chunk_size:
+            create_chunk(sql_ref, sheet_metadata, data_chunk, None if append else row_count // chunk_size - 1)
+            data_chunk = []
+    if data_chunk:
+        create_chunk(sql_ref, sheet_metadata, data_chunk, None if append else row_count // chunk_size)
+    return row_count
+
+
+def rename_join_columns(rows, renamed_columns):
+    for row in rows:
+        row.pop("_id", None)
+        row.pop("sct_id", None)
+        yield {renamed_columns.get(column, column): value for column, value in row.items()}
+
+
+@shared_task
+def join_sheets(result_sheet_id, sheet_ids, join_keys, join_type, filters=None, queue='tasks'):
+    logger.info("Joining sheets {} into sheet with id {}".format(sheet_ids, result_sheet_id))
+    result_sheet = SheetUploadData.objects.get(id=result_sheet_id)
+    result_sheet.status = DataImportStatusEnum.PROCESSING
+    result_sheet.save()
+    filters = filters or [None] * len(sheet_ids)
+    workspace = Workspace("joins", result_sheet_id)
+    try:
+        joiner = PartitionedHashJoin(workspace.path, join_keys, join_type, settings.JOIN_PARTITIONS)
+        column_data = [{"name": "sct_id", "data_type": "string", "column_index": 0, "visible": False,
+                        "alphabet": column_letter(0)}]
+        used_columns = {"sct_id"}
+        for key in join_keys:
+            used_columns.add(key)
+            column_data.append({"name": key, "column_index": len(column_data),
+                                "alphabet": column_letter(len(column_data))})
+        for sheet_id, filter_data in zip(sheet_ids, filters):
+            sheet_data = SheetUploadData.objects.get(id=sheet_id)
+            meta_data = SheetMetaData.objects.get(sql_ref=str(sheet_data.unique_reference))
+            prefix = os.path.splitext(sheet_data.original_file_name)[0]
+            renamed_columns = {}
+            for column in live_columns(meta_data.column_data):
+                if column.name in join_keys:
+                    key_column = next(data for data in column_data if data["name"] == column.name)
+                    key_column.setdefault("data_type", column.data_type)
+                    if column_key(column) != column.name:
+                        renamed_columns[column_key(column)] = column.name
+                    continue
+                if column.name == "sct_id":
+                    continue
+                name = column.name
+                if name in used_columns:
+                    name = "{}_{}".format(prefix, column.name)
+                if name != column_key(column):
+                    renamed_columns[column_key(column)] = name
+                used_columns.add(name)
+                column_data.append({"name": name, "data_type": column.data_type, "column_index": len(column_data),
+                                    "alphabet": column_letter(len(column_data))})
+            filter_schema = FilterSchema.model_validate(filter_data) if filter_data else None
+            joiner.add_input(rename_join_columns(iter_sheet_rows(sheet_data, filter_schema), renamed_columns))
+
+        sheet_metadata = SheetMetaData.objects.create(
+            sql_ref=str(result_sheet.unique_reference),
+            column_data=column_data,
+            chunk_size=settings.ITER_CHUNK_SIZE
+        )
+        row_count = write_sheet_chunks(str(result_sheet.unique_reference), sheet_metadata, joiner.join(),
+                                       assign_ids=True)
+        logger.info("Joined {} rows into sheet with id {}".format(row_count, result_sheet_id))
+        result_sheet.status = DataImportStatusEnum.SUCCESS
+        result_sheet.revision += 1
+        result_sheet.revision_date_time = timezone.now()
+        result_sheet.save()
+    except Exception as e:
+        logger.error("Error while joining sheets: {}".format(e))
+        result_sheet.status = DataImportStatusEnum.FAILURE
+        result_sheet.additional_info = "Error while joining sheets: {}".format(e)
+        result_sheet.save()
+    finally:
+        workspace.remove()
+    return result_sheet_id
+
+
+@shared_task
+def refresh_saved_query(saved_query_id, sct_ids=None, columns=None, queue='tasks'):
+    saved_query = SavedQuery.objects.select_related('result_sheet').get(id=saved_query_id)
+    logger.info("Refreshing saved query {} with id {}".format(saved_query.name, saved_query_id))
+    filter_schema = FilterSchema.model_validate(saved_query.filter_data)
+    source_sheet = SheetUploadData.objects.filter(study_id=saved_query.study_id,
+                                                  original_file_name=saved_query.source_file_name,
+                                                  active=True).first()
+    if not source_sheet:
+        logger.error("No active sheet {} found for saved query with id {}".format(saved_query.source_file_name,
+                                                                                   saved_query_id))
+        saved_query.status = DataImportStatusEnum.FAILURE
+        saved_query.save()
+        return
+
+    full_rebuild = sct_ids is None or source_sheet.id != saved_query.source_sheet_id
+    saved_query.status = DataImportStatusEnum.PROCESSING
+    saved_query.save()
+    try:
+        if not full_rebuild and columns and filter_schema.sort_by_column:
+            sort_keys = resolve_column_keys(stored_column_data(source_sheet), filter_schema.sort_by_column)
+            full_rebuild = bool(set(columns) & set(sort_keys))
+        if not full_rebuild:
+            full_rebuild = not refresh_saved_query_rows(saved_query, source_sheet, filter_schema, sct_ids, columns)
+        if full_rebuild:
+            rebuild_saved_query(saved_query, source_sheet, filter_schema)
+    except Exception as e:
+        logger.error("Error while refreshing saved query: {}".format(e))
+        saved_query.status = DataImportStatusEnum.FAILURE
+        saved_query.save()
+        return
+    saved_query.source_sheet = source_sheet
+    saved_query.source_revision = source_sheet.revision
+    saved_query.last_refresh_date_time = timezone.now()
+    saved_query.status = DataImportStatusEnum.SUCCESS
+    saved_query.save()
+    saved_query.result_sheet.bump_revision()
+    return saved_query_id
+
+
+@shared_task
+def refresh_saved_queries(sheet_id, sct_ids, columns, queue='tasks'):
+    for saved_query_id in SavedQuery.objects.filter(source_sheet_id=sheet_id).values_list('id', flat=True):
+        refresh_saved_query(saved_query_id, sct_ids, columns)
+
+
+def rebuild_saved_query(saved_query, source_sheet, filter_schema):
+    result_sheet = saved_query.result_sheet
+    old_reference = str(result_sheet.unique_reference)
+    new_reference = str(uuid.uuid4())
+    source_meta_data = SheetMetaData.objects.get(sql_ref=str(source_sheet.unique_reference))
+    sheet_metadata = SheetMetaData.objects.create(sql_ref=new_reference, column_data=source_meta_data.column_data,
+                                                  chunk_size=settings.ITER_CHUNK_SIZE)
+    row_count = write_sheet_chunks(new_reference, sheet_metadata, iter_sheet_rows(source_sheet, filter_schema,
+                                                                                  sort=True))
+    result_sheet.unique_reference = new_reference
+    result_sheet.status = DataImportStatusEnum.SUCCESS
+    result_sheet.save()
+    MongoDbClient.objects(sql_ref=old_reference).delete()
+    SheetMetaData.objects(sql_ref=old_reference).delete()
+    drop_row_locations(old_reference)
+    logger.info("Rebuilt saved query {} with {} rows".format(saved_query.name, row_count))
+
+
+def refresh_saved_query_rows(saved_query, source_sheet, filter_schema, sct_ids, columns=None):
+    view_reference = str(saved_query.result_sheet.unique_reference)
+    matching_rows = {row["sct_id"]: row for row in iter_sheet_rows(source_sheet, filter_schema, sct_ids=sct_ids)}
+    present_pipeline = [
+        {"$match": {"sql_ref": view_reference}},
+        {"$unwind": "$data"},
+        {"$match": {"data.sct_id": {"$in": list(sct_ids)}}},
+        {"$project": {"_id": 0, "sct_id": "$data.sct_id"}},
+    ]
+    present = {row["sct_id"] for row in MongoDbClient.objects.aggregate(present_pipeline, allowDiskUse=True)}
+    entering = [sct_id for sct_id in matching_rows if sct_id not in present]
+    if entering and filter_schema.sort_by_column:
+        logger.info("Rows entering sorted saved query {}, falling back to a full rebuild".format(saved_query.name))
+        return False
+
+    operations = []
+    leaving = [sct_id for sct_id in present if sct_id not in matching_rows]
+    if leaving:
+        operations.append(pymongo.UpdateMany({"sql_ref": view_reference},
+                                             {"$pull": {"data": {"sct_id": {"$in": leaving}}}}))
+    for sct_id in present:
+        if sct_id in matching_rows:
+            operations.append(pymongo.UpdateOne({"sql_ref": view_reference, "data.sct_id": sct_id},
+                                                {"$set": {"data.$": matching_rows[sct_id]}}))
+    if operations:
+        MongoDbClient._get_collection().bulk_write(operations, ordered=False)
+    sheet_metadata = SheetMetaData.objects.get(sql_ref=view_reference)
+    if leaving:
+        rebuild_row_locations(view_reference, sheet_metadata.chunk_size)
+    if entering:
+        write_sheet_chunks(view_reference, sheet_metadata, [matching_rows[sct_id] for sct_id in entering],
+                           append=True)
+    if entering or leaving:
+        # Rows moving in or out shift the positions of every sort index of the view, not only the edited columns.
+        rebuild_sort_indexes(view_reference, sheet_metadata, None)
+    elif columns and present:
+        rebuild_sort_indexes(view_reference, sheet_metadata, set(columns))
+    logger.info("Refreshed saved query {}: {} updated, {} removed, {} added".format(
+        saved_query.name, len(present) - len(leaving), len(leaving), len(entering)))
+    return True
+
+
+def previous_sort_indexed_columns(sheet_data):
+    previous_sheet = SheetUploadData.objects.filter(original_file_name=sheet_data.original_file_name,
+                                                    study_id=sheet_data.study_id, active=True).first()
+    if not previous_sheet:
+        return set()
+    previous_meta_data = SheetMetaData.objects(sql_ref=str(previous_sheet.unique_reference)).first()
+    if not previous_meta_data:
+        return set()
+    return {column_key(column) for column in live_columns(previous_meta_data.column_data) if column.sort_indexed}
+
+
+@shared_task
+def compute_formula_column(sql_ref, column, queue='tasks'):
+    logger.info("Computing formula column {} for sheet {}".format(column, sql_ref))
+    meta_data = SheetMetaData.objects.get(sql_ref=sql_ref)
+    column_data = find_column(meta_data.column_data, column)
+    if not column_data or column_data.input_type != "FOR":
+        logger.error("No formula column {} found for sheet {}".format(column, sql_ref))
+        return
+    columns = recompute_order(meta_data.column_data, [column], include_changed=True)
+    try:
+        formulas = compile_formula_columns(meta_data.column_data, columns)
+    except FormulaError as e:
+        logger.error("Invalid formula while computing column {}: {}".format(column, e))
+        return
+    started = datetime.now()
+    result = MongoDbClient._get_collection().update_many({"sql_ref": sql_ref}, formula_update_pipeline(formulas))
+    logger.info("Computed formula columns {} over {} chunks in {}".format(columns, result.modified_count,
+                                                                         datetime.now() - started))
+    data_types = {column_key(data): data.data_type for data in meta_data.column_data}
+    for key, formula in formulas:
+        if formula.data_type and formula.data_type != data_types.get(key):
+            SheetMetaData._get_collection().update_one(
+                {"sql_ref": sql_ref, "column_data": {"$elemMatch": column_match(key)}},
+                {"$set": {"column_data.$.data_type": formula.data_type}, "$inc": {"version": 1}})
+    ColumnDictionary.objects(sql_ref=sql_ref, column__in=columns).delete()
+    invalidate_sort_indexes(sql_ref, columns)
+    for data in live_columns(meta_data.column_data):
+        if column_key(data) in columns and data.sort_indexed and request_sort_index_build(sql_ref, column_key(data)):
+            build_column_sort_index.apply_async(args=[sql_ref, column_key(data)], queue='tasks')
+    sheet_data = SheetUploadData.objects.filter(unique_reference=sql_ref).first()
+    if sheet_data:
+        sheet_data.bump_revision()
+        for saved_query_id in SavedQuery.objects.filter(source_sheet_id=sheet_data.id).values_list('id', flat=True):
+            refresh_saved_query.apply_async(args=[saved_query_id])
+
+
+@shared_task
+def compact_deleted_columns(sql_ref, queue='tasks'):
+    meta_data = SheetMetaData.objects(sql_ref=sql_ref).first()
+    if not meta_data:
+        logger.error("No sheet meta data found for sheet {}".format(sql_ref))
+        return
+    keys = [column_key(column) for column in meta_data.column_data if column.deleted]
+    if not keys:
+        return
+    logger.info("Compacting deleted columns {} of sheet {}".format(keys, sql_ref))
+    started = datetime.now()
+    result = MongoDbClient._get_collection().update_many(
+        {"sql_ref": sql_ref}, {"$unset": {"data.$[].{}".format(key): "" for key in keys}})
+    SearchDocument._get_collection().update_many({"sql_ref": sql_ref}, [
+        {"$unset": ["cells.{}".format(key) for key in keys]},
+        {"$set": {"content": {"$trim": {"input": {"$reduce": {
+            "input": {"$objectToArray": "$cells"}, "initialValue": "",
+            "in": {"$concat": ["$$value", " ", "$$this.v"]}}}}}}},
+    ])
+    ColumnDictionary.objects(sql_ref=sql_ref, column__in=keys).delete()
+    SortIndex.objects(sql_ref=sql_ref, column__in=keys).delete()
+    SortIndexEntry.objects(sql_ref=sql_ref, column__in=keys).delete()
+    SheetMetaData._get_collection().update_one(
+        {"sql_ref": sql_ref},
+        {"$pull": {"column_data": {"deleted": True, "key": {"$in": keys}}}, "$inc": {"version": 1}})
+    logger.info("Compacted deleted columns over {} chunks in {}".format(result.modified_count,
+                                                                       datetime.now() - started))
+
+
+def rebuild_sort_indexes(sql_ref, meta_data, columns):
+    """Marks the sort indexes of the given columns, or of every column when columns is None, STALE and queues the
+    rebuild of the sort indexed ones."""
+    indexed = [column_key(column) for column in live_columns(meta_data.column_data) if column.sort_indexed]
+    if columns is None:
+        columns = indexed
+        invalidate_sort_indexes(sql_ref, SortIndex.objects(sql_ref=sql_ref).distinct('column'))
+    else:
+        invalidate_sort_indexes(sql_ref, columns)
+    for key in indexed:
+        if key in columns and request_sort_index_build(sql_ref, key):
+            build_column_sort_index.s(sql_ref, key).set(queue='tasks').apply_async()
+
+
+def schedule_edit_followups(sheet_data, meta_data, edited_sct_ids, edited_columns):
+    sql_ref = str(sheet_data.unique_reference)
+    if edited_columns:
+        rebuild_sort_indexes(sql_ref, meta_data, edited_columns)
+    if edited_sct_ids and SavedQuery.objects.filter(source_sheet_id=sheet_data.id).exists():
+        refresh_saved_queries.s(sheet_data.id, list(edited_sct_ids), list(edited_columns)) \
+            .set(queue='tasks').apply_async()
+
+
+def value_matches_type(value, data_type):
+    if value in (None, "") or data_type in (None, "string"):
+        return True
+    compatible_types = {"float": ["float", "integer"], "datetime": ["datetime", "date"]}
+    return infer_data_type(str(value)) in compatible_types.get(data_type, [data_type])
+
+
+def resolve_patch_column(meta_data, name, key):
+    column = find_column(meta_data.column_data, name)
+    if column is None:
+        return None, "Unknown column {}".format(name)
+    if column_key(column) in ("sct_id", key):
+        return None, "Column {} cannot be edited".format(name)
+    if column.input_type == "FOR" or column.protected:
+        return None, "Column {} is a protected column".format(name)
+    return column, None
+
+
+def apply_bulk_edit_batch(bulk_edit, sheet_data, meta_data, edits):
+    """Writes one batch of a bulk edit and publishes it as its own revision, with the formula cells it changes.
+
+    Publishing every batch keeps the sheet's revision in step with its cells while a long job runs, so validators,
+    caches and revision-pinned reads never serve cells changed under an older revision. Returns the edited sct_ids
+    that exist in the sheet and the columns changed in them, formula columns included.
+    """
+    sql_ref = str(sheet_data.unique_reference)
+    pending = new_pending_edit()
+    try:
+        existing = write_row_edits(sheet_data, meta_data, edits, bulk_edit.created_by_id, pending)
+        columns = {column for column, values in edits.items() if existing.intersection(values)}
+        columns.update(recompute_edited_formulas(sql_ref, meta_data, existing, columns))
+    except Exception:
+        # Cells may already be written once the batch is journaled; publishing keeps them in the journal.
+        if EditJournal.objects(sql_ref=sql_ref, pending=pending).first():
+            bulk_edit.revision = publish_edits(sheet_data, pending)
+        raise
+    if not existing:
+        discard_edits(sql_ref, pending)
+        return existing, columns
+    bulk_edit.revision = publish_edits(sheet_data, pending)
+    # Sorted reads fall back to sorting on the fly until the job's follow-ups rebuild the indexes.
+    invalidate_sort_indexes(sql_ref, columns)
+    return existing, columns
+
+
+@shared_task
+@fair_share(bulk_edit_study_id)
+def apply_bulk_edit(bulk_edit_id, queue='tasks'):
+    bulk_edit = BulkEditJob.objects.select_related('sheet').get(id=bulk_edit_id)
+    sheet_data = bulk_edit.sheet
+    sql_ref = str(sheet_data.unique_reference)
+    logger.info("Applying bulk edit {} to sheet with id {}".format(bulk_edit.original_file_name, sheet_data.id))
+    bulk_edit.status = DataImportStatusEnum.PROCESSING
+    bulk_edit.save(update_fields=['status'])
+    extension = os.path.splitext(bulk_edit.original_file_name)[1].lower()
+    workspace = Workspace("bulk_edits", bulk_edit_id)
+    patch_path = workspace.join(str(bulk_edit.id) + extension)
+    report = BulkEditReport(settings.BULK_EDIT_MAX_REPORTED_ERRORS)
+    edited_sct_ids = set()
+    edited_columns = set()
+    started = datetime.now()
+    try:
+        workspace.makedirs()
+        blob_service_client = get_blob_service_client()
+        blob_client = blob_service_client.get_blob_client(container=settings.AZURE_STORAGE_CONTAINER_NAME,
+                                                          blob=bulk_edit.date_lake_url)
+        with open(patch_path, "wb") as patch_file:
+            blob_client.download_blob().readinto(patch_file)
+
+        meta_data = SheetMetaData.objects.get(sql_ref=sql_ref)
+        key_column = find_column(meta_data.column_data, bulk_edit.key_column)
+        if key_column is None:
+            raise BulkEditError("Unknown key column {}".format(bulk_edit.key_column))
+        key = column_key(key_column)
+        columns = {}
+        rows = []
+        for line, row in read_patch_rows(patch_path, extension):
+            bulk_edit.total_rows += 1
+            if row is None:
+                report.add(line, None, None, "Malformed row")
+                continue
+            key_value = row.get(bulk_edit.key_column)
+            if key_value in (None, ""):
+                report.add(line, None, bulk_edit.key_column, "Missing value of key column {}".format(
+                    bulk_edit.key_column))
+                continue
+            cells = {}
+            for name, value in row.items():
+                if name in (None, bulk_edit.key_column):
+                    continue
+                if name not in columns:
+                    columns[name], error = resolve_patch_column(meta_data, name, key)
+                    if error:
+                        # Reported once; the column is skipped on every later row.
+                        report.add(line, str(key_value), name, error)
+                column = columns[name]
+                if column is None:
+                    continue
+                if not value_matches_type(value, column.data_type):
+                    report.add(line, str(key_value), name, "Value {} is not a valid {}".format(value,
+                                                                                              column.data_type))
+                    continue
+                cells[column_key(column)] = value
+            if cells:
+                rows.append((line, str(key_value), cells))
+
+        sct_ids = None
+        if key != "sct_id":
+            sct_ids = natural_key_rows(sql_ref, key, {key_value for _, key_value, _ in rows})
+        batch_size = settings.BULK_EDIT_BATCH_SIZE
+        for start in range(0, len(rows), batch_size):
+            edits = defaultdict(dict)
+            batch_lines = {}
+            for line, key_value, cells in rows[start:start + batch_size]:
+                if sct_ids is None:
+                    sct_id = key_value
+                elif len(sct_ids.get(key_value, [])) == 1:
+                    sct_id = sct_ids[key_value][0]
+                else:
+                    report.add(line, key_value, bulk_edit.key_column, "{} matches {} rows".format(
+                        key_value, len(sct_ids.get(key_value, []))))
+                    continue
+                batch_lines[sct_id] = (line, key_value)
+                for column, value in cells.items():
+                    edits[column][sct_id] = value
+            existing, columns_changed = apply_bulk_edit_batch(bulk_edit, sheet_data, meta_data, edits) \
+                if edits else (set(), set())
+            for sct_id, (line, key_value) in batch_lines.items():
+                if sct_id not in existing:
+                    report.add(line, key_value, bulk_edit.key_column, "No row with {} {}".format(
+                        bulk_edit.key_column, key_value))
+            edited_sct_ids.update(existing)
+            edited_columns.update(columns_changed)
+            bulk_edit.processed_rows = min(start + batch_size, len(rows))
+            bulk_edit.applied_cells += sum(len(existing.intersection(values)) for values in edits.values())
+            BulkEditJob.objects.filter(id=bulk_edit.id).update(total_rows=bulk_edit.total_rows,
+                                                               processed_rows=bulk_edit.processed_rows,
+                                                               applied_cells=bulk_edit.applied_cells,
+                                                               revision=bulk_edit.revision)
+        bulk_edit.status = DataImportStatusEnum.SUCCESS
+        logger.info("Applied {} cells of bulk edit {} with {} errors in {}".format(
+            bulk_edit.applied_cells, bulk_edit.id, report.error_count, datetime.now() - started))
+    except Exception as e:
+        logger.error("Error while applying bulk edit {}: {}".format(bulk_edit.id, e))
+        bulk_edit.status = DataImportStatusEnum.FAILURE
+        bulk_edit.additional_info = "Error while applying bulk edit: {}".format(e)
+    finally:
+        workspace.remove()
+    if edited_sct_ids:
+        schedule_edit_followups(sheet_data, meta_data, edited_sct_ids, edited_columns)
+    bulk_edit.errors = report.errors
+    bulk_edit.error_count = report.error_count
+    bulk_edit.finished_date_time = timezone.now()
+    bulk_edit.save()
+    return str(bulk_edit.id)
+
+
+@shared_task
+def compact_edit_journals(queue='tasks'):
+    logger.info("Compacting edit journals")
+    reaped = reap_abandoned_edits()
+    if reaped:
+        logger.info("Removed {} journal entries of abandoned edits".format(reaped))
+    for sql_ref in EditJournal.objects.distinct('sql_ref'):
+        sheet_data = SheetUploadData.objects.filter(unique_reference=sql_ref).first()
+        if sheet_data:
+            horizon = sheet_data.revision - settings.EDIT_JOURNAL_RETAINED_REVISIONS
+        else:
+            horizon = EditJournal.objects(sql_ref=sql_ref).order_by('-revision').first().revision
+        if not horizon or horizon <= 0:
+            continue
+        moved = compact_edit_journal(sql_ref, horizon, settings.EDIT_JOURNAL_COMPACTION_BATCH_SIZE)
+        if moved:
+            logger.info("Archived {} journal entries up to revision {} for sheet {}".format(moved, horizon, sql_ref))
+
+
+def scratch_job_running(kind, job_id):
+    """Whether the job of a scratch workspace is still queued or running; None when there is no record of it."""
+    try:
+        job_id = uuid.UUID(job_id)
+    except ValueError:
+        return None
+    finished = [DataImportStatusEnum.SUCCESS, DataImportStatusEnum.FAILURE]
+    if kind == "bulk_edits":
+        jobs = BulkEditJob.objects.filter(id=job_id)
+    else:
+        jobs = SheetUploadData.objects.filter(id=job_id)
+        if kind == "uploads" and not jobs.exists():
+            jobs = ZipUploadData.objects.filter(id=job_id)
+    status = jobs.values_list('status', flat=True).first()
+    if status is None:
+        return None
+    return status not in finished
+
+
+@shared_task
+def reap_scratch_workspaces(queue='tasks'):
+    reaped = reap_workspaces(scratch_job_running)
+    if reaped:
+        logger.info("Reaped {} scratch workspaces".format(reaped))
+
+
+@shared_task
+def build_column_sort_index(sql_ref, column, queue='tasks'):
+    logger.info("Building sort index of column {} for sheet {}".format(column, sql_ref))
+    try:
+        build_sort_index(sql_ref, column)
+    except Exception as e:
+        logger.error("Error while building sort index: {}".format(e))
+        SortIndex.objects(sql_ref=sql_ref, column=column).update(set__status=SortIndexStatusEnum.FAILED.value)
+
+
 def infer_data_type(value):
     # Try to convert to an integer
     try:
@@ -1,3 +1,1319 @@
-from django.test import TestCase
+import asyncio
+import os
+import shutil
+import tempfile
+import time
+import zipfile
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+from unittest import mock, skipUnless
 
-# Create your tests here.
+import redis
+from django.test import SimpleTestCase, override_settings
+from django.utils.http import http_date
+from mongoengine.errors import NotUniqueError
+from pymongo.errors import BulkWriteError
+
+from clinical_analytics.connections import MongoPoolMetrics, PostgresConnectionMetrics, connection_metrics, \
+    get_blob_service_client
+
+from . import local_cache
+from .api import get_studies, get_study
+from .bulk_edit import BulkEditError, BulkEditReport, read_patch_rows, natural_key_rows
+from .columns import ColumnConflictError, ColumnOperationError, delete_column, find_column, insert_column, \
+    live_columns, rename_column, reorder_columns
+from .conditional import not_modified_response, set_validators, sheet_etag
+from .editing import EditConflictError, aoverlay_revision, apply_row_edits, compact_edit_journal, conflicting_edits, \
+    discard_edits, edit_stacks, locate_rows, publish_edits, reap_abandoned_edits, recompute_formula_rows, \
+    record_row_locations, revision_edits, update_column_metadata, write_row_edits
+from .formulas import FormulaError, compile_formula, canonical_formula, recompute_order, check_dependencies, \
+    formula_update_pipeline
+from .joins import PartitionedHashJoin
+from .local_cache import TTLLRUCache, column_cache, ensure_subscribed, handle_invalidation_message, \
+    handle_subscriber_error, publish_invalidation, sheet_cache
+from .models import ColumnData, DataImportStatusEnum, EditActionEnum
+from .mongo import supports_percentile
+from .parsers import ArrowCsvSheetReader, CsvSheetReader, available_backends, choose_backend, open_sheet_reader
+from .prescan import prescan_sheet
+from .queries import generate_match_query, sorting_query
+from .row_ids import encode_row_id, decode_row_id, row_position
+from .scheduling import acquire_study_slot, fair_share, ingest_priority
+from .tasks import apply_bulk_edit_batch, compact_deleted_columns, discard_uncommitted_chunks, process_csv_file, \
+    process_zip_file, refresh_saved_query, refresh_saved_query_rows, register_zip_sheets
+from .workspaces import LEASE_FILE, ScratchQuotaExceeded, Workspace, reap_workspaces
+
+
+class PartitionedHashJoinTests(SimpleTestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.work_dir, ignore_errors=True)
+
+    def join(self, join_type, *inputs, partitions=4):
+        hash_join = PartitionedHashJoin(self.work_dir, ["subject"], join_type, partitions)
+        for rows in inputs:
+            hash_join.add_input(rows)
+        return sorted(hash_join.join(), key=lambda row: (str(row.get("subject")), sorted(row.items())))
+
+    def test_rows_are_spread_over_partitions(self):
+        hash_join = PartitionedHashJoin(self.work_dir, ["subject"], "inner", 4)
+        hash_join.add_input({"subject": str(index)} for index in range(100))
+        partitions = [partition for partition in range(4)
+                      if list(hash_join.read_partition(partition, 0))]
+        self.assertGreater(len(partitions), 1)
+        self.assertEqual(sum(len(list(hash_join.read_partition(partition, 0))) for partition in range(4)), 100)
+
+    def test_inner_join_keeps_matching_rows(self):
+        rows = self.join("inner",
+                         [{"subject": "1", "age": 30}, {"subject": "2", "age": 40}],
+                         [{"subject": "2", "arm": "B"}, {"subject": "3", "arm": "C"}])
+        self.assertEqual(rows, [{"subject": "2", "age": 40, "arm": "B"}])
+
+    def test_left_join_keeps_unmatched_left_rows(self):
+        rows = self.join("left",
+                         [{"subject": "1", "age": 30}, {"subject": "2", "age": 40}],
+                         [{"subject": "2", "arm": "B"}, {"subject": "3", "arm": "C"}])
+        self.assertEqual(rows, [{"subject": "1", "age": 30}, {"subject": "2", "age": 40, "arm": "B"}])
+
+    def test_outer_join_keeps_unmatched_rows_of_every_input(self):
+        rows = self.join("outer",
+                         [{"subject": "1", "age": 30}, {"subject": "2", "age": 40}],
+                         [{"subject": "2", "arm": "B"}, {"subject": "3", "arm": "C"}])
+        self.assertEqual(rows, [{"subject": "1", "age": 30}, {"subject": "2", "age": 40, "arm": "B"},
+                                {"subject": "3", "arm": "C"}])
+
+    def test_outer_join_keeps_rows_without_a_key(self):
+        rows = self.join("outer", [{"subject": "1", "age": 30}], [{"subject": "", "arm": "A"}])
+        self.assertEqual(rows, [{"subject": "", "arm": "A"}, {"subject": "1", "age": 30}])
+
+    def test_rows_without_a_key_never_match(self):
+        rows = self.join("inner", [{"subject": None, "age": 30}], [{"subject": None, "arm": "A"}])
+        self.assertEqual(rows, [])
+
+    def test_duplicate_keys_join_every_pair(self):
+        rows = self.join("inner",
+                         [{"subject": "1", "visit": 1}, {"subject": "1", "visit": 2}],
+                         [{"subject": "1", "arm": "A"}, {"subject": "1", "arm": "B"}])
+        self.assertEqual(len(rows), 4)
+
+    def test_three_inputs_are_joined_in_order(self):
+        rows = self.join("left",
+                         [{"subject": "1", "age": 30}],
+                         [{"subject": "1", "arm": "A"}],
+                         [{"subject": "2", "site": "X"}],
+                         partitions=2)
+        self.assertEqual(rows, [{"subject": "1", "age": 30, "arm": "A"}])
+
+
+class RowIdTests(SimpleTestCase):
+
+    def test_encodes_ordinals_in_base_36(self):
+        self.assertEqual(encode_row_id(0), "R0")
+        self.assertEqual(encode_row_id(35), "Rz")
+        self.assertEqual(encode_row_id(36), "R10")
+
+    def test_decoding_round_trips(self):
+        for ordinal in [0, 1, 35, 36, 1295, 1296, 10 ** 9]:
+            self.assertEqual(decode_row_id(encode_row_id(ordinal)), ordinal)
+
+    def test_legacy_and_malformed_ids_do_not_decode(self):
+        for sct_id in ["SCT_3f2a", "R", "R-1", "RZ", "", None, 12]:
+            self.assertIsNone(decode_row_id(sct_id))
+
+    def test_row_position_is_chunk_and_offset(self):
+        self.assertEqual(row_position(encode_row_id(0), 1000), (0, 0))
+        self.assertEqual(row_position(encode_row_id(2500), 1000), (2, 500))
+        self.assertIsNone(row_position("SCT_3f2a", 1000))
+        self.assertIsNone(row_position(encode_row_id(5), None))
+
+
+def formula_columns():
+    return [
+        ColumnData(name="Age", key="age", column_index=1, alphabet="A", data_type="integer"),
+        ColumnData(name="Weight (kg)", key="weight", column_index=2, alphabet="B", data_type="float"),
+        ColumnData(name="BMI", key="bmi", column_index=3, alphabet="C", input_type="FOR", formula_string="=B / 2"),
+        ColumnData(name="Score", key="score", column_index=4, alphabet="D", input_type="FOR",
+                   formula_string="=[BMI] * 2"),
+        ColumnData(name="Old", key="old", column_index=5, alphabet="E", deleted=True),
+    ]
+
+
+class FormulaCompilerTests(SimpleTestCase):
+
+    def test_references_compile_to_column_keys(self):
+        for formula_string in ["=A + 1", "=age + 1", "=[Age] + 1"]:
+            formula = compile_formula(formula_string, formula_columns())
+            self.assertEqual(formula.references, {"age"})
+            self.assertEqual(formula.expression, {"$add": [
+                {"$convert": {"input": "$$row.age", "to": "double", "onError": None, "onNull": None}}, 1.0]})
+            self.assertEqual(formula.data_type, "float")
+
+    def test_multiplication_binds_tighter_than_addition(self):
+        formula = compile_formula("=1 + 2 * 3", formula_columns())
+        self.assertEqual(formula.expression, {"$add": [1.0, {"$multiply": [2.0, 3.0]}]})
+
+    def test_division_by_zero_yields_null(self):
+        expression = compile_formula("=A / B", formula_columns()).expression
+        self.assertEqual(expression["$let"]["in"]["$cond"][0], {"$in": ["$$denominator", [0, None]]})
+        self.assertIsNone(expression["$let"]["in"]["$cond"][1])
+
+    def test_functions_and_strings(self):
+        formula = compile_formula('=IF(A > 40, "old", "young")', formula_columns())
+        self.assertEqual(formula.data_type, "string")
+        self.assertEqual(formula.expression["$cond"][1:], [{"$literal": "old"}, {"$literal": "young"}])
+        self.assertEqual(compile_formula("=ISBLANK(A)", formula_columns()).data_type, "boolean")
+
+    def test_invalid_formulas_are_rejected(self):
+        for formula_string in ["", "=", "=A +", "=(A", "=FOO(A)", "=ROUND()", "=[Missing]", "=A $ B", "=[Old]"]:
+            with self.assertRaises(FormulaError, msg=formula_string):
+                compile_formula(formula_string, formula_columns())
+
+    def test_formula_cannot_refer_to_itself(self):
+        with self.assertRaises(FormulaError):
+            compile_formula("=C + 1", formula_columns(), target="bmi")
+
+    def test_canonical_formula_uses_keys(self):
+        self.assertEqual(canonical_formula("=[Weight (kg)] / A", formula_columns()), "=[weight] / [age]")
+        self.assertEqual(canonical_formula('=ROUND(B, 1) & "kg"', formula_columns()), '=ROUND([weight], 1) & "kg"')
+
+    def test_dependency_cycles_are_rejected(self):
+        with self.assertRaises(FormulaError):
+            check_dependencies(formula_columns(), "bmi", ["score"])
+        check_dependencies(formula_columns(), "bmi", ["weight"])
+
+    def test_recompute_order_follows_dependencies(self):
+        self.assertEqual(recompute_order(formula_columns(), ["weight"]), ["bmi", "score"])
+        self.assertEqual(recompute_order(formula_columns(), ["age"]), [])
+        self.assertEqual(recompute_order(formula_columns(), ["score"], include_changed=True), ["score"])
+
+    def test_update_pipeline_evaluates_only_the_given_rows(self):
+        formula = compile_formula("=A + 1", formula_columns())
+        pipeline = formula_update_pipeline([("bmi", formula)], sct_ids=["R0"])
+        self.assertEqual(len(pipeline), 1)
+        computed_row = pipeline[0]["$set"]["data"]["$map"]["in"]
+        self.assertEqual(computed_row["$cond"][0], {"$in": ["$$row.sct_id", ["R0"]]})
+        with self.assertRaises(FormulaError):
+            formula_update_pipeline([("a.b", formula)])
+
+
+class FormulaRecomputeTests(SimpleTestCase):
+
+    def setUp(self):
+        self.column_data = [
+            ColumnData(name="Weight", key="weight", column_index=1, alphabet="A", data_type="float"),
+            ColumnData(name="Doubled", key="zz", column_index=2, alphabet="B", input_type="FOR",
+                       formula_string="=[weight] * 2"),
+            ColumnData(name="Plus one", key="aa", column_index=3, alphabet="C", input_type="FOR",
+                       formula_string="=[zz] + 1"),
+        ]
+
+    def test_dependents_are_ordered_after_their_dependencies(self):
+        self.assertEqual(recompute_order(self.column_data, ["weight"]), ["zz", "aa"])
+        self.assertEqual(recompute_order(self.column_data, ["zz"]), ["aa"])
+
+    def test_edited_rows_are_recomputed_with_one_pipeline_per_chunk(self):
+        with mock.patch("data_upload.editing.locate_rows", return_value={"R0": ("c0", 0), "R1": ("c0", 1)}), \
+                mock.patch("data_upload.editing.pymongo") as pymongo, \
+                mock.patch("data_upload.editing.MongoDbClient") as mongo_db_client:
+            pymongo.UpdateOne.side_effect = lambda *operation: ("one",) + operation
+            pymongo.UpdateMany.side_effect = lambda *operation: ("many",) + operation
+            columns = recompute_formula_rows("sheet", self.column_data, ["R0", "R1", "SCT_3f2a"], ["weight"])
+        self.assertEqual(columns, ["zz", "aa"])
+        operations = mongo_db_client._get_collection.return_value.bulk_write.call_args[0][0]
+        self.assertEqual([operation[:2] for operation in operations],
+                         [("one", {"_id": "c0"}), ("many", {"sql_ref": "sheet", "data.sct_id": {"$in": ["SCT_3f2a"]}})])
+        pipeline = operations[0][2]
+        self.assertEqual([list(stage["$set"]["data"]["$map"]["in"]["$cond"][1]["$mergeObjects"][1])
+                          for stage in pipeline], [["zz"], ["aa"]])
+        self.assertEqual(pipeline[0]["$set"]["data"]["$map"]["in"]["$cond"][0], {"$in": ["$$row.sct_id", ["R0", "R1"]]})
+
+    def test_edits_without_dependent_formulas_write_nothing(self):
+        with mock.patch("data_upload.editing.MongoDbClient") as mongo_db_client:
+            self.assertEqual(recompute_formula_rows("sheet", self.column_data, ["R0"], ["aa"]), [])
+            self.assertEqual(recompute_formula_rows("sheet", self.column_data, [], ["weight"]), [])
+        mongo_db_client._get_collection.return_value.bulk_write.assert_not_called()
+
+
+class ColumnOperationTests(SimpleTestCase):
+
+    def setUp(self):
+        self.meta_data = SimpleNamespace(column_data=[
+            ColumnData(name="sct_id", column_index=0, alphabet="A"),
+            ColumnData(name="Age", key="age", column_index=1, alphabet="B"),
+            ColumnData(name="Arm", column_index=2, alphabet="C"),
+            ColumnData(name="Old", key="old", column_index=3, alphabet="D", deleted=True),
+        ])
+
+    def live_names(self):
+        return [column.name for column in live_columns(self.meta_data.column_data)]
+
+    def test_inserted_columns_get_an_unused_key(self):
+        column = insert_column(self.meta_data, ColumnData(name="old"), 0)
+        self.assertEqual(column.key, "old_2")
+        self.assertEqual(self.live_names(), ["sct_id", "old", "Age", "Arm"])
+        self.assertEqual([column.alphabet for column in live_columns(self.meta_data.column_data)],
+                         ["A", "B", "C", "D"])
+
+    def test_renamed_columns_keep_their_key(self):
+        column = rename_column(self.meta_data, "Arm", "Treatment arm")
+        self.assertEqual((column.key, column.name), ("Arm", "Treatment arm"))
+        self.assertIs(find_column(self.meta_data.column_data, "Arm"), column)
+        self.assertIs(find_column(self.meta_data.column_data, "Treatment arm"), column)
+        for identifier, name in [("age", "Treatment arm"), ("age", "data.age"), ("sct_id", "id"), ("Old", "New")]:
+            with self.assertRaises(ColumnOperationError):
+                rename_column(self.meta_data, identifier, name)
+
+    def test_reorder_must_list_every_column_once(self):
+        reorder_columns(self.meta_data, ["Arm", "age"])
+        self.assertEqual(self.live_names(), ["sct_id", "Arm", "Age"])
+        for identifiers in [["Arm"], ["Arm", "Arm"], ["Arm", "age", "Old"]]:
+            with self.assertRaises(ColumnOperationError):
+                reorder_columns(self.meta_data, identifiers)
+
+    def test_deleted_columns_are_tombstoned_unless_formulas_use_them(self):
+        with self.assertRaises(ColumnOperationError):
+            delete_column(self.meta_data, "age", ["bmi"])
+        column = delete_column(self.meta_data, "age", [])
+        self.assertTrue(column.deleted)
+        self.assertIsNone(find_column(self.meta_data.column_data, "Age"))
+        self.assertEqual([column.column_index for column in live_columns(self.meta_data.column_data)], [0, 1])
+        with self.assertRaises(ColumnOperationError):
+            delete_column(self.meta_data, "sct_id", [])
+
+    @override_settings(METADATA_UPDATE_ATTEMPTS=2)
+    def test_metadata_updates_retry_a_lost_race(self):
+        self.meta_data.version = 3
+        with mock.patch("data_upload.editing.SheetMetaData") as sheet_metadata:
+            sheet_metadata.objects.get.return_value = self.meta_data
+            collection = sheet_metadata._get_collection.return_value
+            collection.update_one.side_effect = [mock.Mock(matched_count=0), mock.Mock(matched_count=1)]
+            operation = mock.Mock()
+            self.assertIs(update_column_metadata("sheet", operation), self.meta_data)
+            self.assertEqual(operation.call_count, 2)
+            self.assertEqual(self.meta_data.version, 4)
+            self.assertEqual(collection.update_one.call_args[0][0], {"sql_ref": "sheet", "version": 3})
+
+            collection.update_one.side_effect = None
+            collection.update_one.return_value.matched_count = 0
+            with self.assertRaises(ColumnConflictError):
+                update_column_metadata("sheet", operation)
+
+    def test_compaction_unsets_deleted_columns_and_drops_their_tombstones(self):
+        with mock.patch("data_upload.tasks.SheetMetaData") as sheet_metadata, \
+                mock.patch("data_upload.tasks.MongoDbClient") as mongo_db_client, \
+                mock.patch("data_upload.tasks.SearchDocument"), mock.patch("data_upload.tasks.ColumnDictionary"), \
+                mock.patch("data_upload.tasks.SortIndex") as sort_index, mock.patch("data_upload.tasks.SortIndexEntry"):
+            sheet_metadata.objects.return_value.first.return_value = self.meta_data
+            compact_deleted_columns("sheet")
+        mongo_db_client._get_collection.return_value.update_many.assert_called_once_with(
+            {"sql_ref": "sheet"}, {"$unset": {"data.$[].old": ""}})
+        sort_index.objects.assert_called_once_with(sql_ref="sheet", column__in=["old"])
+        sheet_metadata._get_collection.return_value.update_one.assert_called_once_with(
+            {"sql_ref": "sheet"},
+            {"$pull": {"column_data": {"deleted": True, "key": {"$in": ["old"]}}}, "$inc": {"version": 1}})
+
+
+class QueryTests(SimpleTestCase):
+
+    def test_filters_and_sorts_resolve_to_column_keys(self):
+        filter_data = SimpleNamespace(filter_column=["Weight (kg)", "age"], value=["70.5", "40"],
+                                      filter_method=["greater than", "Less Than Equals"],
+                                      sort_by_column=["BMI"], sort_order=[-1])
+        self.assertEqual(generate_match_query(filter_data, formula_columns()),
+                         {"data.weight": {"$gt": 70.5}, "data.age": {"$lte": 40}})
+        self.assertEqual(sorting_query(filter_data, formula_columns()), {"data.bmi": -1})
+
+    def test_unknown_and_deleted_columns_are_rejected(self):
+        for column in ["data.$where", "Old"]:
+            filter_data = SimpleNamespace(filter_column=[column], value=["1"], filter_method=["equals"],
+                                          sort_by_column=[column], sort_order=[1])
+            with self.assertRaises(ColumnOperationError):
+                generate_match_query(filter_data, formula_columns())
+            with self.assertRaises(ColumnOperationError):
+                sorting_query(filter_data, formula_columns())
+
+
+class ServerVersionTests(SimpleTestCase):
+
+    def test_percentile_needs_mongodb_7(self):
+        for version_array, supported in [([6, 0, 14, 0], False), ([7, 0, 2, 0], True), ([8, 0, 0, 0], True)]:
+            db = mock.Mock()
+            db.client.server_info.return_value = {"versionArray": version_array}
+            with mock.patch("data_upload.mongo._server_version", None), \
+                    mock.patch("data_upload.mongo.get_db", return_value=db):
+                self.assertEqual(supports_percentile(), supported)
+                supports_percentile()
+            db.client.server_info.assert_called_once_with()
+
+
+class SavedQueryRefreshTests(SimpleTestCase):
+
+    def setUp(self):
+        self.saved_query = mock.Mock(source_sheet_id=1, source_revision=4, status=None)
+        self.saved_query.result_sheet.unique_reference = "view"
+        self.source_sheet = mock.Mock(id=1, revision=5)
+        self.filter_schema = mock.Mock(sort_by_column=["BMI"])
+        self.patch("SavedQuery").objects.select_related.return_value.get.return_value = self.saved_query
+        self.sheet_upload_data = self.patch("SheetUploadData")
+        self.sheet_upload_data.objects.filter.return_value.first.return_value = self.source_sheet
+        self.patch("FilterSchema").model_validate.return_value = self.filter_schema
+        self.patch("stored_column_data", return_value=formula_columns())
+        self.patch("timezone")
+        self.refresh_rows = self.patch("refresh_saved_query_rows", return_value=True)
+        self.rebuild = self.patch("rebuild_saved_query")
+
+    def patch(self, name, **kwargs):
+        patcher = mock.patch("data_upload.tasks.{}".format(name), **kwargs)
+        self.addCleanup(patcher.stop)
+        return patcher.start()
+
+    def test_edited_rows_are_refreshed_in_place_and_the_view_catches_up(self):
+        refresh_saved_query(7, ["R0"], ["age"])
+        self.refresh_rows.assert_called_once_with(self.saved_query, self.source_sheet, self.filter_schema, ["R0"],
+                                                  ["age"])
+        self.rebuild.assert_not_called()
+        self.assertEqual(self.saved_query.status, DataImportStatusEnum.SUCCESS)
+        self.assertEqual(self.saved_query.source_revision, 5)
+        self.saved_query.result_sheet.bump_revision.assert_called_once_with()
+
+    def test_sort_column_edits_and_replaced_sources_rebuild_the_view(self):
+        refresh_saved_query(7, ["R0"], ["bmi"])
+        self.source_sheet.id = 2
+        refresh_saved_query(7, ["R0"], ["age"])
+        self.refresh_rows.assert_not_called()
+        self.assertEqual(self.rebuild.call_count, 2)
+        self.assertEqual(self.saved_query.source_sheet, self.source_sheet)
+
+    def test_rows_entering_a_sorted_view_fall_back_to_a_rebuild(self):
+        self.refresh_rows.return_value = False
+        refresh_saved_query(7, ["R0"], ["age"])
+        self.rebuild.assert_called_once_with(self.saved_query, self.source_sheet, self.filter_schema)
+
+    def test_view_stays_stale_when_the_refresh_fails(self):
+        self.filter_schema.sort_by_column = ["Missing"]
+        refresh_saved_query(7, ["R0"], ["age"])
+        self.sheet_upload_data.objects.filter.return_value.first.return_value = None
+        refresh_saved_query(7, ["R0"], ["age"])
+        self.rebuild.assert_not_called()
+        self.assertEqual(self.saved_query.status, DataImportStatusEnum.FAILURE)
+        self.assertEqual(self.saved_query.source_revision, 4)
+        self.saved_query.result_sheet.bump_revision.assert_not_called()
+
+    def test_view_rows_are_updated_pulled_and_appended(self):
+        self.filter_schema.sort_by_column = []
+        self.patch("iter_sheet_rows", return_value=[{"sct_id": "R0", "age": 41}, {"sct_id": "R2", "age": 50}])
+        self.patch("MongoDbClient").objects.aggregate.return_value = [{"sct_id": "R0"}, {"sct_id": "R1"}]
+        pymongo = self.patch("pymongo")
+        sheet_metadata = self.patch("SheetMetaData").objects.get.return_value
+        rebuild_row_locations = self.patch("rebuild_row_locations")
+        write_sheet_chunks = self.patch("write_sheet_chunks")
+        rebuild_sort_indexes = self.patch("rebuild_sort_indexes")
+        self.assertTrue(refresh_saved_query_rows(self.saved_query, self.source_sheet, self.filter_schema,
+                                                 ["R0", "R1", "R2"], ["age"]))
+        pymongo.UpdateMany.assert_called_once_with({"sql_ref": "view"},
+                                                   {"$pull": {"data": {"sct_id": {"$in": ["R1"]}}}})
+        pymongo.UpdateOne.assert_called_once_with({"sql_ref": "view", "data.sct_id": "R0"},
+                                                  {"$set": {"data.$": {"sct_id": "R0", "age": 41}}})
+        rebuild_row_locations.assert_called_once_with("view", sheet_metadata.chunk_size)
+        write_sheet_chunks.assert_called_once_with("view", sheet_metadata, [{"sct_id": "R2", "age": 50}],
+                                                   append=True)
+        rebuild_sort_indexes.assert_called_once_with("view", sheet_metadata, None)
+
+    def test_rows_entering_a_sorted_view_are_not_patched_in(self):
+        self.patch("iter_sheet_rows", return_value=[{"sct_id": "R2", "bmi": 20}])
+        mongo_db_client = self.patch("MongoDbClient")
+        mongo_db_client.objects.aggregate.return_value = []
+        self.assertFalse(refresh_saved_query_rows(self.saved_query, self.source_sheet, self.filter_schema, ["R2"]))
+        mongo_db_client._get_collection.return_value.bulk_write.assert_not_called()
+
+
+@override_settings(MONGO_MAX_POOL_SIZE=4, AZURE_STORAGE_CONNECTION_STRING="UseDevelopmentStorage=true",
+                   AZURE_STORAGE_CONNECTION_TIMEOUT=20,
+                   DATABASES={"default": {"CONN_MAX_AGE": 60, "CONN_HEALTH_CHECKS": True}})
+class ConnectionMetricsTests(SimpleTestCase):
+
+    def test_pool_listener_tracks_checkout_waits_and_utilization(self):
+        metrics = MongoPoolMetrics()
+        metrics.pool_created(None)
+        with mock.patch("clinical_analytics.connections.time.perf_counter", side_effect=[1.0, 1.25, 2.0, 2.05]):
+            for _ in range(2):
+                metrics.connection_check_out_started(None)
+                metrics.connection_checked_out(None)
+        metrics.connection_checked_in(None)
+        metrics.connection_check_out_failed(None)
+        snapshot = metrics.snapshot()
+        self.assertEqual((snapshot["pools"], snapshot["checked_out"], snapshot["max_checked_out"]), (1, 1, 2))
+        self.assertEqual(snapshot["utilization"], 0.25)
+        self.assertEqual((snapshot["checkouts"], snapshot["checkout_failures"]), (2, 1))
+        self.assertAlmostEqual(snapshot["average_wait_ms"], 150.0)
+        self.assertAlmostEqual(snapshot["max_wait_ms"], 250.0)
+
+    def test_blob_client_is_created_once_per_process(self):
+        with mock.patch("clinical_analytics.connections._blob_service_client", None), \
+                mock.patch("clinical_analytics.connections.BlobServiceClient") as blob_service_client:
+            self.assertFalse(connection_metrics()["blob"]["client_initialized"])
+            self.assertIs(get_blob_service_client(), get_blob_service_client())
+            self.assertTrue(connection_metrics()["blob"]["client_initialized"])
+        blob_service_client.from_connection_string.assert_called_once_with("UseDevelopmentStorage=true",
+                                                                           connection_timeout=20)
+
+    def test_postgres_metrics_count_new_connections(self):
+        metrics = PostgresConnectionMetrics()
+        for _ in range(3):
+            metrics.connection_created(sender=None, connection=None)
+        self.assertEqual(metrics.snapshot(), {"connections_created": 3, "conn_max_age": 60, "health_checks": True})
+
+
+class ConditionalRequestTests(SimpleTestCase):
+
+    def setUp(self):
+        self.sheet_data = mock.Mock(unique_reference="sheet", revision=3)
+        self.last_modified = datetime(2024, 5, 1, 12, 0)
+
+    def request(self, path="/sheet/1?page=1", **headers):
+        return mock.Mock(headers=headers, get_full_path=mock.Mock(return_value=path))
+
+    def test_etag_changes_with_revision_path_and_query(self):
+        etag = sheet_etag(self.sheet_data, self.request())
+        self.assertEqual(sheet_etag(self.sheet_data, self.request()), etag)
+        self.assertNotEqual(sheet_etag(self.sheet_data, self.request("/sheet/1?page=2")), etag)
+        self.assertNotEqual(sheet_etag(self.sheet_data, self.request(), '{"sort_by_column": ["age"]}'), etag)
+        self.sheet_data.revision = 4
+        self.assertNotEqual(sheet_etag(self.sheet_data, self.request()), etag)
+
+    def test_matching_etag_is_not_modified(self):
+        etag = sheet_etag(self.sheet_data, self.request())
+        for if_none_match in [etag, 'W/{}'.format(etag), '"other", {}'.format(etag), "*"]:
+            response = not_modified_response(self.request(**{"If-None-Match": if_none_match}), etag,
+                                             self.last_modified)
+            self.assertEqual(response.status_code, 304)
+            self.assertEqual(response["ETag"], etag)
+            self.assertEqual(response["Last-Modified"], http_date(self.last_modified.timestamp()))
+        self.assertIsNone(not_modified_response(self.request(**{"If-None-Match": '"other"'}), etag,
+                                                self.last_modified))
+
+    def test_if_modified_since_is_used_without_if_none_match(self):
+        since = http_date(self.last_modified.timestamp())
+        self.assertEqual(not_modified_response(self.request(**{"If-Modified-Since": since}), '"a"',
+                                               self.last_modified).status_code, 304)
+        self.assertIsNone(not_modified_response(self.request(**{"If-Modified-Since": since}), '"a"',
+                                                self.last_modified + timedelta(seconds=1)))
+        self.assertIsNone(not_modified_response(self.request(**{"If-None-Match": '"b"', "If-Modified-Since": since}),
+                                                '"a"', self.last_modified))
+        self.assertIsNone(not_modified_response(self.request(), '"a"', self.last_modified))
+
+    def test_validators_make_clients_revalidate(self):
+        response = set_validators({}, '"a"', None)
+        self.assertEqual(response, {"ETag": '"a"', "Cache-Control": "private, no-cache"})
+
+
+class LocalCacheTests(SimpleTestCase):
+
+    def setUp(self):
+        for cache in [sheet_cache, column_cache]:
+            cache.clear()
+            self.addCleanup(cache.clear)
+
+    def test_least_recently_used_entries_are_evicted(self):
+        cache = TTLLRUCache(2, 60)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.get("a")
+        cache.set("c", 3)
+        self.assertEqual([cache.get("a"), cache.get("b"), cache.get("c")], [1, None, 3])
+
+    def test_entries_expire_after_their_ttl(self):
+        cache = TTLLRUCache(2, 60)
+        with mock.patch("data_upload.local_cache.time.monotonic", side_effect=[100.0, 159.0, 161.0]):
+            cache.set("a", 1)
+            self.assertEqual(cache.get("a"), 1)
+            self.assertIsNone(cache.get("a"))
+
+    def test_sheet_changes_are_invalidated_locally_and_published(self):
+        sheet_cache.set("1", "sheet")
+        column_cache.set("ref", ["column"])
+        with mock.patch("data_upload.local_cache.get_invalidation_client") as client:
+            publish_invalidation(None, sheet_id=1, sql_ref="ref")
+        self.assertIsNone(sheet_cache.get("1"))
+        self.assertIsNone(column_cache.get("ref"))
+        client.return_value.publish.assert_called_once_with("clinical_analytics.sheet_changed",
+                                                            '{"sheet_id": "1", "sql_ref": "ref"}')
+
+    def test_failed_publish_still_invalidates_locally(self):
+        sheet_cache.set("1", "sheet")
+        with mock.patch("data_upload.local_cache.get_invalidation_client") as client:
+            client.return_value.publish.side_effect = redis.RedisError("down")
+            publish_invalidation(None, sheet_id=1)
+        self.assertIsNone(sheet_cache.get("1"))
+
+    def test_messages_from_other_processes_invalidate_their_entries(self):
+        sheet_cache.set("1", "sheet")
+        sheet_cache.set("2", "other sheet")
+        column_cache.set("ref", ["column"])
+        handle_invalidation_message({"data": b'{"sheet_id": "1", "sql_ref": "ref"}'})
+        handle_invalidation_message({"data": b"not json"})
+        self.assertIsNone(sheet_cache.get("1"))
+        self.assertEqual(sheet_cache.get("2"), "other sheet")
+        self.assertIsNone(column_cache.get("ref"))
+
+    def test_lost_subscription_clears_the_caches_and_resubscribes(self):
+        sheet_cache.set("1", "sheet")
+        column_cache.set("ref", ["column"])
+        pubsub, thread = mock.Mock(), mock.Mock()
+        with mock.patch("data_upload.local_cache._subscriber_pid", os.getpid()), \
+                mock.patch("data_upload.local_cache.ensure_subscribed") as ensure_subscribed:
+            handle_subscriber_error(redis.RedisError("connection reset"), pubsub, thread)
+            self.assertIsNone(local_cache._subscriber_pid)
+        thread.stop.assert_called_once_with()
+        pubsub.close.assert_called_once_with()
+        self.assertIsNone(sheet_cache.get("1"))
+        self.assertIsNone(column_cache.get("ref"))
+        ensure_subscribed.assert_called_once_with()
+
+    @override_settings(CACHE_INVALIDATION_RETRY_DELAY=30)
+    def test_failed_subscription_is_retried_after_the_delay(self):
+        with mock.patch("data_upload.local_cache._subscriber_pid", None), \
+                mock.patch("data_upload.local_cache._subscriber_retry_at", 0), \
+                mock.patch("data_upload.local_cache.time.monotonic", return_value=100.0) as monotonic, \
+                mock.patch("data_upload.local_cache.get_invalidation_client") as client:
+            client.return_value.pubsub.side_effect = redis.RedisError("down")
+            ensure_subscribed()
+            ensure_subscribed()
+            self.assertEqual(client.return_value.pubsub.call_count, 1)
+            monotonic.return_value = 131.0
+            client.return_value.pubsub.side_effect = None
+            ensure_subscribed()
+            ensure_subscribed()
+            client.return_value.pubsub.return_value.run_in_thread.assert_called_once()
+            self.assertEqual(local_cache._subscriber_pid, os.getpid())
+
+
+class StudyListingTests(SimpleTestCase):
+
+    def setUp(self):
+        self.request = mock.Mock()
+        self.patch("get_user_id", return_value=1)
+        self.study_data = self.patch("StudyData")
+        self.sheet_uploads = self.patch("SheetUploadData").objects.filter.return_value
+        self.sheet_schema = self.patch("SheetUploadDataSchema")
+        self.sheet_schema.model_fields = {"id": None, "original_file_name": None, "active": None}
+        self.single_study = self.patch("SingleStudyDataSchema")
+
+    def patch(self, name, **kwargs):
+        patcher = mock.patch("data_upload.api.{}".format(name), **kwargs)
+        self.addCleanup(patcher.stop)
+        return patcher.start()
+
+    def test_studies_are_listed_a_page_at_a_time(self):
+        query = self.study_data.objects.filter.return_value.only.return_value.order_by.return_value
+        query.__getitem__.return_value = [mock.Mock()]
+        self.assertEqual(get_studies(self.request, page=3, page_size=10).status_code, 200)
+        self.study_data.objects.filter.assert_called_once_with(user_id=1)
+        self.study_data.objects.filter.return_value.only.assert_called_once_with('id', 'study_name', 'sponsor_name',
+                                                                                 'alias')
+        query.__getitem__.assert_called_once_with(slice(20, 30))
+
+    def test_sheet_uploads_are_paged_with_one_lookahead_row(self):
+        page = self.sheet_uploads.order_by.return_value.values.return_value
+        page.__getitem__.return_value = [{"id": index} for index in range(3)]
+        self.assertEqual(get_study(self.request, "study", page=2, page_size=2).status_code, 200)
+        self.sheet_uploads.order_by.assert_called_once_with('original_file_name', '-version_number', 'id')
+        page.__getitem__.assert_called_once_with(slice(2, 5))
+        self.assertEqual(len(self.single_study.call_args[0][1]), 2)
+        self.assertEqual(self.single_study.call_args[1], {"page": 2, "page_size": 2, "has_more": True})
+
+    def test_latest_only_reads_one_active_version_per_file(self):
+        latest = self.sheet_uploads.filter.return_value.order_by.return_value
+        latest.distinct.return_value.values.return_value.__getitem__.return_value = [{"id": 1}]
+        get_study(self.request, "study", page=1, page_size=100, active_only=True, latest_only=True)
+        self.sheet_uploads.filter.assert_called_once_with(active=True)
+        self.sheet_uploads.filter.return_value.order_by.assert_called_once_with('original_file_name',
+                                                                                '-version_number')
+        latest.distinct.assert_called_once_with('original_file_name')
+        self.assertFalse(self.single_study.call_args[1]["has_more"])
+
+    def test_selected_fields_are_read_as_dicts(self):
+        rows = [{"id": 1, "active": True}]
+        self.sheet_uploads.order_by.return_value.values.return_value.__getitem__.return_value = rows
+        get_study(self.request, "study", page=1, page_size=100, fields="active, id")
+        self.sheet_uploads.order_by.return_value.values.assert_called_once_with("id", "active")
+        self.assertEqual(self.single_study.call_args[0][1], rows)
+        self.sheet_schema.model_validate.assert_not_called()
+
+    def test_unknown_fields_and_missing_studies_are_rejected(self):
+        self.assertEqual(get_study(self.request, "study", fields="active,password").status_code, 400)
+        self.study_data.objects.filter.return_value.first.return_value = None
+        self.assertEqual(get_study(self.request, "study").status_code, 404)
+        self.sheet_uploads.order_by.assert_not_called()
+
+
+@mock.patch("data_upload.editing.EditJournal")
+class EditHistoryTests(SimpleTestCase):
+
+    def journal_revisions(self, edit_journal, *revisions):
+        edit_journal._get_collection.return_value.aggregate.return_value = [
+            {"_id": revision, "action": action.value, "reverts": reverts} for revision, action, reverts in revisions]
+
+    def test_undo_and_redo_move_revisions_between_the_stacks(self, edit_journal):
+        self.journal_revisions(edit_journal, (1, EditActionEnum.EDIT, None), (2, EditActionEnum.EDIT, None),
+                               (3, EditActionEnum.UNDO, 2), (4, EditActionEnum.UNDO, 1), (5, EditActionEnum.REDO, 1))
+        self.assertEqual(edit_stacks("sheet"), ([1], [2]))
+
+    def test_a_new_edit_clears_the_redo_stack(self, edit_journal):
+        self.journal_revisions(edit_journal, (1, EditActionEnum.EDIT, None), (2, EditActionEnum.UNDO, 1),
+                               (3, EditActionEnum.EDIT, None))
+        self.assertEqual(edit_stacks("sheet"), ([3], []))
+
+    def test_undo_of_a_revision_below_the_top_is_ignored(self, edit_journal):
+        self.journal_revisions(edit_journal, (1, EditActionEnum.EDIT, None), (2, EditActionEnum.EDIT, None),
+                               (3, EditActionEnum.UNDO, 1))
+        self.assertEqual(edit_stacks("sheet"), ([1, 2], []))
+
+    def test_revision_edits_restore_old_values_or_reapply_new_ones(self, edit_journal):
+        entries = [{"column": "arm", "sct_id": "R0", "old_value": "B", "new_value": "C"},
+                   {"column": "arm", "sct_id": "R0", "old_value": "A", "new_value": "B"}]
+        cursor = edit_journal._get_collection.return_value.find.return_value
+        cursor.sort.return_value = entries
+        self.assertEqual(revision_edits("sheet", 4, undo=True), {"arm": {"R0": "A"}})
+        cursor.sort.assert_called_with("_id", -1)
+        cursor.sort.return_value = list(reversed(entries))
+        self.assertEqual(revision_edits("sheet", 4, undo=False), {"arm": {"R0": "C"}})
+        cursor.sort.assert_called_with("_id", 1)
+
+    def test_pinned_reads_rewind_rows_to_their_revision(self, edit_journal):
+        rows = [{"sct_id": "R0", "arm": "C", "site": "X"}, {"sct_id": "R1", "arm": "Z"}]
+        cursor = mock.MagicMock()
+        # Newest revision first, so the oldest value written after the pinned revision is applied last.
+        cursor.__aiter__.return_value = [{"sct_id": "R0", "column": "arm", "old_value": "B"},
+                                         {"sct_id": "R0", "column": "arm", "old_value": "A"}]
+        with mock.patch("data_upload.editing.get_async_collection") as get_async_collection:
+            get_async_collection.return_value.find.return_value.sort.return_value = cursor
+            rows = asyncio.run(aoverlay_revision("sheet", rows, 2))
+        self.assertEqual(rows, [{"sct_id": "R0", "arm": "A", "site": "X"}, {"sct_id": "R1", "arm": "Z"}])
+        self.assertEqual(get_async_collection.return_value.find.call_args[0][0],
+                         {"sql_ref": "sheet", "sct_id": {"$in": ["R0", "R1"]}, "revision": {"$gt": 2}})
+
+    def test_compaction_archives_in_batches_and_moves_the_horizon(self, edit_journal):
+        journal = edit_journal._get_collection.return_value
+        journal.find.return_value.sort.return_value.limit.side_effect = [[{"_id": 1}, {"_id": 2}], [{"_id": 3}], []]
+        with mock.patch("data_upload.editing.EditJournalArchive") as archive, \
+                mock.patch("data_upload.editing.SheetMetaData") as sheet_metadata:
+            # The first batch was archived by an interrupted run.
+            archive._get_collection.return_value.insert_many.side_effect = [
+                BulkWriteError({"writeErrors": [{"code": 11000}]}), None]
+            self.assertEqual(compact_edit_journal("sheet", 5, 2), 3)
+        journal.find.assert_called_with({"sql_ref": "sheet", "revision": {"$lte": 5}})
+        self.assertEqual(journal.delete_many.call_args_list,
+                         [mock.call({"_id": {"$in": [1, 2]}}), mock.call({"_id": {"$in": [3]}})])
+        sheet_metadata.objects.assert_called_once_with(sql_ref="sheet", compacted_revision__lt=5)
+        sheet_metadata.objects.return_value.update.assert_called_once_with(set__compacted_revision=5)
+
+    def test_compaction_keeps_entries_it_could_not_archive(self, edit_journal):
+        journal = edit_journal._get_collection.return_value
+        journal.find.return_value.sort.return_value.limit.return_value = [{"_id": 1}]
+        with mock.patch("data_upload.editing.EditJournalArchive") as archive, \
+                mock.patch("data_upload.editing.SheetMetaData") as sheet_metadata:
+            archive._get_collection.return_value.insert_many.side_effect = BulkWriteError(
+                {"writeErrors": [{"code": 121}]})
+            with self.assertRaises(BulkWriteError):
+                compact_edit_journal("sheet", 5, 2)
+        journal.delete_many.assert_not_called()
+        sheet_metadata.objects.assert_not_called()
+
+
+class RowLocatorTests(SimpleTestCase):
+
+    def setUp(self):
+        self.row_locator = self.patch("RowLocator")
+        self.collection = self.patch("MongoDbClient")._get_collection.return_value
+        self.patch("pymongo").UpdateOne.side_effect = lambda *operation: operation
+
+    def patch(self, name, **kwargs):
+        patcher = mock.patch("data_upload.editing.{}".format(name), **kwargs)
+        self.addCleanup(patcher.stop)
+        return patcher.start()
+
+    def test_only_rows_off_their_ordinal_position_get_a_locator(self):
+        rows = [{"sct_id": encode_row_id(1000)}, {"sct_id": encode_row_id(5)}, {"sct_id": "SCT_3f2a"}]
+        record_row_locations("sheet", "chunk", rows, 1, 1000)
+        self.row_locator._get_collection.return_value.insert_many.assert_called_once_with(
+            [{"s": "sheet", "i": encode_row_id(5), "c": "chunk", "o": 1},
+             {"s": "sheet", "i": "SCT_3f2a", "c": "chunk", "o": 2}], ordered=False)
+
+    def test_rows_are_located_by_locator_then_by_ordinal(self):
+        self.row_locator._get_collection.return_value.find.return_value = [{"i": "SCT_3f2a", "c": "c9", "o": 4}]
+        self.collection.find.return_value = [{"_id": "c2", "chunk_no": 2}]
+        locations = locate_rows("sheet", ["SCT_3f2a", encode_row_id(2500), encode_row_id(7500)], 1000)
+        self.assertEqual(locations, {"SCT_3f2a": ("c9", 4), encode_row_id(2500): ("c2", 500)})
+        self.assertEqual(sorted(self.collection.find.call_args[0][0]["chunk_no"]["$in"]), [2, 7])
+
+    def test_edits_are_one_guarded_update_per_chunk(self):
+        self.collection.bulk_write.return_value.matched_count = 1
+        with mock.patch("data_upload.editing.locate_rows", return_value={"R0": ("c0", 0), "R1": ("c0", 1)}):
+            self.assertEqual(apply_row_edits("sheet", {"arm": {"R0": "A", "R1": "B"}, "site": {"R1": "S"}}), 1)
+        self.collection.bulk_write.assert_called_once_with(
+            [({"_id": "c0", "data.0.sct_id": "R0", "data.1.sct_id": "R1"},
+              {"$set": {"data.0.arm": "A", "data.1.arm": "B", "data.1.site": "S"}})], ordered=False)
+
+    def test_stale_and_missing_locations_fall_back_to_positional_updates(self):
+        self.collection.bulk_write.return_value.matched_count = 0
+        with mock.patch("data_upload.editing.locate_rows", return_value={"R0": ("c0", 0)}):
+            apply_row_edits("sheet", {"arm": {"R0": "A", "SCT_3f2a": "B"}})
+        self.assertEqual(self.collection.bulk_write.call_args_list[1][0][0], [
+            ({"sql_ref": "sheet", "data.sct_id": "R0"}, {"$set": {"data.$.arm": "A"}}),
+            ({"sql_ref": "sheet", "data.sct_id": "SCT_3f2a"}, {"$set": {"data.$.arm": "B"}}),
+        ])
+
+        self.collection.bulk_write.reset_mock()
+        self.collection.bulk_write.return_value.matched_count = 1
+        with mock.patch("data_upload.editing.locate_rows", return_value={"R0": ("c0", 0)}):
+            apply_row_edits("sheet", {"arm": {"R0": "A", "SCT_3f2a": "B"}})
+        self.assertEqual(self.collection.bulk_write.call_args_list[1][0][0], [
+            ({"sql_ref": "sheet", "data.sct_id": "SCT_3f2a"}, {"$set": {"data.$.arm": "B"}})])
+
+
+class BulkEditTests(SimpleTestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.work_dir, ignore_errors=True)
+
+    def write_patch(self, name, content):
+        path = os.path.join(self.work_dir, name)
+        with open(path, "w", encoding="utf-8") as patch_file:
+            patch_file.write(content)
+        return path
+
+    def test_natural_keys_resolve_to_every_matching_row(self):
+        chunks = [
+            {"data": [{"sct_id": "R0", "subject": "S-1"}, {"sct_id": "R1", "subject": "S-2"}]},
+            {"data": [{"sct_id": "R2", "subject": 3}, {"sct_id": "R3", "subject": "S-2"}, {"sct_id": "R4"}]},
+        ]
+        with mock.patch("data_upload.bulk_edit.MongoDbClient") as mongo_client:
+            mongo_client._get_collection.return_value.find.return_value = chunks
+            rows = natural_key_rows("sheet", "subject", ["S-2", 3, "S-9"])
+        self.assertEqual(rows, {"S-2": ["R1", "R3"], "3": ["R2"]})
+        mongo_client._get_collection.return_value.find.assert_called_once_with(
+            {"sql_ref": "sheet"}, {"_id": 0, "data.sct_id": 1, "data.subject": 1})
+
+    def test_csv_patch_rows_carry_their_line_numbers(self):
+        path = self.write_patch("patch.csv", "\ufeffsubject,arm\nS-1,A\n\"S-2\",\"B\nC\"\nS-3,D\n")
+        rows = list(read_patch_rows(path, ".csv"))
+        self.assertEqual(rows, [(2, {"subject": "S-1", "arm": "A"}), (4, {"subject": "S-2", "arm": "B\nC"}),
+                                (5, {"subject": "S-3", "arm": "D"})])
+
+    def test_csv_patch_without_header_is_rejected(self):
+        path = self.write_patch("patch.csv", "")
+        with self.assertRaises(BulkEditError):
+            list(read_patch_rows(path, ".csv"))
+
+    def test_malformed_ndjson_lines_yield_none(self):
+        path = self.write_patch("patch.ndjson", '{"subject": "S-1", "arm": "A"}\n\nnot json\n[1, 2]\n')
+        rows = list(read_patch_rows(path, ".ndjson"))
+        self.assertEqual(rows, [(1, {"subject": "S-1", "arm": "A"}), (3, None), (4, None)])
+
+    def test_report_counts_every_error_but_keeps_the_first(self):
+        report = BulkEditReport(max_errors=2)
+        for line in range(5):
+            report.add(line, "S-{}".format(line), "arm", "Unknown key")
+        self.assertEqual(report.error_count, 5)
+        self.assertEqual([error["line"] for error in report.errors], [0, 1])
+
+
+@mock.patch("data_upload.tasks.invalidate_sort_indexes")
+@mock.patch("data_upload.tasks.discard_edits")
+@mock.patch("data_upload.tasks.publish_edits")
+@mock.patch("data_upload.tasks.recompute_edited_formulas", return_value=["bmi"])
+@mock.patch("data_upload.tasks.write_row_edits")
+class BulkEditBatchTests(SimpleTestCase):
+
+    def setUp(self):
+        self.bulk_edit = mock.Mock(created_by_id=1, revision=None)
+        self.sheet_data = mock.Mock(unique_reference="sheet")
+        self.meta_data = mock.Mock(column_data=[], chunk_size=1000)
+
+    def test_every_batch_is_published_as_its_own_revision(self, write_row_edits, recompute_edited_formulas,
+                                                          publish_edits, discard_edits, invalidate_sort_indexes):
+        write_row_edits.return_value = {"R0"}
+        publish_edits.side_effect = [5, 6]
+        for value in ["B", "C"]:
+            existing, columns = apply_bulk_edit_batch(self.bulk_edit, self.sheet_data, self.meta_data,
+                                                      {"arm": {"R0": value}})
+            self.assertEqual(existing, {"R0"})
+            self.assertEqual(columns, {"arm", "bmi"})
+        pending = [call[0][4] for call in write_row_edits.call_args_list]
+        self.assertNotEqual(pending[0], pending[1])
+        self.assertEqual([call[0][1] for call in publish_edits.call_args_list], pending)
+        self.assertEqual(self.bulk_edit.revision, 6)
+        invalidate_sort_indexes.assert_called_with("sheet", {"arm", "bmi"})
+        discard_edits.assert_not_called()
+
+    def test_batch_of_unknown_rows_is_discarded(self, write_row_edits, recompute_edited_formulas, publish_edits,
+                                                discard_edits, invalidate_sort_indexes):
+        write_row_edits.return_value = set()
+        recompute_edited_formulas.return_value = []
+        existing, columns = apply_bulk_edit_batch(self.bulk_edit, self.sheet_data, self.meta_data,
+                                                  {"arm": {"R9": "B"}})
+        self.assertEqual((existing, columns), (set(), set()))
+        discard_edits.assert_called_once_with("sheet", write_row_edits.call_args[0][4])
+        publish_edits.assert_not_called()
+        self.assertIsNone(self.bulk_edit.revision)
+
+    def test_failed_batch_publishes_what_it_journaled(self, write_row_edits, recompute_edited_formulas,
+                                                      publish_edits, discard_edits, invalidate_sort_indexes):
+        write_row_edits.side_effect = RuntimeError("chunk write failed")
+        publish_edits.return_value = 7
+        with mock.patch("data_upload.tasks.EditJournal") as edit_journal:
+            edit_journal.objects.return_value.first.return_value = mock.Mock()
+            with self.assertRaises(RuntimeError):
+                apply_bulk_edit_batch(self.bulk_edit, self.sheet_data, self.meta_data, {"arm": {"R0": "B"}})
+        self.assertEqual(self.bulk_edit.revision, 7)
+        discard_edits.assert_not_called()
+
+
+@mock.patch("data_upload.editing.EditJournal")
+class EditPublishTests(SimpleTestCase):
+
+    def setUp(self):
+        self.sheet_data = mock.Mock(unique_reference="sheet")
+        self.sheet_data.bump_revision.return_value = 7
+        self.meta_data = mock.Mock(column_data=[], chunk_size=1000)
+
+    def test_publish_stamps_pending_entries_with_the_new_revision(self, edit_journal):
+        self.assertEqual(publish_edits(self.sheet_data, "pending"), 7)
+        edit_journal._get_collection.return_value.update_many.assert_called_once_with(
+            {"sql_ref": "sheet", "pending": "pending"}, {"$set": {"revision": 7}, "$unset": {"pending": ""}})
+
+    def test_discard_drops_pending_entries_without_a_revision(self, edit_journal):
+        discard_edits("sheet", "pending")
+        edit_journal._get_collection.return_value.delete_many.assert_called_once_with(
+            {"sql_ref": "sheet", "pending": "pending"})
+        self.sheet_data.bump_revision.assert_not_called()
+
+    @override_settings(EDIT_PENDING_TIMEOUT=600)
+    def test_conflicts_include_later_revisions_and_recent_pending_edits(self, edit_journal):
+        now = datetime(2024, 5, 1, 12, 0)
+        edit_journal._get_collection.return_value.find.return_value.limit.return_value = []
+        with mock.patch("data_upload.editing.timezone.now", return_value=now):
+            conflicting_edits("sheet", {"arm": {"R0": "A"}, "site": {}}, 3, "pending")
+        query = edit_journal._get_collection.return_value.find.call_args[0][0]
+        self.assertEqual(query["$and"], [
+            {"$or": [{"column": "arm", "sct_id": {"$in": ["R0"]}}]},
+            {"$or": [{"revision": {"$gt": 3}},
+                     {"pending": {"$exists": True, "$ne": "pending"},
+                      "edit_date_time": {"$gt": now - timedelta(seconds=600)}}]},
+        ])
+
+    @override_settings(EDIT_PENDING_TIMEOUT=600)
+    def test_abandoned_pending_edits_are_reaped(self, edit_journal):
+        now = datetime(2024, 5, 1, 12, 0)
+        edit_journal._get_collection.return_value.delete_many.return_value.deleted_count = 2
+        with mock.patch("data_upload.editing.timezone.now", return_value=now):
+            self.assertEqual(reap_abandoned_edits(), 2)
+        edit_journal._get_collection.return_value.delete_many.assert_called_once_with(
+            {"pending": {"$exists": True}, "edit_date_time": {"$lt": now - timedelta(seconds=600)}})
+
+    def test_conflicting_edit_is_discarded_before_any_cell_is_written(self, edit_journal):
+        conflict = {"sct_id": "R0", "column": "arm", "revision": 4}
+        with mock.patch("data_upload.editing.fetch_row_values", return_value={"R0": {"arm": "A"}}), \
+                mock.patch("data_upload.editing.journal_edits") as journal_edits, \
+                mock.patch("data_upload.editing.conflicting_edits", return_value=[conflict]), \
+                mock.patch("data_upload.editing.apply_row_edits") as apply_row_edits:
+            with self.assertRaises(EditConflictError) as raised:
+                write_row_edits(self.sheet_data, self.meta_data, {"arm": {"R0": "B"}}, 1, "pending",
+                                base_revision=3)
+        self.assertEqual(raised.exception.conflicts, [conflict])
+        journal_edits.assert_called_once()
+        apply_row_edits.assert_not_called()
+        edit_journal._get_collection.return_value.delete_many.assert_called_once_with(
+            {"sql_ref": "sheet", "pending": "pending"})
+        self.sheet_data.bump_revision.assert_not_called()
+
+    def test_edits_of_missing_rows_are_dropped(self, edit_journal):
+        with mock.patch("data_upload.editing.fetch_row_values", return_value={"R0": {"arm": "A"}}), \
+                mock.patch("data_upload.editing.journal_edits"), \
+                mock.patch("data_upload.editing.conflicting_edits", return_value=[]), \
+                mock.patch("data_upload.editing.get_column_dictionary", return_value=None), \
+                mock.patch("data_upload.editing.apply_row_edits") as apply_row_edits:
+            edited = write_row_edits(self.sheet_data, self.meta_data, {"arm": {"R0": "B", "R9": "C"}}, 1, "pending",
+                                     base_revision=3)
+        self.assertEqual(edited, {"R0"})
+        apply_row_edits.assert_called_once_with("sheet", {"arm": {"R0": "B"}}, 1000)
+        self.sheet_data.bump_revision.assert_not_called()
+
+
+class RetryTask(Exception):
+    pass
+
+
+def study_task():
+    task = mock.Mock()
+    task.request.id = "task-1"
+    task.retry.return_value = RetryTask()
+    return task
+
+
+@mock.patch("data_upload.scheduling.release_study_slot")
+@mock.patch("data_upload.scheduling.acquire_study_slot")
+class FairShareTests(SimpleTestCase):
+
+    def setUp(self):
+        self.function = mock.Mock(return_value="done")
+        self.wrapped = fair_share(lambda study_id: study_id)(self.function)
+
+    def test_task_runs_while_holding_a_slot(self, acquire_study_slot, release_study_slot):
+        acquire_study_slot.return_value = True
+        with mock.patch("data_upload.scheduling.current_task", study_task()):
+            self.assertEqual(self.wrapped("study-1"), "done")
+        acquire_study_slot.assert_called_once_with("study-1", "task-1")
+        release_study_slot.assert_called_once_with("study-1", "task-1")
+
+    @override_settings(STUDY_SLOT_RETRY_DELAY=15)
+    def test_task_is_retried_when_the_study_has_no_free_slot(self, acquire_study_slot, release_study_slot):
+        acquire_study_slot.return_value = False
+        task = study_task()
+        with mock.patch("data_upload.scheduling.current_task", task):
+            with self.assertRaises(RetryTask):
+                self.wrapped("study-1")
+        self.function.assert_not_called()
+        release_study_slot.assert_not_called()
+        task.retry.assert_called_once_with(countdown=15, max_retries=None)
+
+    def test_slot_is_released_when_the_task_fails(self, acquire_study_slot, release_study_slot):
+        acquire_study_slot.return_value = True
+        self.function.side_effect = ValueError("failed")
+        with mock.patch("data_upload.scheduling.current_task", study_task()):
+            with self.assertRaises(ValueError):
+                self.wrapped("study-1")
+        release_study_slot.assert_called_once_with("study-1", "task-1")
+
+    def test_calls_outside_a_task_or_without_a_study_run_directly(self, acquire_study_slot, release_study_slot):
+        with mock.patch("data_upload.scheduling.current_task", None):
+            self.assertEqual(self.wrapped("study-1"), "done")
+        with mock.patch("data_upload.scheduling.current_task", study_task()):
+            self.assertEqual(self.wrapped(None), "done")
+        acquire_study_slot.assert_not_called()
+
+
+class SchedulingTests(SimpleTestCase):
+
+    def test_unreachable_redis_does_not_block_tasks(self):
+        with mock.patch("data_upload.scheduling.get_scheduling_client") as client:
+            client.return_value.eval.side_effect = redis.RedisError("down")
+            self.assertTrue(acquire_study_slot("study-1", "task-1"))
+
+    @override_settings(INGEST_PRIORITY_THRESHOLDS=[100, 1000])
+    def test_smaller_uploads_get_higher_priorities(self):
+        self.assertEqual(ingest_priority(10), 9)
+        self.assertEqual(ingest_priority(100), 9)
+        self.assertEqual(ingest_priority(500), 7)
+        self.assertEqual(ingest_priority(5000), 5)
+
+
+class WorkspaceTests(SimpleTestCase):
+
+    def setUp(self):
+        self.scratch_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.scratch_root, ignore_errors=True)
+        settings_override = override_settings(SCRATCH_ROOT=self.scratch_root, SCRATCH_QUOTA_BYTES=1000,
+                                              SCRATCH_WORKSPACE_MAX_IDLE=60)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def idle_workspace(self, kind, job_id, idle):
+        workspace = Workspace(kind, job_id)
+        workspace.reserve("sheet.csv", 10)
+        past = time.time() - idle
+        os.utime(workspace.join(LEASE_FILE), (past, past))
+        return workspace
+
+    def test_reservations_of_all_workspaces_share_the_quota(self):
+        Workspace("uploads", "job-1").reserve("sheet.csv", 600)
+        with self.assertRaises(ScratchQuotaExceeded) as raised:
+            Workspace("uploads", "job-2").reserve("sheet.csv", 600)
+        self.assertTrue(raised.exception.retryable)
+        Workspace("uploads", "job-1").remove()
+        Workspace("uploads", "job-2").reserve("sheet.csv", 600)
+
+    def test_job_larger_than_the_quota_is_not_retried(self):
+        with self.assertRaises(ScratchQuotaExceeded) as raised:
+            Workspace("uploads", "job-1").reserve("sheet.csv", 1001)
+        self.assertFalse(raised.exception.retryable)
+
+    def test_reserving_a_file_again_replaces_its_reservation(self):
+        workspace = Workspace("uploads", "job-1")
+        workspace.reserve("sheet.csv", 600)
+        workspace.reserve("sheet.csv", 700)
+        workspace.reserve("other.csv", 300)
+        self.assertEqual(workspace.reservations(), {"sheet.csv": 700, "other.csv": 300})
+
+    def test_reaper_removes_workspaces_of_finished_jobs(self):
+        workspace = self.idle_workspace("uploads", "job-1", 0)
+        self.assertEqual(reap_workspaces(lambda kind, job_id: False), 1)
+        self.assertFalse(os.path.exists(workspace.path))
+
+    def test_reaper_keeps_idle_workspaces_of_queued_jobs(self):
+        workspace = self.idle_workspace("uploads", "job-1", 3600)
+        self.assertEqual(reap_workspaces(lambda kind, job_id: True), 0)
+        self.assertTrue(os.path.exists(workspace.path))
+
+    def test_reaper_removes_orphaned_workspaces_once_idle(self):
+        recent = self.idle_workspace("joins", "job-1", 0)
+        idle = self.idle_workspace("joins", "job-2", 3600)
+        self.assertEqual(reap_workspaces(lambda kind, job_id: None), 1)
+        self.assertTrue(os.path.exists(recent.path))
+        self.assertFalse(os.path.exists(idle.path))
+
+
+PARSER_CSV = '\ufeffsubject,arm,note\nS-1,A,plain\nS-2,B,"two\nlines"\nS-3,,"quoted, comma"\nS-4,D,\u00e9t\u00e9\n'
+PARSER_ROWS = [
+    {"subject": "S-1", "arm": "A", "note": "plain"},
+    {"subject": "S-2", "arm": "B", "note": "two\nlines"},
+    {"subject": "S-3", "arm": "", "note": "quoted, comma"},
+    {"subject": "S-4", "arm": "D", "note": "\u00e9t\u00e9"},
+]
+
+
+class SheetParserTests(SimpleTestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.work_dir, ignore_errors=True)
+        self.path = os.path.join(self.work_dir, "sheet.csv")
+        with open(self.path, "w", encoding="utf-8", newline="") as sheet_file:
+            sheet_file.write(PARSER_CSV)
+
+    def read_resumed(self, reader_class):
+        """Reads two rows, then resumes from the reported position with a fresh reader."""
+        with reader_class(self.path) as reader:
+            rows = reader.rows()
+            first_rows = [next(rows), next(rows)]
+            position = reader.position()
+        with reader_class(self.path) as reader:
+            return first_rows, list(reader.rows(position))
+
+    def test_csv_reader_reads_header_without_bom(self):
+        with CsvSheetReader(self.path) as reader:
+            self.assertEqual(reader.columns, ["subject", "arm", "note"])
+            self.assertEqual([dict(row) for row in reader.rows()], PARSER_ROWS)
+
+    def test_csv_reader_resumes_after_the_last_row_read(self):
+        first_rows, rest = self.read_resumed(CsvSheetReader)
+        self.assertEqual([dict(row) for row in first_rows + rest], PARSER_ROWS)
+
+    @skipUnless("arrow" in available_backends(), "pyarrow is not installed")
+    def test_arrow_reader_matches_the_csv_reader(self):
+        with ArrowCsvSheetReader(self.path) as reader:
+            self.assertEqual(reader.columns, ["subject", "arm", "note"])
+            self.assertEqual(list(reader.rows()), PARSER_ROWS)
+        first_rows, rest = self.read_resumed(ArrowCsvSheetReader)
+        self.assertEqual(first_rows + rest, PARSER_ROWS)
+
+    @override_settings(SHEET_PARSER_BACKEND="auto", SHEET_PARSER_ARROW_MIN_SIZE=10 ** 9)
+    def test_small_files_use_the_python_backend(self):
+        self.assertEqual(choose_backend(self.path, ".csv"), "python")
+        with open_sheet_reader(self.path, ".csv") as reader:
+            self.assertEqual(reader.backend, "python")
+
+    def test_unknown_file_types_and_backends(self):
+        self.assertIsNone(open_sheet_reader(self.path, ".txt", "python"))
+        with self.assertRaises(ValueError):
+            open_sheet_reader(self.path, ".csv", "fortran")
+
+
+@override_settings(ITER_CHUNK_SIZE=2, SHEET_PARSER_BACKEND="python")
+class IngestCheckpointTests(SimpleTestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.work_dir, ignore_errors=True)
+        with open(os.path.join(self.work_dir, "s1.csv"), "w", encoding="utf-8", newline="") as sheet_file:
+            sheet_file.write(PARSER_CSV)
+        self.sheet_data = mock.Mock(id="s1", file_type=".csv", unique_reference="ref", revision=0,
+                                    status=DataImportStatusEnum.PROCESSING)
+        self.workspace = self.patch("Workspace").return_value
+        self.workspace.join.return_value = self.work_dir
+        self.patch("SheetUploadData").objects.get.return_value = self.sheet_data
+        self.sheet_metadata = self.patch("SheetMetaData")
+        self.sheet_metadata.objects.return_value.first.return_value = None
+        self.sheet_metadata.objects.create.return_value = mock.Mock(sql_ref="ref", chunk_size=2, ingested_rows=0,
+                                                                    column_data=[])
+        self.create_chunk = self.patch("create_chunk")
+        self.checkpoint_ingest = self.patch("checkpoint_ingest")
+        self.discard_uncommitted_chunks = self.patch("discard_uncommitted_chunks")
+        self.patch("previous_sort_indexed_columns", return_value=set())
+        for name in ["ColumnDictionaryBuilder", "SearchIndexBuilder", "searchable_columns", "SearchDocument",
+                     "SavedQuery", "sheet_changed", "timezone"]:
+            self.patch(name)
+
+    def patch(self, name, **kwargs):
+        patcher = mock.patch("data_upload.tasks.{}".format(name), **kwargs)
+        self.addCleanup(patcher.stop)
+        return patcher.start()
+
+    def written_chunks(self):
+        return [(call[0][3], [(row["sct_id"], row["subject"]) for row in call[0][2]])
+                for call in self.create_chunk.call_args_list]
+
+    def test_every_chunk_is_checkpointed(self):
+        process_csv_file(None, "s1")
+        self.assertEqual(self.written_chunks(), [(0, [("R0", "S-1"), ("R1", "S-2")]),
+                                                 (1, [("R2", "S-3"), ("R3", "S-4")])])
+        self.assertEqual([call[0][1] for call in self.checkpoint_ingest.call_args_list], [2, 4])
+        self.assertEqual(self.sheet_data.status, DataImportStatusEnum.SUCCESS)
+        self.workspace.remove.assert_called_once_with()
+
+    def test_redelivery_resumes_after_the_checkpoint(self):
+        with CsvSheetReader(os.path.join(self.work_dir, "s1.csv")) as reader:
+            rows = reader.rows()
+            next(rows), next(rows)
+            position = reader.position()
+        checkpoint = mock.Mock(sql_ref="ref", chunk_size=2, ingested_rows=2, ingest_position=position,
+                               ingest_parser="python", column_data=[])
+        self.sheet_metadata.objects.return_value.first.return_value = checkpoint
+        process_csv_file(None, "s1")
+        self.sheet_metadata.objects.create.assert_not_called()
+        self.assertIs(self.discard_uncommitted_chunks.call_args[0][0], checkpoint)
+        self.assertEqual(self.written_chunks(), [(1, [("R2", "S-3"), ("R3", "S-4")])])
+        self.assertEqual(self.sheet_data.status, DataImportStatusEnum.SUCCESS)
+
+    def test_ingested_sheets_are_skipped_on_redelivery(self):
+        self.sheet_data.status = DataImportStatusEnum.SUCCESS
+        process_csv_file(None, "s1")
+        self.create_chunk.assert_not_called()
+        self.workspace.remove.assert_called_once_with()
+
+    def test_losing_the_metadata_race_leaves_the_upload_to_the_other_delivery(self):
+        self.sheet_metadata.objects.create.side_effect = NotUniqueError()
+        process_csv_file(None, "s1")
+        self.create_chunk.assert_not_called()
+        self.sheet_data.save.assert_not_called()
+        self.workspace.remove.assert_not_called()
+
+    def test_rows_past_the_checkpoint_are_discarded_and_committed_rows_counted(self):
+        checkpoint = mock.Mock(sql_ref="ref", chunk_size=2, ingested_rows=3)
+        dictionary_builder = mock.Mock()
+        with mock.patch("data_upload.tasks.MongoDbClient") as mongo_db_client:
+            mongo_db_client._get_collection.return_value.find.return_value = [
+                {"data": [{"sct_id": "R0"}, {"sct_id": "R1"}]}, {"data": [{"sct_id": "R2"}]}]
+            discard_uncommitted_chunks(checkpoint, dictionary_builder)
+        mongo_db_client.objects.assert_called_once_with(sql_ref="ref", chunk_no__gte=2)
+        self.assertEqual(mongo_db_client._get_collection.return_value.find.call_args[0][0],
+                         {"sql_ref": "ref", "chunk_no": {"$lt": 2}})
+        self.assertEqual(dictionary_builder.add.call_count, 3)
+
+
+@override_settings(ZIP_EXTRACT_THREADS=2, ZIP_EXTRACT_BUFFER_SIZE=4)
+class ZipRegistrationTests(SimpleTestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.work_dir, ignore_errors=True)
+        self.zip_upload_data = mock.Mock(id="zip", study_id="study", uploaded_by="user",
+                                         original_file_name="upload.zip")
+        self.sheet_upload_data = self.patch("SheetUploadData")
+        self.sheet_upload_data.side_effect = lambda **fields: SimpleNamespace(id=fields["original_file_name"],
+                                                                            **fields)
+        self.patch("transaction")
+
+    def patch(self, name, **kwargs):
+        patcher = mock.patch("data_upload.tasks.{}".format(name), **kwargs)
+        self.addCleanup(patcher.stop)
+        return patcher.start()
+
+    def test_members_are_registered_with_one_version_query_and_one_insert(self):
+        registered = SimpleNamespace(original_file_name="a.csv")
+        objects = self.sheet_upload_data.objects
+        objects.filter.side_effect = [
+            [registered], mock.Mock(**{"values.return_value.annotate.return_value.values_list.return_value":
+                                       [("c.csv", 2)]})]
+        sheets = register_zip_sheets(self.zip_upload_data, ["c.csv", "a.csv", "b.xlsx"])
+        self.assertEqual([sheet.original_file_name for sheet in sheets], ["c.csv", "a.csv", "b.xlsx"])
+        self.assertIs(sheets[1], registered)
+        self.assertEqual(objects.filter.call_args_list[1], mock.call(
+            study_id="study", original_file_name__in=["c.csv", "b.xlsx"], active=True))
+        new_sheets = objects.bulk_create.call_args[0][0]
+        self.assertEqual([(sheet.original_file_name, sheet.version_number, sheet.file_type) for sheet in new_sheets],
+                         [("c.csv", 3, ".csv"), ("b.xlsx", 1, ".xlsx")])
+        objects.bulk_create.assert_called_once()
+
+    def test_members_are_extracted_and_failures_marked_in_one_update(self):
+        with zipfile.ZipFile(os.path.join(self.work_dir, "upload.zip"), "w") as zip_file:
+            zip_file.writestr("a.csv", "subject\nS-1\n")
+            zip_file.writestr("nested/b.csv", "subject\nS-2\n")
+            zip_file.writestr("notes.txt", "not a sheet")
+        extracted_dir = os.path.join(self.work_dir, "extracted_files")
+        os.makedirs(extracted_dir)
+        workspace = self.patch("Workspace").return_value
+        workspace.join.side_effect = lambda *parts: os.path.join(self.work_dir, *parts)
+        workspace.makedirs.return_value = extracted_dir
+        self.patch("ZipUploadData").objects.get.return_value = self.zip_upload_data
+        sheets = [SimpleNamespace(id=index, original_file_name=name, file_type=".csv")
+                  for index, name in enumerate(["a.csv", "nested/b.csv", "missing.csv"])]
+        with mock.patch("data_upload.tasks.register_zip_sheets", return_value=sheets) as register:
+            self.assertEqual(process_zip_file("zip"), "zip")
+        register.assert_called_once_with(self.zip_upload_data, ["a.csv", "nested/b.csv"])
+        with open(os.path.join(extracted_dir, "1.csv")) as extracted:
+            self.assertEqual(extracted.read(), "subject\nS-2\n")
+        self.assertTrue(os.path.exists(os.path.join(extracted_dir, "0.csv")))
+        self.sheet_upload_data.objects.filter.assert_called_once_with(id__in=[2])
+        self.sheet_upload_data.objects.filter.return_value.update.assert_called_once_with(
+            status=DataImportStatusEnum.FAILURE)
+        self.zip_upload_data.save.assert_called_once_with()
+
+
+class PrescanTests(SimpleTestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.work_dir, ignore_errors=True)
+
+    def prescan(self, content, file_type=".csv"):
+        path = os.path.join(self.work_dir, "sheet" + file_type)
+        with open(path, "wb") as sheet_file:
+            sheet_file.write(content if isinstance(content, bytes) else content.encode("utf-8"))
+        return prescan_sheet(path, file_type)
+
+    def error_codes(self, report):
+        return [error["code"] for error in report.errors]
+
+    def test_valid_csv_passes(self):
+        report = self.prescan("subject,arm\nS-1,A\nS-2,B\n")
+        self.assertTrue(report.valid)
+        self.assertEqual(report.info["columns"], 2)
+        self.assertEqual(report.info["sampled_rows"], 2)
+        self.assertEqual(report.dict()["prescan"]["valid"], True)
+
+    def test_utf8_bom_is_accepted(self):
+        report = self.prescan(b"\xef\xbb\xbfsubject,arm\nS-1,A\n")
+        self.assertTrue(report.valid)
+        self.assertTrue(report.info["bom"])
+
+    def test_empty_file_is_rejected(self):
+        self.assertEqual(self.error_codes(self.prescan("  \n")), ["empty_file"])
+
+    def test_non_utf8_files_are_rejected(self):
+        self.assertEqual(self.error_codes(self.prescan("subject,arm\n".encode("utf-16"))), ["encoding"])
+        self.assertEqual(self.error_codes(self.prescan(b"subject,arm\nS-1,\xff\n")), ["encoding"])
+
+    def test_other_delimiters_are_rejected(self):
+        report = self.prescan("subject;arm;site\nS-1;A;X\nS-2;B;Y\n")
+        self.assertEqual(self.error_codes(report), ["delimiter"])
+        self.assertEqual(report.info["delimiter"], ";")
+
+    def test_blank_and_duplicate_headers_are_rejected(self):
+        report = self.prescan("subject,,arm,arm\nS-1,1,A,B\n")
+        self.assertEqual(self.error_codes(report), ["blank_header", "duplicate_header"])
+        self.assertEqual(report.errors[0]["columns"], [2])
+        self.assertEqual(report.errors[1]["columns"], ["arm"])
+
+    def test_ragged_rows_are_reported_with_their_lines(self):
+        report = self.prescan("subject,arm\nS-1,A\nS-2\nS-3,C,extra\n")
+        self.assertEqual(self.error_codes(report), ["ragged_rows"])
+        self.assertEqual(report.errors[0]["rows"], [{"line": 3, "fields": 1}, {"line": 4, "fields": 3}])
+
+    def test_quoted_newlines_are_not_ragged(self):
+        self.assertTrue(self.prescan('subject,note\nS-1,"two\nlines"\nS-2,plain\n').valid)
+
+    def test_other_file_types_are_rejected(self):
+        self.assertEqual(self.error_codes(self.prescan("subject\n", ".txt")), ["file_type"])
@@ -0,0 +1,146 @@
+import fcntl
+import json
+import logging
+import os
+import shutil
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+WORKSPACE_KINDS = ["uploads", "joins", "bulk_edits"]
+LEASE_FILE = ".lease"
+
+
+class ScratchQuotaExceeded(Exception):
+    def __init__(self, message, retryable=True):
+        super().__init__(message)
+        self.retryable = retryable
+
+
+@contextmanager
+def quota_lock():
+    os.makedirs(settings.SCRATCH_ROOT, exist_ok=True)
+    with open(os.path.join(settings.SCRATCH_ROOT, ".quota.lock"), "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def read_lease(path):
+    try:
+        with open(os.path.join(path, LEASE_FILE)) as lease_file:
+            return json.load(lease_file)
+    except (OSError, ValueError):
+        return None
+
+
+def lease_age(path):
+    try:
+        return time.time() - os.path.getmtime(os.path.join(path, LEASE_FILE))
+    except OSError:
+        return time.time() - os.path.getmtime(path)
+
+
+def workspace_paths(kind):
+    kind_path = os.path.join(settings.SCRATCH_ROOT, kind)
+    if not os.path.isdir(kind_path):
+        return []
+    return [os.path.join(kind_path, name) for name in os.listdir(kind_path)]
+
+
+def reserved_bytes(exclude=None):
+    total = 0
+    for kind in WORKSPACE_KINDS:
+        for path in workspace_paths(kind):
+            lease = read_lease(path) if path != exclude else None
+            if lease:
+                total += sum(lease.get("reservations", {}).values())
+    return total
+
+
+class Workspace:
+    """Scratch directory of one job, SCRATCH_ROOT/<kind>/<job id>.
+
+    Jobs reserve the disk space of every file they are about to write; the reservations of all workspaces together
+    stay under SCRATCH_QUOTA_BYTES. Reservations are named after their file, so a redelivered task reserving the same
+    file again does not count it twice. The lease file holds the reservations and its modification time is the
+    job's heartbeat, which keeps the reaper away from workspaces whose job record is gone while they are in use.
+    """
+
+    def __init__(self, kind, job_id):
+        self.kind = kind
+        self.job_id = str(job_id)
+        self.path = os.path.join(settings.SCRATCH_ROOT, kind, self.job_id)
+
+    def join(self, *parts):
+        return os.path.join(self.path, *parts)
+
+    def makedirs(self, *parts):
+        path = self.join(*parts)
+        os.makedirs(path, exist_ok=True)
+        return path
+
+    def reservations(self):
+        lease = read_lease(self.path)
+        return lease.get("reservations", {}) if lease else {}
+
+    def write_lease(self, reservations):
+        self.makedirs()
+        lease_path = self.join(LEASE_FILE)
+        with open(lease_path + ".tmp", "w") as lease_file:
+            json.dump({"kind": self.kind, "job_id": self.job_id, "reservations": reservations}, lease_file)
+        os.replace(lease_path + ".tmp", lease_path)
+
+    def reserve(self, name, size):
+        """Reserves size bytes for the file name, or raises ScratchQuotaExceeded when they do not fit."""
+        with quota_lock():
+            reservations = self.reservations()
+            reservations[name] = size
+            reserved = sum(reservations.values())
+            quota = settings.SCRATCH_QUOTA_BYTES
+            if quota and reserved > quota:
+                raise ScratchQuotaExceeded("Job needs {} bytes of scratch space, the quota is {}".format(
+                    reserved, quota), retryable=False)
+            in_use = reserved_bytes(exclude=self.path)
+            if quota and in_use + reserved > quota:
+                raise ScratchQuotaExceeded("Scratch quota in use: {} of {} bytes reserved".format(in_use, quota))
+            self.makedirs()
+            free = shutil.disk_usage(self.path).free
+            if size > free:
+                raise ScratchQuotaExceeded("Scratch disk has {} bytes free, job needs {}".format(free, size))
+            self.write_lease(reservations)
+        logger.info("Reserved {} bytes of scratch space for {} of {} {}".format(size, name, self.kind, self.job_id))
+
+    def touch(self):
+        lease_path = self.join(LEASE_FILE)
+        if os.path.exists(lease_path):
+            os.utime(lease_path)
+
+    def remove(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+
+
+def reap_workspaces(job_running):
+    """Removes the workspaces of finished jobs, and orphaned ones idle for SCRATCH_WORKSPACE_MAX_IDLE.
+
+    job_running(kind, job_id) returns True while the job owning a workspace still has work to do, False once it has
+    finished and None when there is no record of the job. A job waiting in the queue or between retries does not
+    touch its lease, so the idle timeout only applies to workspaces no job record accounts for.
+    """
+    reaped = 0
+    for kind in WORKSPACE_KINDS:
+        for path in workspace_paths(kind):
+            running = job_running(kind, os.path.basename(path))
+            idle = lease_age(path)
+            if running or (running is None and idle < settings.SCRATCH_WORKSPACE_MAX_IDLE):
+                continue
+            logger.info("Reaping scratch workspace {} of {} job idle for {:.0f}s".format(
+                path, "an orphaned" if running is None else "a finished", idle))
+            shutil.rmtree(path, ignore_errors=True)
+            reaped += 1
+    return reaped